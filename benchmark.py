@@ -0,0 +1,353 @@
+import functions.global_vars as glvars
+import functions.migrations as migrations
+import functions.sessions as sessions
+from functions.db_man import DBManager
+from functions.users import User
+from flask import Flask, session
+from flask_session import Session
+import argparse
+import random
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Benchmarks run against a throwaway copy of a seeded dataset, never against data.db.
+#   python benchmark.py profiles --rows 50000 --seconds 5
+#   python benchmark.py reserve --buyers 32 --tickets 200
+#   python benchmark.py sessions --clients 8 --seconds 5
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def seed_dataset(db_file, rows):
+    migrations.upgrade(db_file)
+    db_conn = sqlite3.connect(db_file)
+
+    db_conn.executemany(
+        f'INSERT INTO {glvars.users_table} (name, phone_number, address) VALUES (?, ?, ?)',
+        ((f'user {i}', f'09{i:09d}', f'address {i}') for i in range(1, rows // 10 + 2))
+    )
+    db_conn.executemany(
+        f'INSERT INTO {glvars.tickets_table} (code) VALUES (?)',
+        ((f'{i:06d}',) for i in range(rows))
+    )
+    db_conn.commit()
+    db_conn.execute('ANALYZE')
+    db_conn.close()
+
+
+def run_workload(db_man, rows, seconds, readers):
+    stop = threading.Event()
+    read_times = []
+    write_times = []
+    lock = threading.Lock()
+
+    def reader(seed):
+        offset = seed * 997
+        local = []
+        while not stop.is_set():
+            offset = (offset + 28) % max(rows - 28, 1)
+            start = time.perf_counter()
+            db_man.execute_query(f"SELECT * FROM {glvars.tickets_table} WHERE status = {glvars.status_available} LIMIT 28 OFFSET ?", (offset,))
+            local.append(time.perf_counter() - start)
+        with lock:
+            read_times.extend(local)
+
+    def writer():
+        i = 0
+        local = []
+        while not stop.is_set():
+            code = f'{i % rows:06d}'
+            status = glvars.status_ordered if (i // rows) % 2 == 0 else glvars.status_available
+            start = time.perf_counter()
+            db_conn = db_man.get_conn()
+            db_man.edit_row(glvars.tickets_table, ('code',), (code,), ('status',), (status,), db_conn)
+            db_man.commit(db_conn)
+            db_man.release_conn(db_conn)
+            local.append(time.perf_counter() - start)
+            i += 1
+        with lock:
+            write_times.extend(local)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return read_times, write_times
+
+
+def bench_profiles(args):
+    work_dir = tempfile.mkdtemp(prefix='scc-bench-')
+    seed_file = os.path.join(work_dir, 'seed.db')
+    seed_dataset(seed_file, args.rows)
+    print(f'Seeded {args.rows} tickets in {seed_file}')
+    print(f"{'profile':<10} {'reads/s':>10} {'read p95 ms':>12} {'writes/s':>10} {'write p95 ms':>13}")
+
+    try:
+        for profile_name in args.profile or glvars.db_profiles.keys():
+            db_file = os.path.join(work_dir, f'{profile_name}.db')
+            shutil.copyfile(seed_file, db_file)
+
+            db_man = DBManager(db_file, glvars.db_profiles[profile_name])
+            read_times, write_times = run_workload(db_man, args.rows, args.seconds, args.readers)
+            db_man.pool.close_all()
+
+            print(f'{profile_name:<10} {len(read_times) / args.seconds:>10.0f} {percentile(read_times, 95) * 1000:>12.2f} '
+                  f'{len(write_times) / args.seconds:>10.0f} {percentile(write_times, 95) * 1000:>13.2f}')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_pages(args):
+    work_dir = tempfile.mkdtemp(prefix='scc-bench-')
+    db_file = os.path.join(work_dir, 'pages.db')
+    seed_dataset(db_file, args.rows)
+    db_man = DBManager(db_file)
+    select = f'SELECT * FROM {glvars.tickets_table}'
+    where = (f"status = {glvars.status_available}",)
+
+    try:
+        print(f"{'page':>8} {'offset ms':>10} {'cursor ms':>10}")
+        for page in args.page or [1, 100, 1000, args.rows // args.limit - 1]:
+            offset = (page - 1) * args.limit
+
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                db_man.execute_page(select, 'code', where=where, limit=args.limit, offset=offset)
+            offset_ms = (time.perf_counter() - start) * 1000 / args.repeat
+
+            # The cursor a client would hold after walking to this page
+            edge = db_man.execute_query(f"SELECT code FROM {glvars.tickets_table} WHERE status = {glvars.status_available} ORDER BY code LIMIT 1 OFFSET ?", (max(offset - 1, 0),))
+            cursor = glvars.encode_cursor(k=edge[0][0], d='next') if offset else None
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                db_man.execute_page(select, 'code', where=where, limit=args.limit, cursor=cursor)
+            cursor_ms = (time.perf_counter() - start) * 1000 / args.repeat
+
+            print(f'{page:>8} {offset_ms:>10.3f} {cursor_ms:>10.3f}')
+    finally:
+        db_man.pool.close_all()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Buyers race for the same tickets through the real /cart/add route, session save included, with the
+# pool at its configured DB_POOL_SIZE. Use more buyers than that so requests have to share connections.
+def bench_reserve(args):
+    work_dir = tempfile.mkdtemp(prefix='scc-bench-')
+    db_file = os.path.join(work_dir, 'reserve.db')
+    seed_dataset(db_file, args.tickets)
+    db_conn = sqlite3.connect(db_file)
+    db_conn.executemany(
+        f'INSERT OR IGNORE INTO {glvars.users_table} (id, name, phone_number, address) VALUES (?, ?, ?, ?)',
+        ((i, f'buyer {i}', f'08{i:09d}', f'address {i}') for i in range(1, args.buyers + 1))
+    )
+    db_conn.commit()
+    db_conn.close()
+
+    # routes sets up its app, pool and managers on glvars.db_path when it is first imported
+    glvars.db_path = db_file
+    import routes
+    base_url = 'https://localhost'
+    print(f'{args.buyers} buyers, pool max_size={routes.db_man.pool.max_size}, timeout={routes.db_man.pool.timeout}s')
+
+    codes = [f'{i:06d}' for i in range(args.tickets)]
+    wins = {}
+    attempts = []
+    errors = []
+    session_mismatch = []
+    lock = threading.Lock()
+    start_line = threading.Barrier(args.buyers)
+
+    def buyer(buyer_id):
+        http = routes.app.test_client()
+        user = routes.users_man.get_user(buyer_id)['data'].to_dict()
+        with http.session_transaction(base_url=base_url) as sess:
+            sess['user_info'] = glvars.session_user(user)
+
+        # Every buyer walks the same codes in a different order so they collide constantly
+        wanted = codes[:]
+        random.Random(buyer_id).shuffle(wanted)
+        mine = set()
+        count = 0
+        start_line.wait()
+        for code in wanted:
+            res = http.post('/cart/add', json={'code': code}, base_url=base_url)
+            body = res.get_json(silent=True) or {}
+            count += 1
+            if res.status_code == 200 and body.get('success'):
+                mine.add(code)
+                with lock:
+                    wins.setdefault(code, []).append(buyer_id)
+            elif res.status_code != 200 or body.get('message') != 'Ticket already ordered!':
+                with lock:
+                    errors.append(f'{res.status_code} {body.get("message")}')
+
+        # The session has to point at the cart that holds what this buyer won
+        cart = (http.get('/cart/', base_url=base_url).get_json(silent=True) or {}).get('data') or {}
+        in_session = set(cart['tickets_bought'].split(';')) if cart.get('tickets_bought') else set()
+        with lock:
+            attempts.append(count)
+            if in_session != mine:
+                session_mismatch.append(buyer_id)
+
+    threads = [threading.Thread(target=buyer, args=(n + 1,)) for n in range(args.buyers)]
+    try:
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        double_sold = {code: buyers for code, buyers in wins.items() if len(buyers) > 1}
+        rows = routes.db_man.execute_query(
+            f'SELECT t.code, t.buyer_id, o.buyer_id FROM {glvars.tickets_table} t '
+            f'JOIN {glvars.order_items_table} i ON i.ticket_code = t.code '
+            f'JOIN {glvars.orders_table} o ON o.id = i.order_id'
+        )
+        mismatched = [row for row in rows if row[1] != row[2] or wins.get(row[0]) != [row[1]]]
+        pool = routes.db_man.pool_stats()
+
+        print(f'{args.buyers} buyers, {sum(attempts)} requests in {elapsed:.2f}s ({sum(attempts) / elapsed:.0f}/s)')
+        print(f'reserved {len(wins)}/{len(codes)} tickets, {len(errors)} errors, pool waits {pool["waits"]}, pool timeouts {pool["timeouts"]}')
+        print(f'double-sold: {len(double_sold)}, db rows not matching the winner: {len(mismatched)}, '
+              f'sessions not matching their cart: {len(session_mismatch)}')
+        for message in set(errors):
+            print(f'  error: {message}')
+        if double_sold or mismatched or session_mismatch or errors or pool['timeouts'] or len(rows) != len(wins):
+            raise SystemExit(1)
+    finally:
+        if isinstance(routes.app.session_interface, sessions.MemorySessionInterface):
+            routes.app.session_interface.stop()
+        routes.db_man.pool.close_all()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+# Same session settings as routes.py, with the store picked by backend
+def session_app(backend, work_dir):
+    app = Flask(__name__)
+    app.secret_key = 'benchmark'
+    app.config['SESSION_PERMANENT'] = False
+
+    db_man = None
+    if backend == 'filesystem':
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = os.path.join(work_dir, 'flask_sessions')
+        Session(app)
+    else:
+        db_file = os.path.join(work_dir, f'{backend}.db')
+        migrations.upgrade(db_file)
+        db_man = DBManager(db_file)
+        app.session_interface = sessions.make_session_interface(app, db_man, backend)
+
+    # Roughly what a storefront request does to the session: read the user, change the cart
+    @app.route('/login/<int:user_id>')
+    def login(user_id):
+        session['user_info'] = User(user_id).to_dict()
+        session['cart'] = {'id': 0, 'buyer_id': user_id, 'amount_bought': 0, 'tickets_bought': '', 'img_link': '', 'is_in_cart': True}
+        return 'OK'
+
+    @app.route('/cart/<code>')
+    def cart(code):
+        cart = dict(session['cart'])
+        codes = [c for c in cart['tickets_bought'].split(';') if c]
+        codes = codes[1:] if len(codes) >= 10 else codes + [code]
+        cart['tickets_bought'] = ';'.join(codes)
+        cart['amount_bought'] = len(codes)
+        session['cart'] = cart
+        return session['user_info']['name']
+
+    return app, db_man
+
+
+def bench_sessions(args):
+    work_dir = tempfile.mkdtemp(prefix='bench_sessions_')
+    print(f'{"backend":<11} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    try:
+        for backend in args.backend or ['filesystem', 'sqlite', 'memory']:
+            app, db_man = session_app(backend, work_dir)
+            stop = threading.Event()
+            times = []
+            errors = []
+            lock = threading.Lock()
+
+            def client(user_id):
+                http = app.test_client()
+                http.get(f'/login/{user_id}')
+                local = []
+                i = 0
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    res = http.get(f'/cart/{i:06d}')
+                    local.append(time.perf_counter() - start)
+                    if res.status_code != 200:
+                        with lock:
+                            errors.append(res.status_code)
+                    i += 1
+                with lock:
+                    times.extend(local)
+
+            threads = [threading.Thread(target=client, args=(n + 1,)) for n in range(args.clients)]
+            for thread in threads:
+                thread.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            print(f'{backend:<11} {len(times) / args.seconds:>8.0f} {percentile(times, 50) * 1000:>8.2f} '
+                  f'{percentile(times, 95) * 1000:>8.2f} {percentile(times, 99) * 1000:>8.2f}'
+                  + (f'  ({len(errors)} errors)' if errors else ''))
+
+            if isinstance(app.session_interface, sessions.MemorySessionInterface):
+                app.session_interface.stop()
+            if db_man is not None:
+                db_man.pool.close_all()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the lottery backend')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    profiles_parser = subparsers.add_parser('profiles', help='Compare SQLite PRAGMA profiles on the same dataset')
+    profiles_parser.add_argument('--rows', type=int, default=50000)
+    profiles_parser.add_argument('--seconds', type=float, default=5)
+    profiles_parser.add_argument('--readers', type=int, default=4)
+    profiles_parser.add_argument('--profile', action='append', choices=list(glvars.db_profiles.keys()))
+    profiles_parser.set_defaults(func=bench_profiles)
+
+    pages_parser = subparsers.add_parser('pages', help='Compare OFFSET and cursor pagination at increasing depth')
+    pages_parser.add_argument('--rows', type=int, default=200000)
+    pages_parser.add_argument('--limit', type=int, default=28)
+    pages_parser.add_argument('--repeat', type=int, default=20)
+    pages_parser.add_argument('--page', type=int, action='append')
+    pages_parser.set_defaults(func=bench_pages)
+
+    reserve_parser = subparsers.add_parser('reserve', help='Race buyers for the same tickets and check nothing is sold twice')
+    reserve_parser.add_argument('--buyers', type=int, default=32)
+    reserve_parser.add_argument('--tickets', type=int, default=200)
+    reserve_parser.set_defaults(func=bench_reserve)
+
+    sessions_parser = subparsers.add_parser('sessions', help='Compare session backends on cart-style session writes')
+    sessions_parser.add_argument('--clients', type=int, default=8)
+    sessions_parser.add_argument('--seconds', type=float, default=5)
+    sessions_parser.add_argument('--backend', action='append', choices=['filesystem', 'sqlite', 'memory'])
+    sessions_parser.set_defaults(func=bench_sessions)
+
+    args = parser.parse_args()
+    args.func(args)
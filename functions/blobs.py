@@ -0,0 +1,125 @@
+import functions.global_vars as glvars
+import hashlib
+import sqlite3
+import tempfile
+
+
+# Content-addressed store for uploaded files: a blob's key is the SHA-256 of its bytes,
+# so the same image uploaded twice is stored once and a key always means the same bytes.
+class BlobManager:
+    def __init__(self, db_man):
+        self.db_man = db_man
+
+    # Inside the caller's transaction, like the other *_no_commit helpers
+    def put_blob(self, data, content_type, db_conn):
+        digest = hashlib.sha256(data).hexdigest()
+        res = self.db_man.exec_no_commit(
+            f"INSERT OR IGNORE INTO {glvars.blobs_table} (hash, content_type, size, data, created_at) VALUES (?, ?, ?, ?, ?)",
+            (digest, content_type, len(data), data, glvars.now_epoch()),
+            db_conn,
+        )
+        if not res["success"]:
+            return glvars.ReturnMessage(False, res["message"]).send()
+
+        return glvars.ReturnData(True, "Stored blob", hash=digest, created=res["rows_affected"] == 1).send()
+
+    # Copies an upload stream chunk_size bytes at a time into a spooled temp file, hashing it on the way.
+    # Stops as soon as it goes past max_size, and types it from its first bytes. The caller closes "spool".
+    def spool_upload(self, stream, max_size=glvars.max_upload_bytes, chunk_size=glvars.blob_chunk_size):
+        spool = tempfile.SpooledTemporaryFile(max_size=glvars.upload_spool_memory)
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            if size > max_size:
+                spool.close()
+                return glvars.ReturnMessage(False, f"Image is over {max_size} bytes!").send()
+
+            if len(head) < 16:
+                head += chunk[:16 - len(head)]
+            digest.update(chunk)
+            spool.write(chunk)
+
+        content_type = glvars.sniff_image_type(head)
+        if not content_type:
+            spool.close()
+            return glvars.ReturnMessage(False, "Not a supported image!").send()
+
+        spool.seek(0)
+        return glvars.ReturnData(
+            True, "Spooled upload", spool=spool, hash=digest.hexdigest(), size=size, content_type=content_type
+        ).send()
+
+    # put_blob for a spool_upload result: the row is created with a zeroblob of the right size and
+    # filled in chunk by chunk, so the image is never held in memory whole. Known hashes are not rewritten.
+    def put_upload(self, upload, db_conn, chunk_size=glvars.blob_chunk_size):
+        res = self.db_man.exec_no_commit(
+            f"INSERT OR IGNORE INTO {glvars.blobs_table} (hash, content_type, size, data, created_at) VALUES (?, ?, ?, zeroblob(?), ?)",
+            (upload["hash"], upload["content_type"], upload["size"], upload["size"], glvars.now_epoch()),
+            db_conn,
+        )
+        if not res["success"]:
+            return glvars.ReturnMessage(False, res["message"]).send()
+
+        created = res["rows_affected"] == 1
+        if created and upload["size"]:
+            try:
+                with db_conn.blobopen(glvars.blobs_table, "data", res["id_affected"]) as blob:
+                    while True:
+                        chunk = upload["spool"].read(chunk_size)
+                        if not chunk:
+                            break
+                        blob.write(chunk)
+            except (sqlite3.Error, ValueError) as e:
+                return glvars.ReturnMessage(False, f"Could not write blob: {e}").send()
+
+        return glvars.ReturnData(True, "Stored blob", hash=upload["hash"], created=created).send()
+
+    # Metadata, plus the bytes themselves for blobs up to stream_threshold so the caller can send them
+    # without a second query. data is None for larger ones, which are left for stream_blob.
+    def get_blob_info(self, digest, stream_threshold=glvars.blob_stream_threshold):
+        res = self.db_man.execute_query(
+            f"SELECT rowid, content_type, size, CASE WHEN size <= ? THEN data END FROM {glvars.blobs_table} WHERE hash = ?",
+            (stream_threshold, digest),
+        )
+        if not isinstance(res, list):
+            return glvars.ReturnMessage(False, f"Could not load blob: {res}").send()
+        if not res:
+            return glvars.ReturnMessage(False, "Blob not found!").send()
+
+        rowid, content_type, size, data = res[0]
+        return glvars.ReturnData(
+            True, "Blob found", hash=digest, rowid=rowid, content_type=content_type, size=size, data=data
+        ).send()
+
+    # Yields the blob chunk_size bytes at a time through incremental blob I/O. The response body is
+    # produced after the request context is gone, so it holds its own pooled connection until done;
+    # only blobs over BLOB_STREAM_THRESHOLD come through here.
+    def stream_blob(self, rowid, chunk_size=glvars.blob_chunk_size):
+        db_conn = self.db_man.pool.checkout()
+        try:
+            with db_conn.blobopen(glvars.blobs_table, "data", rowid, readonly=True) as blob:
+                while True:
+                    chunk = blob.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            self.db_man.release_conn(db_conn)
+
+    def read_blob(self, digest):
+        res = self.db_man.execute_query(
+            f"SELECT content_type, data FROM {glvars.blobs_table} WHERE hash = ?", (digest,)
+        )
+        if not isinstance(res, list):
+            return glvars.ReturnMessage(False, f"Could not load blob: {res}").send()
+        if not res:
+            return glvars.ReturnMessage(False, "Blob not found!").send()
+
+        return glvars.ReturnData(True, "Blob found", content_type=res[0][0], data=res[0][1]).send()
@@ -87,7 +87,8 @@ class Cart():
 
 
 
-    def import_from_db(self, input_data):
+    # items are the ticket codes from the order_items table. Without them the legacy tickets_bought column is used.
+    def import_from_db(self, input_data, items=None):
         if input_data == None or not isinstance(input_data, Iterable):
             return 0
         
@@ -95,6 +96,11 @@ class Cart():
         self.user_id = input_data[1]
         self.img_link = input_data[4]
         self.is_in_cart = input_data[5]
+
+        if items is not None:
+            self.items = set(items)
+            self.items_len = len(self.items)
+            return glvars.ReturnMessage(True, 'Successfully imported!').send()
         
         # try:
         #     tickets_string = str(input_data[3])
@@ -1,59 +1,342 @@
 import functions.global_vars as glvars
+import re
 import sqlite3
-from flask import g
+import threading
+import time
+from flask import g, has_app_context
 from collections.abc import Iterable
 
+
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+
+class ConnectionPool():
+    def __init__(self, connect, max_size=glvars.db_pool_size, timeout=glvars.db_pool_timeout, idle_timeout=glvars.db_pool_idle_timeout):
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+
+        # Idle connections are kept as (conn, returned_at), most recently returned last
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {'created': 0, 'closed': 0, 'checkouts': 0, 'returns': 0, 'waits': 0, 'timeouts': 0}
+
+
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+        db_conn = None
+
+        with self._cond:
+            self._close_idle()
+            while True:
+                if self._idle:
+                    db_conn = self._idle.pop()[0]
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'No free connection after {self.timeout}s (max_size={self.max_size})')
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+
+            self._stats['checkouts'] += 1
+
+        if db_conn is None:
+            try:
+                db_conn = self.connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._stats['checkouts'] -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats['created'] += 1
+
+        return db_conn
+
+
+    def checkin(self, db_conn):
+        if not isinstance(db_conn, sqlite3.Connection):
+            return
+
+        # Never hand out a connection with someone else's half-done transaction
+        try:
+            if db_conn.in_transaction:
+                db_conn.rollback()
+        except sqlite3.Error:
+            self.discard(db_conn)
+            return
+
+        with self._cond:
+            self._stats['returns'] += 1
+            self._idle.append((db_conn, time.monotonic()))
+            self._cond.notify()
+
+
+    def discard(self, db_conn):
+        try:
+            db_conn.close()
+        except sqlite3.Error:
+            pass
+
+        with self._cond:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+
+
+    def close_all(self):
+        with self._cond:
+            for db_conn, _ in self._idle:
+                db_conn.close()
+                self._size -= 1
+                self._stats['closed'] += 1
+            self._idle = []
+
+
+    def _close_idle(self):
+        # Must be called with the lock held. Oldest connections sit at the front.
+        if self.idle_timeout <= 0:
+            return
+
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < cutoff:
+            db_conn = self._idle.pop(0)[0]
+            db_conn.close()
+            self._size -= 1
+            self._stats['closed'] += 1
+
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'max_size': self.max_size,
+                'idle_timeout': self.idle_timeout,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            })
+        return stats
+
+
 class DBManager():
-    def __init__(self, db_file_path=glvars.db_path):
-        self.db_path = db_file_path
+    # Without a path it opens glvars.db_path as it is when the manager is made (benchmark.py points it elsewhere)
+    def __init__(self, db_file_path=None, profile=glvars.db_profile):
+        self.db_path = db_file_path or glvars.db_path
+        self.profile = profile
+        self.pool = ConnectionPool(self.connect)
+
+
+    def connect(self):
+        # Pooled connections move between worker threads, one at a time
+        db_conn = sqlite3.connect(self.db_path, timeout=20, check_same_thread=False)
+        self.apply_profile(db_conn)
+        return db_conn
+
+
+    def apply_profile(self, db_conn):
+        for pragma, value in self.profile.items():
+            # PRAGMA values cannot be bound as parameters
+            if pragma not in glvars.db_pragmas or not re.fullmatch(r'-?\w+', str(value)):
+                raise ValueError(f'Invalid PRAGMA {pragma} = {value}')
+            db_conn.execute(f'PRAGMA {pragma} = {value}')
+
+
+    def profile_report(self):
+        db_conn, owned = self.borrow_conn()
+        try:
+            return {pragma: db_conn.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in glvars.db_pragmas}
+        finally:
+            if owned:
+                self.pool.checkin(db_conn)
 
 
+    # Outside of a request the caller owns the connection and must release_conn() it
     def get_conn(self):
+        if not has_app_context():
+            return self.pool.checkout()
+
         if '_database' not in g:
-            g._database = sqlite3.connect(self.db_path, timeout=20)
+            g._database = self.pool.checkout()
         return g._database
 
 
-    # Params must be a tuple
-    def execute_query(self, query, params=None):
-        db_conn = sqlite3.connect(self.db_path)
-        db_cur = db_conn.cursor()
-        # print('params= ', params)
-        # query = str()
+    def release_conn(self, db_conn):
+        self.pool.checkin(db_conn)
 
-        parameters = params
-        if not isinstance(params, tuple) and not isinstance(params, type(None)):
-            parameters = tuple(params)
 
+    # Inside an app context this is the request's connection (get_conn), so a request never holds more
+    # than one pool slot and cannot deadlock the pool waiting for a second one. owned tells the caller
+    # whether it checked the connection out itself and has to give it back.
+    # With attach=False the request's connection is only used if it already has one; otherwise the
+    # caller gets its own checkout, for callers in apps that never release g._database.
+    def borrow_conn(self, attach=True):
+        if has_app_context() and (attach or '_database' in g):
+            return self.get_conn(), False
+        return self.pool.checkout(), True
+
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+
+    # Params must be a tuple. Returns the exception instead of raising, so callers check isinstance(res, list).
+    # In a request it runs on the request's connection: SELECTs see the request's own uncommitted writes,
+    # and anything else commits them along with it.
+    def execute_query(self, query, params=None):
         try:
-            db_cur.execute(query, parameters or ())
+            db_conn, owned = self.borrow_conn()
         except sqlite3.DatabaseError as e:
             return e
 
-        if query.strip().upper().startswith('SELECT'):
-            return db_cur.fetchall()
-        else:
-            db_conn.commit()
-            return db_cur.lastrowid
+        try:
+            db_cur = db_conn.cursor()
+            # print('params= ', params)
+            # query = str()
+
+            parameters = params
+            if not isinstance(params, tuple) and not isinstance(params, type(None)):
+                parameters = tuple(params)
+
+            try:
+                db_cur.execute(query, parameters or ())
+            except sqlite3.DatabaseError as e:
+                return e
+
+            if query.strip().upper().startswith('SELECT'):
+                return db_cur.fetchall()
+            else:
+                db_conn.commit()
+                return db_cur.lastrowid
+        finally:
+            if owned:
+                self.pool.checkin(db_conn)
         
 
+    # Keyset pagination: a cursor carries the key at the edge of the current page, so page 5000
+    # costs the same as page 1. offset is only used when no cursor is given (legacy clients).
+    def execute_page(self, select, key, key_index=0, where=(), params=(), limit=28, cursor=None, offset=0):
+        conditions = list(where)
+        parameters = list(params)
+        direction = 'next'
+
+        if cursor:
+            cursor_data = glvars.decode_cursor(cursor)
+            if not cursor_data or cursor_data.get('d') not in ('next', 'prev') or 'k' not in cursor_data:
+                return glvars.ReturnMessage(False, 'Invalid cursor').send()
+
+            direction = cursor_data['d']
+            conditions.append(f'{key} > ?' if direction == 'next' else f'{key} < ?')
+            parameters.append(cursor_data['k'])
+            offset = 0
+
+        where_string = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'ASC' if direction == 'next' else 'DESC'
+        query = f'{select}{where_string} ORDER BY {key} {order} LIMIT ? OFFSET ?'
+
+        # One extra row tells whether there is a page after this one
+        rows = self.execute_query(query, parameters + [limit + 1, max(offset, 0)])
+        if not isinstance(rows, list):
+            return glvars.ReturnMessage(False, f'Could not load page: {rows}').send()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if direction == 'prev':
+            rows.reverse()
+
+        next_cursor = None
+        prev_cursor = None
+        if rows:
+            first_key = rows[0][key_index]
+            last_key = rows[-1][key_index]
+            if direction == 'next':
+                next_cursor = glvars.encode_cursor(k=last_key, d='next') if has_more else None
+                prev_cursor = glvars.encode_cursor(k=first_key, d='prev') if cursor or offset > 0 else None
+            else:
+                next_cursor = glvars.encode_cursor(k=last_key, d='next')
+                prev_cursor = glvars.encode_cursor(k=first_key, d='prev') if has_more else None
+
+        return glvars.ReturnData(True, 'Page loaded', data=rows, next_cursor=next_cursor, prev_cursor=prev_cursor).send()
+
+
+    # Ranked (e.g. FTS) results have no stable key to seek on, so their cursors carry an offset instead.
+    # query must end with its ORDER BY.
+    def execute_ranked_page(self, query, params=(), limit=28, cursor=None, offset=0):
+        if cursor:
+            cursor_data = glvars.decode_cursor(cursor)
+            if not cursor_data or not isinstance(cursor_data.get('o'), int):
+                return glvars.ReturnMessage(False, 'Invalid cursor').send()
+            offset = cursor_data['o']
+
+        offset = max(offset, 0)
+        rows = self.execute_query(f'{query} LIMIT ? OFFSET ?', list(params) + [limit + 1, offset])
+        if not isinstance(rows, list):
+            return glvars.ReturnMessage(False, f'Could not load page: {rows}').send()
+
+        has_more = len(rows) > limit
+        next_cursor = glvars.encode_cursor(o=offset + limit) if has_more else None
+        prev_cursor = glvars.encode_cursor(o=max(offset - limit, 0)) if offset > 0 else None
+
+        return glvars.ReturnData(True, 'Page loaded', data=rows[:limit], next_cursor=next_cursor, prev_cursor=prev_cursor).send()
+
+
     def exec_no_commit(self, query, params=None, conn=None):
         if not isinstance(conn, sqlite3.Connection):
-            db_conn = sqlite3.connect(self.db_path)
+            db_conn = self.get_conn()
         else:
             db_conn = conn
         db_cur = db_conn.cursor()
 
         parameters = params
-        if not isinstance(params, tuple) and not isinstance(params, None):
+        if not isinstance(params, tuple) and not isinstance(params, type(None)):
             parameters = tuple(params)
 
         try:
             db_cur.execute(query, parameters or ())
-        except sqlite3.DatabaseError:
-            return glvars.ReturnMessage(False, 'No such column').send()
+        except sqlite3.DatabaseError as e:
+            return glvars.ReturnMessage(False, f'Query failed: {e}').send()
+
+        return glvars.ReturnData(True, 'OK! DONT FORGET TO COMMIT!', db_conn=db_conn, id_affected=db_cur.lastrowid, rows_affected=db_cur.rowcount).send()
+
 
-        return glvars.ReturnData(True, 'OK! DONT FORGET TO COMMIT!', db_conn=db_conn, id_affected=db_cur.lastrowid).send()
+    # exec_no_commit for statements that return rows: SELECTs inside the caller's transaction, or ... RETURNING
+    def fetch_no_commit(self, query, params=None, conn=None):
+        if not isinstance(conn, sqlite3.Connection):
+            return glvars.ReturnMessage(False, 'NOT A DB CONN!').send()
+
+        parameters = params
+        if not isinstance(params, tuple) and not isinstance(params, type(None)):
+            parameters = tuple(params)
+
+        try:
+            rows = conn.execute(query, parameters or ()).fetchall()
+        except sqlite3.DatabaseError as e:
+            return glvars.ReturnMessage(False, f'Query failed: {e}').send()
+
+        return glvars.ReturnData(True, 'OK! DONT FORGET TO COMMIT!', db_conn=conn, rows=rows).send()
+
+
+    # Runs one prepared statement for every row in a single transaction. rows can be a generator.
+    def exec_many(self, query, rows, conn):
+        if not isinstance(conn, sqlite3.Connection):
+            return glvars.ReturnMessage(False, 'NOT A DB CONN!').send()
+
+        db_cur = conn.cursor()
+        try:
+            db_cur.executemany(query, rows)
+        except sqlite3.DatabaseError as e:
+            return glvars.ReturnMessage(False, f'Batch failed: {e}').send()
+
+        return glvars.ReturnData(True, 'OK! DONT FORGET TO COMMIT!', db_conn=conn, rows_affected=db_cur.rowcount).send()
     
 
     def commit(self, db_conn):
@@ -82,6 +365,25 @@ class DBManager():
         return glvars.ReturnData(True, 'Successfully added row', id_affected=response['id_affected']).send()
     
     
+    # on_conflict='IGNORE' skips rows that would break a UNIQUE/PRIMARY KEY constraint
+    def add_rows(self, table, cols, rows, db_conn, on_conflict=None):
+        if not isinstance(cols, Iterable) or not isinstance(rows, Iterable) or not isinstance(table, str) or not isinstance(db_conn, sqlite3.Connection):
+            return glvars.ReturnMessage(False, 'Invalid Data').send()
+        if on_conflict not in (None, 'IGNORE', 'REPLACE', 'ABORT'):
+            return glvars.ReturnMessage(False, 'Invalid conflict clause').send()
+
+        placeholders = ', '.join(['?'] * len(cols))
+        col_string = ', '.join(cols)
+        insert = f'INSERT OR {on_conflict}' if on_conflict else 'INSERT'
+
+        query = f"{insert} INTO {table} ({col_string}) VALUES ({placeholders})"
+        response = self.exec_many(query, rows, db_conn)
+        if not response['success']:
+            return glvars.ReturnMessage(False, f"Something in the backend went wrong: {response['message']}").send()
+
+        return glvars.ReturnData(True, 'Successfully added rows', rows_affected=response['rows_affected']).send()
+
+
     def delete_row(self, table, col, value, db_conn):
         if not isinstance(col, str) or not isinstance(value, str) or not isinstance(table, str):
             return glvars.ReturnMessage(False, 'Invalid Data').send()
@@ -92,9 +394,29 @@ class DBManager():
         return glvars.ReturnData(True, 'Successfully removed row', id_affected=response).send()
     
 
+    # values is an iterable of single values, one DELETE per value.
+    # With a tuple of cols, each value is a row matching every col instead.
+    def delete_rows(self, table, col, values, db_conn):
+        if not isinstance(col, (str, tuple)) or not isinstance(values, Iterable) or not isinstance(table, str):
+            return glvars.ReturnMessage(False, 'Invalid Data').send()
+
+        if isinstance(col, str):
+            query = f"DELETE FROM {table} WHERE {col} = ?"
+            rows = ((value,) for value in values)
+        else:
+            query = f"DELETE FROM {table} WHERE {' AND '.join(f'{c} = ?' for c in col)}"
+            rows = values
+
+        response = self.exec_many(query, rows, db_conn)
+        if not response['success']:
+            return glvars.ReturnMessage(False, response['message']).send()
+
+        return glvars.ReturnData(True, 'Successfully removed rows', rows_affected=response['rows_affected']).send()
+
+
     def edit_row(self, table, condition_cols, condition_values, edit_cols, edit_values, conn=None):
         if not isinstance(conn, sqlite3.Connection):
-            db_conn = sqlite3.connect(self.db_path)
+            db_conn = self.get_conn()
         else:
             db_conn = conn
 
@@ -115,6 +437,25 @@ class DBManager():
         return glvars.ReturnMessage(True, 'Edited row(s)').send()
     
 
+    # Each row holds the edit values followed by the condition values, same order as edit_row's params
+    def edit_rows(self, table, condition_cols, edit_cols, rows, db_conn):
+        if (not isinstance(table, str)
+            or not isinstance(condition_cols, Iterable)
+            or not isinstance(edit_cols, Iterable)
+            or not isinstance(rows, Iterable)):
+            return glvars.ReturnMessage(False, 'Incorrect value types').send()
+
+        condition_string = ' AND '.join(f'{col} = ?' for col in condition_cols)
+        edit_string = ', '.join(f'{col} = ?' for col in edit_cols)
+        query = f'UPDATE {table} SET {edit_string} WHERE {condition_string}'
+
+        response = self.exec_many(query, rows, db_conn)
+        if not response['success']:
+            return glvars.ReturnMessage(False, response['message']).send()
+
+        return glvars.ReturnData(True, 'Edited row(s)', rows_affected=response['rows_affected']).send()
+
+
     def rollback(self, db_conn):
         if not isinstance(db_conn, sqlite3.Connection):
             return glvars.ReturnMessage(False, 'Provide a db connection!').send()
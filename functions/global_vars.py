@@ -1,13 +1,15 @@
 from dotenv import load_dotenv
 from flask import session, jsonify
 from collections.abc import Iterable
-from datetime import datetime, timedelta
+from datetime import datetime
 import re
 import base64
+import binascii
 import sqlite3
 import json
 import logging
 import os
+import time
 
 load_dotenv()
 
@@ -16,9 +18,43 @@ db_path = os.getenv('DB_PATH', './data.db')
 tickets_table = os.getenv('TICKETS_TABLE', 'tickets') 
 users_table = os.getenv('USERS_TABLE', 'users')
 orders_table = os.getenv('ORDERS_TABLE', 'orders')
+order_items_table = os.getenv('ORDER_ITEMS_TABLE', 'order_items')
+users_fts_table = os.getenv('USERS_FTS_TABLE', 'users_fts')
+tickets_fts_table = os.getenv('TICKETS_FTS_TABLE', 'tickets_fts')
+blobs_table = os.getenv('BLOBS_TABLE', 'blobs')
+thumbnails_table = os.getenv('THUMBNAILS_TABLE', 'thumbnails')
+sessions_table = os.getenv('SESSIONS_TABLE', 'sessions')
 secret_key = os.getenv('SECRET_KEY', '')
 price_each = os.getenv('PRICE_EACH', 30000)
 
+# Connection pool
+db_pool_size = int(os.getenv('DB_POOL_SIZE', 16))
+db_pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', 20))
+db_pool_idle_timeout = float(os.getenv('DB_POOL_IDLE_TIMEOUT', 300))
+
+# SQLite performance profiles, applied to every new connection.
+# 'default' leaves SQLite's own settings untouched.
+db_pragmas = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout']
+db_profiles = {
+    'default': {},
+    'safe': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -8000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 20000
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 20000
+    }
+}
+
 status_codes = [
     os.getenv('STATUS_AVAILABLE', 'available'),
     os.getenv('STATUS_ORDERED', 'ordered'),
@@ -26,6 +62,10 @@ status_codes = [
     os.getenv('STATUS_CONFIRMED', 'confirmed')
 ]
 
+# tickets.status is stored as its index in status_codes and tickets.expire_at as epoch seconds.
+# The names and formatted times only appear at the JSON boundary (see ticket_row_to_json).
+status_available, status_ordered, status_processing, status_confirmed = range(len(status_codes))
+
 format_code = os.getenv('FORMAT_CODE', '%Y-%m-%d %H:%M:%S')
 
 expire_hours = [
@@ -33,6 +73,87 @@ expire_hours = [
     int(os.getenv('PROCESSED_EXPIRE_TIME', 24))
 ]
 
+# Most codes a single /cart/add_many request may reserve
+cart_batch_max = int(os.getenv('CART_BATCH_MAX', 200))
+# Most orders a single /order/confirm_batch or /order/cancel_batch request may touch
+order_batch_max = int(os.getenv('ORDER_BATCH_MAX', 500))
+
+# The expiry sweep releases at most PRUNE_CHUNK_SIZE tickets per transaction and
+# sleeps PRUNE_CHUNK_PAUSE seconds between chunks so storefront writes can get in
+prune_chunk_size = int(os.getenv('PRUNE_CHUNK_SIZE', 500))
+prune_chunk_pause = float(os.getenv('PRUNE_CHUNK_PAUSE', 0.05))
+
+# Blobs up to BLOB_STREAM_THRESHOLD bytes are sent from one query; larger ones are streamed out
+# BLOB_CHUNK_SIZE bytes at a time. They never change (the key is their SHA-256),
+# so clients may keep them for BLOB_CACHE_MAX_AGE seconds.
+blob_stream_threshold = int(os.getenv('BLOB_STREAM_THRESHOLD', 1024 * 1024))
+blob_chunk_size = int(os.getenv('BLOB_CHUNK_SIZE', 65536))
+blob_cache_max_age = int(os.getenv('BLOB_CACHE_MAX_AGE', 31536000))
+
+# Largest payment image accepted, in bytes. Multipart uploads are cut off as soon as they go past it.
+max_upload_bytes = int(os.getenv('MAX_UPLOAD_BYTES', 5 * 1024 * 1024))
+# Uploads up to UPLOAD_SPOOL_MEMORY bytes are kept in memory, bigger ones are spooled to a temp file
+upload_spool_memory = int(os.getenv('UPLOAD_SPOOL_MEMORY', 512 * 1024))
+
+# Thumbnail edge lengths in px that clients may ask for; anything else is rounded up to the next one.
+# Rendering needs Pillow, without it the full image is served instead.
+thumbnail_sizes = sorted(int(size) for size in os.getenv('THUMBNAIL_SIZES', '128,256').split(','))
+thumbnail_quality = int(os.getenv('THUMBNAIL_QUALITY', 80))
+
+# bcrypt runs in a pool of HASH_WORKERS processes (0 hashes on the calling thread). Past HASH_QUEUE_MAX
+# hashes waiting or running, new ones fail fast with 'busy' instead of piling up behind a login burst.
+bcrypt_rounds = int(os.getenv('BCRYPT_ROUNDS', 12))
+hash_workers = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))
+hash_queue_max = int(os.getenv('HASH_QUEUE_MAX', 64))
+hash_timeout = float(os.getenv('HASH_TIMEOUT', 10))
+hash_start_method = os.getenv('HASH_START_METHOD', 'fork')
+
+# Bulk user import: rows are hashed and inserted USER_IMPORT_BATCH at a time, one transaction per batch.
+# Keep it well under HASH_QUEUE_MAX so logins still get a slot. Past USER_IMPORT_MAX_ERRORS, errors are only counted.
+user_import_batch = int(os.getenv('USER_IMPORT_BATCH', 16))
+user_import_max_errors = int(os.getenv('USER_IMPORT_MAX_ERRORS', 200))
+
+# Where Flask-Session keeps sessions: 'sqlite' (sessions table), 'memory' (in-process LRU of SESSION_MEMORY_MAX
+# sessions, written behind to the sessions table every SESSION_FLUSH_INTERVAL seconds; single process only)
+# or 'filesystem' (one file per session in ./tmp/flask_sessions). Expired sessions are deleted about once every
+# SESSION_CLEANUP_N_REQUESTS requests.
+session_backend = os.getenv('SESSION_BACKEND', 'sqlite')
+session_memory_max = int(os.getenv('SESSION_MEMORY_MAX', 10000))
+session_flush_interval = float(os.getenv('SESSION_FLUSH_INTERVAL', 5))
+session_cleanup_n_requests = int(os.getenv('SESSION_CLEANUP_N_REQUESTS', 1000))
+
+# With SLIM_SESSIONS=1 the session only keeps the user's id and role and the cart's id, so its size stays the same
+# however many tickets a user has. The rest (tickets, pfp, cart items) is loaded per request when a route needs it.
+slim_sessions = os.getenv('SLIM_SESSIONS', '1') == '1'
+
+# UserManager.get_user keeps up to USER_CACHE_SIZE users (0 turns it off) for USER_CACHE_TTL seconds (0: until evicted).
+# Writes in this process drop the user straight away; the TTL only matters for changes made by other processes.
+user_cache_size = int(os.getenv('USER_CACHE_SIZE', 1024))
+user_cache_ttl = float(os.getenv('USER_CACHE_TTL', 60))
+
+# Carts nobody has touched for CART_TTL_HOURS are deleted by the cart cleanup, with any tickets they still hold
+cart_ttl_hours = float(os.getenv('CART_TTL_HOURS', 24))
+
+# With LAZY_EXPIRY=1 an ordered/processing ticket reads as available as soon as its expire_at passes,
+# and can be reserved again right away. Releasing it in the database is left to the scheduler/prune job.
+lazy_expiry = os.getenv('LAZY_EXPIRY', '0') == '1'
+
+# In-process expiry scheduler: releases each ticket as its expire_at passes instead of waiting for the sweep
+expiry_scheduler_enabled = os.getenv('EXPIRY_SCHEDULER', '1') == '1'
+# Codes whose release failed (e.g. the database was locked) are tried again this many seconds later
+expiry_retry_delay = float(os.getenv('EXPIRY_RETRY_DELAY', 5))
+
+# In-process index of available ticket codes for the storefront.
+# Other processes (e.g. the prune job) can change tickets too, so it is reloaded every TICKET_INDEX_REFRESH seconds.
+ticket_index_enabled = os.getenv('TICKET_INDEX', '1') == '1'
+ticket_index_refresh = float(os.getenv('TICKET_INDEX_REFRESH', 60))
+
+# Columns mirrored into the FTS5 search indexes
+users_fts_columns = ['name', 'phone_number', 'address', 'email']
+tickets_fts_columns = ['code', 'note_for']
+# The trigram tokenizer cannot match anything shorter
+fts_min_length = 3
+
 # Logger Variable here
 logger = logging.getLogger(__name__)
 roles = ['user', 'mod', 'agent', 'admin']
@@ -117,6 +238,71 @@ def pair_iters_to_string(obj1, obj2):
     return pair_string, tuple(obj2) 
 
 
+# "100-105;7" -> '100', '101', ..., '105', '7'. A zero-padded range keeps its width ("002-005" -> '002', ...).
+# Stops once limit codes are out, so a huge range is never expanded in full.
+def parse_codes(code_string, limit=None):
+    codes = []
+    for c in str(code_string).strip().split(';'):
+        c_mod = [part.strip() for part in c.strip().split('-')]
+
+        if len(c_mod) == 2:
+            if not all(re.fullmatch(r'[0-9]+', part) for part in c_mod):
+                return ReturnMessage(False, f'Invalid code range "{c.strip()}"!').send()
+
+            start, end = int(c_mod[0]), int(c_mod[1])
+            if start > end:
+                start, end = end, start
+            width = max((len(part) for part in c_mod if len(part) > 1 and part.startswith('0')), default=0)
+
+            for j in range(start, end + 1):
+                codes.append(str(j).zfill(width))
+                if limit and len(codes) >= limit:
+                    return ReturnData(True, 'Parsed codes', codes=codes).send()
+
+        elif len(c_mod) == 1 and c_mod[0]:
+            codes.append(c_mod[0])
+            if limit and len(codes) >= limit:
+                return ReturnData(True, 'Parsed codes', codes=codes).send()
+
+        elif len(c_mod) > 2:
+            return ReturnMessage(False, f'Invalid code range "{c.strip()}"!').send()
+
+    return ReturnData(True, 'Parsed codes', codes=codes).send()
+
+
+# Search types come straight from the query string and end up in the SQL, so only plain column names pass
+def is_column_name(name):
+    return bool(re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?', str(name)))
+
+
+# 'u.name' -> 'name' if that column is in the FTS index, otherwise None
+def fts_column(search_for, fts_columns):
+    column = str(search_for).split('.')[-1]
+    return column if column in fts_columns else None
+
+
+# Quoted as a single FTS5 phrase so user input can never be read as query syntax
+def fts_match(column, q):
+    escaped = str(q).replace('"', '""')
+    return f'{column} : "{escaped}"'
+
+
+# Pagination cursors are opaque to clients: urlsafe base64 of a small JSON object
+def encode_cursor(**cursor_data):
+    raw = json.dumps(cursor_data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+    return cursor_data if isinstance(cursor_data, dict) else None
+
+
 def check_multi_conditions(condition_func, *params):
     results = []
     params_list = [*params]
@@ -136,6 +322,24 @@ def check_multi_conditions(condition_func, *params):
 
 
 
+# Any single PRAGMA can be overridden with DB_<NAME>, e.g. DB_SYNCHRONOUS=FULL
+def load_db_profile(profile_name):
+    if profile_name not in db_profiles:
+        raise ValueError(f'Unknown DB_PROFILE {profile_name}, expected one of {list(db_profiles.keys())}')
+
+    profile = dict(db_profiles[profile_name])
+    for pragma in db_pragmas:
+        env_value = os.getenv(f'DB_{pragma.upper()}')
+        if env_value:
+            profile[pragma] = env_value
+
+    return profile
+
+
+db_profile_name = os.getenv('DB_PROFILE', 'fast')
+db_profile = load_db_profile(db_profile_name)
+
+
 def setup_logger():
     log_file_path = os.path.join(app_root_dir, 'run.log')
 
@@ -148,17 +352,68 @@ def setup_logger():
     )
 
 
-def set_exp_time(current_time_string, time_unit='hours', time_units=60):
-    dt_obj = datetime.strptime(current_time_string, format_code)
+def now_epoch():
+    return int(time.time())
+
 
-    if time_unit == 'minutes':
-        td_obj = timedelta(minutes=time_units)
-    else:
-        td_obj = timedelta(hours=time_units)
+def expire_after(hours):
+    return now_epoch() + int(hours) * 3600
 
-    new_dt_obj = dt_obj + td_obj
 
-    return new_dt_obj.strftime(format_code)
+def status_name(status):
+    return status_codes[status] if isinstance(status, int) and 0 <= status < len(status_codes) else status
+
+
+def status_id(name):
+    return status_codes.index(name) if name in status_codes else None
+
+
+# Confirmed tickets never expire; they used to carry the string 'never', and the JSON still does
+def format_expire_at(expire_at, status=None):
+    if expire_at is None:
+        return 'never' if status == status_confirmed else None
+    return datetime.fromtimestamp(expire_at).strftime(format_code)
+
+
+def parse_expire_at(value):
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(datetime.strptime(str(value), format_code).timestamp())
+    except ValueError:
+        return None
+
+
+# Ticket rows straight from SQL, with the status and expire_at columns turned back into what clients expect
+def ticket_row_to_json(row, status_index, expire_index=None):
+    row = list(row)
+    status = row[status_index]
+    row[status_index] = status_name(status)
+    if expire_index is not None:
+        row[expire_index] = format_expire_at(row[expire_index], status)
+    return row
+
+
+# Tickets as readers should see them, as (sql, params) to use in a FROM clause. With lazy expiry,
+# lapsed holds come back with the available status and no buyer, note or expire_at.
+def tickets_source():
+    if not lazy_expiry:
+        return tickets_table, ()
+
+    sql = (
+        f"(SELECT rowid AS rowid, code, IIF(lapsed, ?, status) AS status, IIF(lapsed, NULL, expire_at) AS expire_at, "
+        f"IIF(lapsed, NULL, buyer_id) AS buyer_id, IIF(lapsed, '', note_for) AS note_for "
+        f"FROM (SELECT rowid, *, (status IN (?, ?) AND expire_at <= ?) AS lapsed FROM {tickets_table}))"
+    )
+    return sql, (status_available, status_ordered, status_processing, now_epoch())
+
+
+# WHERE condition for a ticket that may be reserved right now, as (sql, params)
+def reservable_condition():
+    if not lazy_expiry:
+        return 'status = ?', (status_available,)
+
+    return '(status = ? OR (status IN (?, ?) AND expire_at <= ?))', (status_available, status_ordered, status_processing, now_epoch())
 
 
 # Shameful but i got the following from GPT
@@ -177,4 +432,54 @@ def is_base64_image(s):
         base64.b64decode(base64_data, validate=True)
         return True
     except Exception:
-        return False
\ No newline at end of file
+        return False
+
+
+image_types = {'png': 'image/png', 'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'bmp': 'image/bmp'}
+
+# The first bytes of each accepted image type. Uploads are typed by these, never by what the client claims.
+image_signatures = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+
+def sniff_image_type(head):
+    for signature, content_type in image_signatures:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+# "data:image/png;base64,..." -> ('image/png', raw bytes), or None if it is not a valid image data URL
+def decode_data_url(s):
+    match = re.match(r'^data:image/(png|jpeg|jpg|gif|bmp);base64,', s or '')
+    if not match:
+        return None
+
+    try:
+        data = base64.b64decode(s[match.end():], validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+    return image_types[match.group(1)], data
+
+
+def encode_data_url(content_type, data):
+    return f"data:{content_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+# What session['user_info'] / session['cart'] hold for a full user or cart dict
+def session_user(user_dict):
+    if not slim_sessions or not user_dict:
+        return user_dict
+    return {'id': user_dict['id'], 'role': user_dict['role']}
+
+
+def session_cart(cart_dict):
+    if not slim_sessions or not cart_dict:
+        return cart_dict
+    return {'id': cart_dict['id']}
@@ -0,0 +1,224 @@
+import functions.global_vars as glvars
+import bcrypt
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+
+# These run in the worker processes, so they have to be plain module-level functions
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def check_password(password, pass_hash):
+    return bcrypt.checkpw(password, pass_hash)
+
+
+# Returns the result with how long the worker spent on it, which separates hashing time from queue wait
+def timed_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def noop():
+    return None
+
+
+# bcrypt off the request threads: hashes and checks go to a bounded process pool. Once max_queue
+# of them are waiting or running, new ones are refused straight away (busy=True) so a login burst
+# cannot tie up every worker thread.
+class PasswordHasher:
+    def __init__(self, workers=glvars.hash_workers, max_queue=glvars.hash_queue_max, timeout=glvars.hash_timeout, rounds=glvars.bcrypt_rounds):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.rounds = rounds
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            'submitted': 0, 'completed': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0,
+            'hash_ms_total': 0.0, 'hash_ms_max': 0.0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0
+        }
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context(glvars.hash_start_method)
+            )
+        return self._executor
+
+    # With fork, every worker is forked on the first submit. Doing that at startup, before the app
+    # starts its own threads, keeps those threads' locks out of the children.
+    def start(self):
+        if self.workers <= 0:
+            return glvars.ReturnMessage(True, 'Hashing on the calling thread').send()
+
+        with self._lock:
+            executor = self._get_executor()
+        executor.submit(noop).result()
+        return glvars.ReturnMessage(True, f'Password hasher started with {self.workers} workers').send()
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _record(self, hash_seconds, total_seconds):
+        hash_ms = hash_seconds * 1000
+        wait_ms = max(total_seconds - hash_seconds, 0) * 1000
+        with self._lock:
+            self._stats['completed'] += 1
+            self._stats['hash_ms_total'] += hash_ms
+            self._stats['hash_ms_max'] = max(self._stats['hash_ms_max'], hash_ms)
+            self._stats['wait_ms_total'] += wait_ms
+            self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], wait_ms)
+
+    def _run(self, func, *args):
+        start = time.perf_counter()
+        if self.workers <= 0:
+            result, hash_seconds = timed_call(func, *args)
+            with self._lock:
+                self._stats['submitted'] += 1
+            self._record(hash_seconds, time.perf_counter() - start)
+            return glvars.ReturnData(True, 'OK', result=result).send()
+
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self._stats['rejected'] += 1
+                return glvars.ReturnData(False, 'Server is busy, please try again in a moment!', busy=True).send()
+            self._pending += 1
+            self._stats['submitted'] += 1
+            executor = self._get_executor()
+
+        try:
+            future = executor.submit(timed_call, func, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._reset(executor)
+            with self._lock:
+                self._pending -= 1
+                self._stats['errors'] += 1
+            return glvars.ReturnData(False, f'Password hashing failed: {e}', busy=False).send()
+        # The slot is only freed once the worker is really done, even if the caller gave up waiting
+        future.add_done_callback(self._done)
+
+        try:
+            result, hash_seconds = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            return glvars.ReturnData(False, 'Server is busy, please try again in a moment!', busy=True).send()
+        except BrokenProcessPool as e:
+            self._reset(executor)
+            with self._lock:
+                self._stats['errors'] += 1
+            return glvars.ReturnData(False, f'Password hashing failed: {e}', busy=False).send()
+
+        self._record(hash_seconds, time.perf_counter() - start)
+        return glvars.ReturnData(True, 'OK', result=result).send()
+
+    # A worker died; the next call gets a fresh pool
+    def _reset(self, broken_executor):
+        with self._lock:
+            if self._executor is broken_executor:
+                self._executor = None
+
+    def hash(self, password):
+        res = self._run(hash_password, password.encode('utf-8'), self.rounds)
+        if not res['success']:
+            return res
+        return glvars.ReturnData(True, 'Hashed password', hash=res['result']).send()
+
+    def check(self, password, pass_hash):
+        res = self._run(check_password, password.encode('utf-8'), pass_hash)
+        if not res['success']:
+            return res
+        return glvars.ReturnData(True, 'Checked password', valid=res['result']).send()
+
+    # Hashes a batch in parallel, all of it counted against max_queue at once. Bulk callers should keep
+    # batches well under max_queue so logins still get through while they run.
+    def hash_many(self, passwords):
+        passwords = [password.encode('utf-8') for password in passwords]
+        if not passwords:
+            return glvars.ReturnData(True, 'Nothing to hash', hashes=[]).send()
+
+        start = time.perf_counter()
+        if self.workers <= 0:
+            hashes = []
+            for password in passwords:
+                result, hash_seconds = timed_call(hash_password, password, self.rounds)
+                hashes.append(result)
+                self._record(hash_seconds, hash_seconds)
+            with self._lock:
+                self._stats['submitted'] += len(passwords)
+            return glvars.ReturnData(True, 'Hashed passwords', hashes=hashes).send()
+
+        with self._lock:
+            if self._pending + len(passwords) > self.max_queue:
+                self._stats['rejected'] += len(passwords)
+                return glvars.ReturnData(False, 'Server is busy, please try again in a moment!', busy=True).send()
+            self._pending += len(passwords)
+            self._stats['submitted'] += len(passwords)
+            executor = self._get_executor()
+
+        futures = []
+        try:
+            for password in passwords:
+                future = executor.submit(timed_call, hash_password, password, self.rounds)
+                future.add_done_callback(self._done)
+                futures.append(future)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._reset(executor)
+            with self._lock:
+                self._pending -= len(passwords) - len(futures)
+                self._stats['errors'] += 1
+            return glvars.ReturnData(False, f'Password hashing failed: {e}', busy=False).send()
+
+        hashes = []
+        deadline = start + self.timeout * len(passwords) / max(self.workers, 1)
+        try:
+            for future in futures:
+                result, hash_seconds = future.result(timeout=max(deadline - time.perf_counter(), 0))
+                self._record(hash_seconds, time.perf_counter() - start)
+                hashes.append(result)
+        except FutureTimeout:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            return glvars.ReturnData(False, 'Server is busy, please try again in a moment!', busy=True).send()
+        except BrokenProcessPool as e:
+            self._reset(executor)
+            with self._lock:
+                self._stats['errors'] += 1
+            return glvars.ReturnData(False, f'Password hashing failed: {e}', busy=False).send()
+
+        return glvars.ReturnData(True, 'Hashed passwords', hashes=hashes).send()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            pending = self._pending
+
+        completed = stats['completed'] or 1
+        return {
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'pending': pending,
+            'submitted': stats['submitted'],
+            'completed': stats['completed'],
+            'rejected': stats['rejected'],
+            'timeouts': stats['timeouts'],
+            'errors': stats['errors'],
+            'hash_ms_avg': round(stats['hash_ms_total'] / completed, 2),
+            'hash_ms_max': round(stats['hash_ms_max'], 2),
+            'wait_ms_avg': round(stats['wait_ms_total'] / completed, 2),
+            'wait_ms_max': round(stats['wait_ms_max'], 2),
+        }
@@ -0,0 +1,104 @@
+import functions.global_vars as glvars
+import datetime
+import importlib.util
+import os
+import re
+import sqlite3
+
+# Migrations live in <repo>/migrations as NNNN_name.sql or NNNN_name.py (with an upgrade(db_conn) function).
+# Each one runs in its own short IMMEDIATE transaction, so readers keep going while a live database upgrades.
+migrations_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+migrations_table = 'schema_migrations'
+
+
+def list_migrations(path=migrations_dir):
+    found = []
+    for file_name in sorted(os.listdir(path)):
+        match = re.fullmatch(r'(\d+)_(\w+)\.(sql|py)', file_name)
+        if match:
+            found.append((int(match.group(1)), match.group(2), os.path.join(path, file_name)))
+
+    versions = [version for version, _, _ in found]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f'Duplicate migration versions in {path}')
+
+    return found
+
+
+# executescript() commits on its own, so scripts are split and run statement by statement instead
+def split_statements(script):
+    buffer = ''
+    for line in script.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            if buffer.strip():
+                yield buffer
+            buffer = ''
+
+    leftover = '\n'.join(line for line in buffer.splitlines() if not line.strip().startswith('--')).strip()
+    if leftover:
+        raise ValueError(f'Incomplete SQL statement: {leftover[:80]}')
+
+
+def current_version(db_conn):
+    db_conn.execute(f'''CREATE TABLE IF NOT EXISTS {migrations_table} (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )''')
+    return db_conn.execute(f'SELECT COALESCE(MAX(version), 0) FROM {migrations_table}').fetchone()[0]
+
+
+def apply_migration(db_conn, path):
+    if path.endswith('.sql'):
+        with open(path, 'r') as sql_file:
+            for statement in split_statements(sql_file.read()):
+                db_conn.execute(statement)
+        return
+
+    spec = importlib.util.spec_from_file_location(f'migration_{os.path.basename(path)[:-3]}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.upgrade(db_conn)
+
+
+def upgrade(db_path=glvars.db_path, target=None):
+    db_conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    applied = []
+
+    try:
+        for version, name, path in list_migrations():
+            if target is not None and version > target:
+                break
+
+            db_conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Re-checked under the write lock so parallel workers never apply a migration twice
+                if version <= current_version(db_conn):
+                    db_conn.execute('ROLLBACK')
+                    continue
+
+                apply_migration(db_conn, path)
+                db_conn.execute(
+                    f'INSERT INTO {migrations_table} (version, name, applied_at) VALUES (?, ?, ?)',
+                    (version, name, datetime.datetime.now().strftime(glvars.format_code))
+                )
+                db_conn.execute('COMMIT')
+            except Exception:
+                db_conn.execute('ROLLBACK')
+                raise
+
+            applied.append(f'{version:04d}_{name}')
+
+        # The partial indexes are only picked over a sort when the planner has table statistics
+        has_stats = db_conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+        db_conn.execute('PRAGMA optimize' if has_stats else 'ANALYZE')
+    finally:
+        db_conn.close()
+
+    return applied
+
+
+if __name__ == '__main__':
+    applied = upgrade()
+    print(f"Applied migrations: {applied}" if applied else 'Database is up to date.')
@@ -1,4 +1,5 @@
-import datetime
+import json
+import time
 
 from flask.typing import ResponseClass
 
@@ -12,99 +13,219 @@ class OrderManager:
     def __init__(self, db_man):
         self.db_man = db_man
         self.tickets_man = None
+        self.blob_man = None
+        self.users_man = None
 
     def set_tickets_man(self, tickets_man):
         self.tickets_man = tickets_man
 
-    def add_tickets_to_cart(self, ticket_id, user_session, cart_session):
-        """Edit Ticket in DB"""
-        # Initialize ticket class
-        ticket_get = self.tickets_man.get_ticket(ticket_id)
-        if not ticket_get["success"]:
-            return glvars.ReturnMessage(False, ticket_get["message"]).send()
-        ticket = ticket_get["data"]
+    def set_blob_man(self, blob_man):
+        self.blob_man = blob_man
+
+    def set_users_man(self, users_man):
+        self.users_man = users_man
+
+    # The user's tickets changed, so their cached copy is out of date. Called after the commit.
+    def forget_user(self, *user_ids):
+        if self.users_man:
+            self.users_man.forget_user(*user_ids)
+
+    # The ticket columns are rewritten whole, so they are read again inside the write transaction
+    # (after its first UPDATE, so no other writer can get in between) instead of trusting the session
+    # or UserManager's cached copy, which another worker may have changed since.
+    def load_user_tickets(self, user, db_conn):
+        res = self.db_man.fetch_no_commit(
+            f"SELECT tickets_bought, tickets_ordered FROM {glvars.users_table} WHERE id = ?", (user.id,), db_conn
+        )
+        if not res["success"]:
+            return glvars.ReturnMessage(False, res["message"]).send()
+        if not res["rows"]:
+            return glvars.ReturnMessage(False, "User not found!").send()
+
+        bought, ordered = res["rows"][0]
+        user.tickets_bought = set(bought.split(";")) if bought else set()
+        user.tickets_ordered = set(ordered.split(";")) if ordered else set()
+        return glvars.ReturnMessage(True, "Loaded tickets").send()
 
+    def add_tickets_to_cart(self, ticket_id, user_session, cart_session):
         # Initialize user class
         user = User()
         user.import_from_dict(user_session)
 
-        """Update tickets in db"""
+        """Reserve the ticket, same transaction as the cart/user update"""
         db_conn = self.db_man.get_conn()
-        if not ticket.is_available():
-            # print('Ticket Data: ', ticket.to_dict())
-            return glvars.ReturnMessage(False, "Ticket already ordered!").send()
-        ticket.order(user.id)
-        response = self.db_man.edit_row(
-            glvars.tickets_table,
-            ("code",),
-            (ticket_id,),
-            ("status", "buyer_id", "expire_at"),
-            (ticket.status, ticket.buyer_id, ticket.expire_at),
-            db_conn,
-        )
-        if not response["success"]:
-            return glvars.ReturnMessage(False, response["message"]).send()
+        reserve_res = self.tickets_man.reserve_ticket(ticket_id, user.id, db_conn)
+        if not reserve_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, reserve_res["message"]).send()
+
+        tickets_res = self.load_user_tickets(user, db_conn)
+        if not tickets_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, tickets_res["message"]).send()
+
+        reclaim_res = self.reclaim_tickets((ticket_id,), db_conn)
+        if not reclaim_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, reclaim_res["message"]).send()
 
         """Edit Cart Session"""
         cart = Cart()
         cart.import_from_dict(cart_session)
+        persist_res = self.persist_cart(cart, db_conn)
+        if not persist_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, persist_res["message"]).send()
         cart = cart.add_item(ticket_id, user_dict=user_session)
         cart_dict = cart.to_dict()
 
+        item_res = self.db_man.add_rows(
+            glvars.order_items_table,
+            ("order_id", "ticket_code"),
+            ((cart.id, ticket_id),),
+            db_conn,
+            on_conflict="IGNORE",
+        )
+        if not item_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, item_res["message"]).send()
+
         """ Edit User Session """
         user.add_set_item("tickets_ordered", ticket_id)
         user_dict = user.to_dict()
 
-        self.save_to_db(user_dict, cart_dict, db_conn)
+        save_status = self.save_to_db(user_dict, cart_dict, db_conn)
+        if not save_status["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, save_status["message"]).send()
 
         commit_res = self.db_man.commit(db_conn)
         if not commit_res["success"]:
             self.db_man.rollback(db_conn)
             return glvars.ReturnMessage(False, commit_res["message"]).send()
 
+        self.tickets_man.index.discard(ticket_id)
+        self.forget_user(*reclaim_res["buyer_ids"])
+        self.tickets_man.track_expiry((ticket_id,), reserve_res["data"].expire_at)
+        self.forget_user(user.id)
+
         """Return the Data"""
         return glvars.ReturnData(
             True, "Added ticket!", cart=cart_dict, user=user_dict
         ).send()
 
-    def remove_tickets_from_cart(self, ticket_id, user_session, cart_session):
-        """Edit Ticket in DB"""
-        # Initialize ticket class
-        ticket_get = self.tickets_man.get_ticket(ticket_id)
-        if not ticket_get["success"]:
-            return glvars.ReturnMessage(False, ticket_get["message"]).send()
-        ticket = ticket_get["data"]
+    # Batch add_tickets_to_cart: every code is reserved by one UPDATE and the user/cart are saved
+    # once, all in one transaction. results maps each requested code to its outcome.
+    def add_many_to_cart(self, codes, user_session, cart_session):
+        user = User()
+        user.import_from_dict(user_session)
+
+        db_conn = self.db_man.get_conn()
+        reserve_res = self.tickets_man.reserve_tickets(codes, user.id, db_conn)
+        if not reserve_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, reserve_res["message"]).send()
+        reserved = reserve_res["reserved"]
+
+        tickets_res = self.load_user_tickets(user, db_conn)
+        if not tickets_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, tickets_res["message"]).send()
+
+        reclaim_res = self.reclaim_tickets(reserved, db_conn)
+        if not reclaim_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, reclaim_res["message"]).send()
+
+        results = {code: {"success": True, "message": "Added ticket!"} for code in reserved}
+        for code, message in reserve_res["failed"].items():
+            results[code] = {"success": False, "message": message}
+
+        if not reserved:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnData(
+                True, "No tickets added", added=0, results=results, cart=cart_session, user=user_session
+            ).send()
+
+        cart = Cart()
+        cart.import_from_dict(cart_session)
+        persist_res = self.persist_cart(cart, db_conn)
+        if not persist_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, persist_res["message"]).send()
+        cart = cart.add_item(*reserved, user_dict=user_session)
+        cart_dict = cart.to_dict()
+
+        item_res = self.db_man.add_rows(
+            glvars.order_items_table,
+            ("order_id", "ticket_code"),
+            ((cart.id, code) for code in reserved),
+            db_conn,
+            on_conflict="IGNORE",
+        )
+        if not item_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, item_res["message"]).send()
 
+        for code in reserved:
+            user.add_set_item("tickets_ordered", code)
+        user_dict = user.to_dict()
+
+        save_status = self.save_to_db(user_dict, cart_dict, db_conn)
+        if not save_status["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, save_status["message"]).send()
+
+        commit_res = self.db_man.commit(db_conn)
+        if not commit_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, commit_res["message"]).send()
+
+        self.tickets_man.index.discard(*reserved)
+        self.forget_user(*reclaim_res["buyer_ids"])
+        self.tickets_man.track_expiry(reserved, reserve_res["expire_at"])
+        self.forget_user(user.id)
+
+        return glvars.ReturnData(
+            True, f"Added {len(reserved)} tickets!", added=len(reserved), results=results, cart=cart_dict, user=user_dict
+        ).send()
+
+    def remove_tickets_from_cart(self, ticket_id, user_session, cart_session):
         # Initialize user class
         user = User()
         user.import_from_dict(user_session)
 
         """Update tickets in db"""
         db_conn = self.db_man.get_conn()
-        if ticket.is_available():
-            return glvars.ReturnMessage(False, "Ticket is available").send()
-        ticket.remove_order()
-        response = self.db_man.edit_row(
-            glvars.tickets_table,
-            ("code",),
-            (ticket_id,),
-            ("status", "buyer_id", "expire_at"),
-            (ticket.status, ticket.buyer_id, ticket.expire_at),
-            db_conn,
-        )
-        if not response["success"]:
-            return glvars.ReturnMessage(False, response["message"]).send()
+        release_res = self.tickets_man.release_tickets((ticket_id,), user.id, db_conn)
+        if not release_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, release_res["message"]).send()
+
+        tickets_res = self.load_user_tickets(user, db_conn)
+        if not tickets_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, tickets_res["message"]).send()
 
         """Edit Cart Session"""
         cart = Cart()
         cart.import_from_dict(cart_session)
+        if not release_res["released"] and ticket_id not in cart.items:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, "Ticket is not in your cart").send()
         cart.remove_item(ticket_id)
 
+        item_res = self.unlink_items(cart.id, (ticket_id,), db_conn)
+        if not item_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, item_res["message"]).send()
+
         # Edit User Session
         user.remove_set_item("tickets_ordered", ticket_id)
 
         save_status = self.save_to_db(user.to_dict(), cart.to_dict(), db_conn)
         if not save_status['success']:
+            self.db_man.rollback(db_conn)
             return glvars.ReturnMessage(False, save_status['message']).send()
 
         commit_res = self.db_man.commit(db_conn)
@@ -112,6 +233,9 @@ class OrderManager:
             self.db_man.rollback(db_conn)
             return glvars.ReturnMessage(False, commit_res["message"]).send()
 
+        self.tickets_man.index.add(*release_res["released"])
+        self.forget_user(user.id)
+
         """Return the Data"""
         return glvars.ReturnData(
             True, "Removed ticket!", cart=cart.to_dict(), user=user.to_dict()
@@ -124,25 +248,22 @@ class OrderManager:
         cart.import_from_dict(cart_session)
 
         db_conn = self.db_man.get_conn()
-        for item in cart.items:
-            ticket_get = self.tickets_man.get_ticket(item)
-            if not ticket_get["success"]:
-                return glvars.ReturnMessage(False, ticket_get["message"]).send()
-            ticket = ticket_get["data"]
-            ticket.remove_order()
-            response = self.db_man.edit_row(
-                glvars.tickets_table,
-                ("code",),
-                (ticket.code,),
-                ("status", "buyer_id", "expire_at"),
-                (ticket.status, ticket.buyer_id, ticket.expire_at),
-                db_conn,
-            )
-            if response["success"] == False:
-                return glvars.ReturnMessage(False, response["message"]).send()
+        release_res = self.tickets_man.release_tickets(cart.items, user.id, db_conn)
+        if not release_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, release_res["message"]).send()
 
-            user.remove_set_item("tickets_ordered", ticket.code)
-            cart.remove_item(ticket.code)
+        for item in list(cart.items):
+            user.remove_set_item("tickets_ordered", item)
+        cart.items.clear()
+        cart.items_len = 0
+
+        item_res = self.db_man.delete_rows(
+            glvars.order_items_table, "order_id", (cart.id,), db_conn
+        )
+        if not item_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, item_res["message"]).send()
 
         commit_res = self.db_man.commit(db_conn)
         if not commit_res["success"]:
@@ -151,11 +272,14 @@ class OrderManager:
                 False, f"Could not commit: {commit_res['message']}"
             ).send()
 
+        self.tickets_man.index.add(*release_res["released"])
+
         return glvars.ReturnData(
             True, "Removed Successfully", cart=cart.to_dict(), user=user.to_dict()
         ).send()
 
-    def confirm_bought(self, img_data, user_session, cart_session):
+    # image is the payment screenshot as spooled by BlobManager.spool_upload
+    def confirm_bought(self, image, user_session, cart_session):
         user = User()
         user.import_from_dict(user_session)
         cart = Cart()
@@ -164,138 +288,576 @@ class OrderManager:
         if not cart.items:
             return glvars.ReturnMessage(False, "No tickets in cart!").send()
 
-        cart.img_link = img_data
-
         db_conn = self.db_man.get_conn()
 
-        for item in cart.items:
-            ticket_get = self.tickets_man.get_ticket(item)
-            if not ticket_get["success"]:
-                return glvars.ReturnMessage(False, ticket_get["message"]).send()
-            ticket = ticket_get["data"]
+        """One UPDATE for every ticket in the cart"""
+        purchase_res = self.tickets_man.purchase_tickets(cart.items, user.id, user.name, db_conn)
+        if not purchase_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, purchase_res["message"]).send()
+        bought = purchase_res["bought"]
+
+        tickets_res = self.load_user_tickets(user, db_conn)
+        if not tickets_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, tickets_res["message"]).send()
 
-            ticket.purchase()
-            ticket.add_note(user.name)
+        results = [{"code": code, "success": True, "message": "Bought ticket!"} for code in bought]
+        results += [{"code": code, "success": False, "message": message} for code, message in purchase_res["failed"].items()]
 
-            response = self.tickets_man.edit_ticket(
-                ticket.code,
-                ["status", "buyer_id", "expire_at", "note_for"],
-                [ticket.status, ticket.buyer_id, ticket.expire_at, ticket.note_for],
-                db_conn,
-            )
+        if not bought:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnData(False, "None of the tickets in the cart are reserved anymore!", results=results).send()
 
-            if response["success"] == False:
-                return glvars.ReturnMessage(False, response["message"]).send()
+        # Tickets that lapsed before checkout are dropped from the order instead of failing it
+        lapsed = list(purchase_res["failed"].keys())
+        if lapsed:
+            unlink_res = self.unlink_items(cart.id, lapsed, db_conn)
+            if not unlink_res["success"]:
+                self.db_man.rollback(db_conn)
+                return glvars.ReturnMessage(False, unlink_res["message"]).send()
+            cart.items.difference_update(lapsed)
+            cart.items_len = len(cart.items)
+
+        for code in cart.items:
+            user.remove_set_item("tickets_ordered", code)
+            user.add_set_item("tickets_bought", code)
+        for code in lapsed:
+            user.remove_set_item("tickets_ordered", code)
+        user_dict = user.to_dict()
 
-            user.remove_set_item("tickets_ordered", ticket.code)
-            user.add_set_item("tickets_bought", ticket.code)
-        # self.db_man.commit(db_conn)
+        """The image goes to the blob store once, the order row only keeps its hash"""
+        blob_res = self.blob_man.put_upload(image, db_conn)
+        if not blob_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, blob_res["message"]).send()
 
+        cart.img_link = blob_res["hash"]
         cart.turn_to_order()
-        order_id = cart.id
-        # SAVE TO DB
-        if not self.save_to_db(user_session, cart.to_dict(), db_conn)["success"]:
+        cart_dict = cart.to_dict()
+        order_res = self.db_man.exec_no_commit(
+            f"UPDATE {glvars.orders_table} SET amount_bought = ?, img_link = ?, is_in_cart = 0 WHERE id = ? AND is_in_cart = 1",
+            (cart_dict["amount_bought"], cart_dict["img_link"], cart.id),
+            db_conn,
+        )
+        if not order_res["success"] or order_res["rows_affected"] != 1:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, "Cart already in orders").send()
+
+        user_res = self.db_man.edit_row(
+            glvars.users_table,
+            ("id",),
+            (user.id,),
+            ("tickets_bought", "tickets_ordered"),
+            (user_dict["tickets_bought"], user_dict["tickets_ordered"]),
+            db_conn,
+        )
+        if not user_res["success"]:
             self.db_man.rollback(db_conn)
             return glvars.ReturnMessage(False, "Could not save to DB.").send()
-        
-        self.db_man.commit(db_conn)
+
+        commit_res = self.db_man.commit(db_conn)
+        if not commit_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, commit_res["message"]).send()
+
+        self.tickets_man.track_expiry(bought, purchase_res["expire_at"])
+        self.forget_user(user.id)
 
         return glvars.ReturnData(
             True,
             "Tickets in cart bought.",
             cart=None,
-            user=user.to_dict(),
-            order_id=order_id,
+            user=user_dict,
+            order_id=cart.id,
+            results=results,
         ).send()
 
     def confirm_cart(self, order_id):
-        order = Cart()
-        order_res_query = f"SELECT * FROM {glvars.orders_table} WHERE id = ?"
-        order_res = self.db_man.execute_query(order_res_query, (order_id,))
-        order.import_from_db(order_res[0])
+        res = self.confirm_orders([order_id])
+        if not res["success"]:
+            return glvars.ReturnMessage(False, res["message"]).send()
+
+        outcome = next(iter(res["results"].values()))
+        return glvars.ReturnMessage(outcome["success"], outcome["message"]).send()
 
+    def cancel_cart(self, order_id):
+        res = self.cancel_orders([order_id])
+        if not res["success"]:
+            return glvars.ReturnMessage(False, res["message"]).send()
+
+        outcome = next(iter(res["results"].values()))
+        return glvars.ReturnMessage(outcome["success"], outcome["message"]).send()
+
+    # Batch confirm: every order and every one of their tickets is updated by one statement each,
+    # in one transaction. results maps each order id to its outcome.
+    def confirm_orders(self, order_ids):
+        start = time.perf_counter()
+        ids, results = self.parse_order_ids(order_ids)
+        if not ids:
+            return glvars.ReturnData(False, "No valid order ids!", results=results).send()
+        ids_json = json.dumps(ids)
+
+        # The state check is part of the UPDATE, so an order cancelled or confirmed by someone else
+        # in the meantime is never reported as confirmed here. Carts (still being filled) are left alone.
         db_conn = self.db_man.get_conn()
-        for item in order.items:
-            # print('Ticket Code: ', item)
-            ticket_get = self.tickets_man.get_ticket(item)
-            if not ticket_get["success"]:
-                return glvars.ReturnMessage(False, ticket_get["message"]).send()
-            ticket = ticket_get["data"]
-
-            ticket.confirm()
-            # print('This is a ticket: ', ticket.to_dict())
-            response = self.db_man.edit_row(
-                glvars.tickets_table,
-                ("code",),
-                (ticket.code,),
-                ("status", "expire_at"),
-                (ticket.status, ticket.expire_at),
+        order_res = self.db_man.fetch_no_commit(
+            f"UPDATE {glvars.orders_table} SET confirmed = 1 WHERE id IN (SELECT value FROM json_each(?)) "
+            f"AND is_in_cart = 0 AND confirmed = 0 RETURNING id",
+            (ids_json,),
+            db_conn,
+        )
+        if not order_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, order_res["message"]).send()
+        confirmed = {row[0] for row in order_res["rows"]}
+        ready = [i for i in ids if i in confirmed]
+
+        # Why the rest were skipped, read inside the same (now write-locked) transaction
+        skipped = [i for i in ids if i not in confirmed]
+        if skipped:
+            state_res = self.db_man.fetch_no_commit(
+                f"SELECT id, is_in_cart FROM {glvars.orders_table} WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(skipped),),
                 db_conn,
             )
-
-            if response["success"] == False:
-                return glvars.ReturnMessage(False, response["message"]).send()
-
-        cart_edit = self.db_man.edit_row(
-            glvars.orders_table, ("id",), (order_id,), ("confirmed",),
-              (1,), db_conn
-        )
-        if cart_edit["success"] == False:
-            return glvars.ReturnMessage(False, cart_edit["message"]).send()
+            if not state_res["success"]:
+                self.db_man.rollback(db_conn)
+                return glvars.ReturnMessage(False, state_res["message"]).send()
+            states = {row[0]: row[1] for row in state_res["rows"]}
+            for order_id in skipped:
+                if order_id not in states:
+                    results[str(order_id)] = {"success": False, "message": "Order not found!"}
+                elif states[order_id]:
+                    results[str(order_id)] = {"success": False, "message": "Order is still a cart!"}
+                else:
+                    results[str(order_id)] = {"success": False, "message": "Order already confirmed!"}
+
+        ticket_rows = []
+        if ready:
+            ticket_res = self.db_man.fetch_no_commit(
+                f"UPDATE {glvars.tickets_table} SET status = ?, expire_at = NULL WHERE status = ? AND code IN "
+                f"(SELECT ticket_code FROM {glvars.order_items_table} WHERE order_id IN (SELECT value FROM json_each(?))) RETURNING code",
+                (glvars.status_confirmed, glvars.status_processing, json.dumps(ready)),
+                db_conn,
+            )
+            if not ticket_res["success"]:
+                self.db_man.rollback(db_conn)
+                return glvars.ReturnMessage(False, ticket_res["message"]).send()
+            ticket_rows = ticket_res["rows"]
 
         commit_res = self.db_man.commit(db_conn)
         if not commit_res["success"]:
             self.db_man.rollback(db_conn)
             return glvars.ReturnMessage(False, commit_res["message"]).send()
 
-        return glvars.ReturnMessage(True, "Order confirmed to be bought!").send()
+        self.tickets_man.index.forget(*(row[0] for row in ticket_rows))
 
-    def cancel_cart(self, order_id):
-        order = Cart()
-        order_res_query = f"SELECT * FROM {glvars.orders_table} WHERE id = ?"
-        order_res = self.db_man.execute_query(order_res_query, (order_id,))
-        order.import_from_db(order_res[0])
+        for order_id in ready:
+            results[str(order_id)] = {"success": True, "message": "Order confirmed to be bought!"}
 
-        db_conn = self.db_man.get_conn()
+        elapsed = time.perf_counter() - start
+        return glvars.ReturnData(
+            True,
+            f"Confirmed {len(ready)} of {len(results)} orders",
+            confirmed=len(ready),
+            results=results,
+            elapsed_ms=round(elapsed * 1000, 2),
+            orders_per_sec=round(len(ready) / elapsed, 1) if elapsed else None,
+        ).send()
 
-        for item in order.items:
-            ticket_get = self.tickets_man.get_ticket(item)
-            if not ticket_get["success"]:
-                return glvars.ReturnMessage(False, ticket_get["message"]).send()
-            ticket = ticket_get["data"]
-
-            ticket.reset()
-            response = self.db_man.edit_row(
-                glvars.tickets_table,
-                ("code",),
-                (ticket.code,),
-                ("status", "expire_at", "buyer_id", "note_for"),
-                (ticket.status, ticket.expire_at, ticket.buyer_id, ticket.note_for),
-                db_conn
-            )
-            if not response["success"]:
-                return glvars.ReturnMessage(
-                    False, "Something went wrong editing to reset in the database."
-                ).send()
+    # Batch cancel: the orders' tickets go back on sale, then the orders and their items are deleted.
+    def cancel_orders(self, order_ids):
+        start = time.perf_counter()
+        ids, results = self.parse_order_ids(order_ids)
+        if not ids:
+            return glvars.ReturnData(False, "No valid order ids!", results=results).send()
+        ids_json = json.dumps(ids)
+
+        db_conn = self.db_man.get_conn()
+        ticket_res = self.db_man.fetch_no_commit(
+            f"UPDATE {glvars.tickets_table} SET status = ?, expire_at = NULL, buyer_id = NULL, note_for = '' WHERE code IN "
+            f"(SELECT ticket_code FROM {glvars.order_items_table} WHERE order_id IN (SELECT value FROM json_each(?))) RETURNING code",
+            (glvars.status_available, ids_json),
+            db_conn,
+        )
+        if not ticket_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, ticket_res["message"]).send()
+        released = [row[0] for row in ticket_res["rows"]]
 
-        order_del = self.db_man.delete_row(
-            glvars.orders_table, "id", str(order.id), db_conn
+        item_res = self.db_man.exec_no_commit(
+            f"DELETE FROM {glvars.order_items_table} WHERE order_id IN (SELECT value FROM json_each(?))",
+            (ids_json,),
+            db_conn,
         )
+        if not item_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, item_res["message"]).send()
 
-        if not order_del["success"]:
+        order_res = self.db_man.fetch_no_commit(
+            f"DELETE FROM {glvars.orders_table} WHERE id IN (SELECT value FROM json_each(?)) RETURNING id",
+            (ids_json,),
+            db_conn,
+        )
+        if not order_res["success"]:
             self.db_man.rollback(db_conn)
-            return glvars.ReturnMessage(
-                False, f"Could not cancel the order: {order_del['message']}"
-            ).send()
+            return glvars.ReturnMessage(False, f"Could not cancel the orders: {order_res['message']}").send()
+        cancelled = {row[0] for row in order_res["rows"]}
 
         commit_res = self.db_man.commit(db_conn)
         if not commit_res["success"]:
             self.db_man.rollback(db_conn)
-            return glvars.ReturnMessage(
-                False, f"Could not cancel the order: {commit_res['message']}"
-            ).send()
+            return glvars.ReturnMessage(False, f"Could not cancel the orders: {commit_res['message']}").send()
+
+        self.tickets_man.index.add(*released)
+
+        for order_id in ids:
+            if order_id in cancelled:
+                results[str(order_id)] = {"success": True, "message": "Order cancelled!"}
+            else:
+                results[str(order_id)] = {"success": False, "message": "Order not found!"}
 
-        return glvars.ReturnMessage(True, "Order cancelled!").send()
+        elapsed = time.perf_counter() - start
+        return glvars.ReturnData(
+            True,
+            f"Cancelled {len(cancelled)} of {len(results)} orders",
+            cancelled=len(cancelled),
+            released=len(released),
+            results=results,
+            elapsed_ms=round(elapsed * 1000, 2),
+            orders_per_sec=round(len(cancelled) / elapsed, 1) if elapsed else None,
+        ).send()
+
+    # Expiry sweep: lapsed ordered/processing tickets go back on sale, chunk_size per transaction.
+    # The inner SELECT walks idx_tickets_expire_at, so each chunk only touches the rows it releases.
+    # codes narrows the sweep to those tickets (the expiry scheduler); they are still only released if lapsed.
+    def release_expired(self, chunk_size=glvars.prune_chunk_size, pause=glvars.prune_chunk_pause, log=print, codes=None):
+        now = glvars.now_epoch()
+        totals = {"released": 0, "orders_deleted": 0, "orders_updated": 0, "chunks": 0}
+
+        where = "expire_at <= ? AND status IN (?, ?)"
+        params = [now, glvars.status_ordered, glvars.status_processing]
+        if codes is not None:
+            where += " AND code IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(list(codes)))
+
+        # One connection for the whole sweep. prune_tickets.py runs outside a request, where nothing
+        # would give a connection back, so an owned one is released here.
+        db_conn, owned = self.db_man.borrow_conn()
+        try:
+            while True:
+                start = time.perf_counter()
+                ticket_res = self.db_man.fetch_no_commit(
+                    f"UPDATE {glvars.tickets_table} SET status = ?, expire_at = NULL, buyer_id = NULL, note_for = '' WHERE code IN "
+                    f"(SELECT code FROM {glvars.tickets_table} WHERE {where} LIMIT ?) RETURNING code",
+                    (glvars.status_available, *params, chunk_size),
+                    db_conn,
+                )
+                if not ticket_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, ticket_res["message"], **totals).send()
+
+                released = [row[0] for row in ticket_res["rows"]]
+                if not released:
+                    self.db_man.rollback(db_conn)
+                    break
+
+                detach_res = self.detach_tickets(released, db_conn)
+                if not detach_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, detach_res["message"], **totals).send()
+
+                commit_res = self.db_man.commit(db_conn)
+                if not commit_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, commit_res["message"], **totals).send()
+
+                self.tickets_man.index.add(*released)
+                self.forget_user(*detach_res["buyer_ids"])
+                totals["released"] += len(released)
+                totals["orders_deleted"] += detach_res["orders_deleted"]
+                totals["orders_updated"] += detach_res["orders_updated"]
+                totals["chunks"] += 1
+                log(
+                    f"CHUNK {totals['chunks']}: released {len(released)} tickets, deleted {detach_res['orders_deleted']} orders, "
+                    f"updated {detach_res['orders_updated']} orders in {(time.perf_counter() - start) * 1000:.1f}ms"
+                )
+
+                if len(released) < chunk_size:
+                    break
+                time.sleep(pause)
+        finally:
+            if owned:
+                self.db_man.release_conn(db_conn)
+
+        return glvars.ReturnData(True, f"Released {totals['released']} expired tickets", **totals).send()
+
+    # Cart cleanup: carts untouched since ttl_hours ago are deleted, chunk_size orders per transaction, and the
+    # tickets they still hold go back on sale. Submitted orders left without any tickets (ghost orders) go too.
+    def prune_carts(self, ttl_hours=glvars.cart_ttl_hours, chunk_size=glvars.prune_chunk_size, pause=glvars.prune_chunk_pause, log=print):
+        cutoff = glvars.now_epoch() - int(ttl_hours * 3600)
+        totals = {"carts_deleted": 0, "empty_carts": 0, "ghost_orders_deleted": 0, "released": 0, "chunks": 0}
+
+        # Same connection handling as release_expired
+        db_conn, owned = self.db_man.borrow_conn()
+        try:
+            while True:
+                start = time.perf_counter()
+                order_res = self.db_man.fetch_no_commit(
+                    f"DELETE FROM {glvars.orders_table} WHERE id IN ("
+                    f"SELECT id FROM {glvars.orders_table} WHERE is_in_cart = 1 AND updated_at <= ? UNION ALL "
+                    f"SELECT id FROM {glvars.orders_table} o WHERE is_in_cart = 0 AND NOT EXISTS (SELECT 1 FROM {glvars.order_items_table} i WHERE i.order_id = o.id) "
+                    f"LIMIT ?) RETURNING id, is_in_cart",
+                    (cutoff, chunk_size),
+                    db_conn,
+                )
+                if not order_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, order_res["message"], **totals).send()
+
+                deleted = order_res["rows"]
+                if not deleted:
+                    self.db_man.rollback(db_conn)
+                    break
+                cart_ids = [row[0] for row in deleted if row[1]]
+
+                item_res = self.db_man.fetch_no_commit(
+                    f"DELETE FROM {glvars.order_items_table} WHERE order_id IN (SELECT value FROM json_each(?)) RETURNING order_id, ticket_code",
+                    (json.dumps(cart_ids),),
+                    db_conn,
+                )
+                if not item_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, item_res["message"], **totals).send()
+
+                ticket_res = self.db_man.fetch_no_commit(
+                    f"UPDATE {glvars.tickets_table} SET status = ?, expire_at = NULL, buyer_id = NULL, note_for = '' "
+                    f"WHERE code IN (SELECT value FROM json_each(?)) AND status = ? RETURNING code",
+                    (glvars.status_available, json.dumps([row[1] for row in item_res["rows"]]), glvars.status_ordered),
+                    db_conn,
+                )
+                if not ticket_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, ticket_res["message"], **totals).send()
+
+                commit_res = self.db_man.commit(db_conn)
+                if not commit_res["success"]:
+                    self.db_man.rollback(db_conn)
+                    return glvars.ReturnData(False, commit_res["message"], **totals).send()
+
+                released = [row[0] for row in ticket_res["rows"]]
+                self.tickets_man.index.add(*released)
+                empty_carts = len(set(cart_ids) - {row[0] for row in item_res["rows"]})
+                totals["carts_deleted"] += len(cart_ids)
+                totals["empty_carts"] += empty_carts
+                totals["ghost_orders_deleted"] += len(deleted) - len(cart_ids)
+                totals["released"] += len(released)
+                totals["chunks"] += 1
+                log(
+                    f"CHUNK {totals['chunks']}: deleted {len(cart_ids)} carts ({empty_carts} empty) and {len(deleted) - len(cart_ids)} ghost orders, "
+                    f"released {len(released)} tickets in {(time.perf_counter() - start) * 1000:.1f}ms"
+                )
+
+                if len(deleted) < chunk_size:
+                    break
+                time.sleep(pause)
+        finally:
+            if owned:
+                self.db_man.release_conn(db_conn)
+
+        return glvars.ReturnData(
+            True, f"Deleted {totals['carts_deleted']} stale carts and {totals['ghost_orders_deleted']} ghost orders", **totals
+        ).send()
+
+    # Lazy expiry lets a reservation take over a lapsed hold, so the previous holder's order_items
+    # rows for those codes are dropped. Their emptied orders are left for the cart cleanup (prune_carts).
+    def reclaim_tickets(self, ticket_codes, db_conn):
+        if not glvars.lazy_expiry or not ticket_codes:
+            return glvars.ReturnData(True, "Nothing to reclaim", buyer_ids=[]).send()
+
+        return self.detach_tickets(ticket_codes, db_conn, drop_empty=False)
+
+    # Takes codes out of whatever orders hold them: orders left empty are deleted, the rest recounted.
+    # The codes also leave their previous buyers' ticket columns; buyer_ids lists those users, whose
+    # cached copies the caller drops (forget_user) once the transaction is committed.
+    def detach_tickets(self, ticket_codes, db_conn, drop_empty=True):
+        item_res = self.db_man.fetch_no_commit(
+            f"DELETE FROM {glvars.order_items_table} WHERE ticket_code IN (SELECT value FROM json_each(?)) RETURNING order_id, ticket_code",
+            (json.dumps(list(ticket_codes)),),
+            db_conn,
+        )
+        if not item_res["success"]:
+            return glvars.ReturnMessage(False, item_res["message"]).send()
+        order_ids = json.dumps(sorted({row[0] for row in item_res["rows"]}))
+
+        buyers_res = self.unlink_buyers(item_res["rows"], db_conn)
+        if not buyers_res["success"]:
+            return glvars.ReturnMessage(False, buyers_res["message"]).send()
+
+        delete_res = {"success": True, "rows_affected": 0}
+        if drop_empty:
+            delete_res = self.db_man.exec_no_commit(
+                f"DELETE FROM {glvars.orders_table} WHERE id IN (SELECT value FROM json_each(?)) "
+                f"AND NOT EXISTS (SELECT 1 FROM {glvars.order_items_table} i WHERE i.order_id = {glvars.orders_table}.id)",
+                (order_ids,),
+                db_conn,
+            )
+        if not delete_res["success"]:
+            return glvars.ReturnMessage(False, delete_res["message"]).send()
+
+        update_res = self.db_man.exec_no_commit(
+            f"UPDATE {glvars.orders_table} SET amount_bought = (SELECT COUNT(*) FROM {glvars.order_items_table} i WHERE i.order_id = {glvars.orders_table}.id) "
+            f"WHERE id IN (SELECT value FROM json_each(?))",
+            (order_ids,),
+            db_conn,
+        )
+        if not update_res["success"]:
+            return glvars.ReturnMessage(False, update_res["message"]).send()
+
+        return glvars.ReturnData(
+            True,
+            "Detached tickets",
+            orders_deleted=delete_res["rows_affected"],
+            orders_updated=update_res["rows_affected"],
+            buyer_ids=buyers_res["buyer_ids"],
+        ).send()
+
+    # items are the (order_id, ticket_code) rows detach_tickets took out. Each order's buyer loses those codes
+    # from tickets_ordered/tickets_bought, rewritten from the row as it is inside this transaction.
+    def unlink_buyers(self, items, db_conn):
+        if not items:
+            return glvars.ReturnData(True, "No buyers to update", buyer_ids=[]).send()
+
+        codes_by_order = {}
+        for order_id, code in items:
+            codes_by_order.setdefault(order_id, set()).add(str(code))
+
+        user_res = self.db_man.fetch_no_commit(
+            f"SELECT o.id, u.id, u.tickets_bought, u.tickets_ordered FROM {glvars.orders_table} o "
+            f"JOIN {glvars.users_table} u ON u.id = o.buyer_id WHERE o.id IN (SELECT value FROM json_each(?))",
+            (json.dumps(sorted(codes_by_order)),),
+            db_conn,
+        )
+        if not user_res["success"]:
+            return glvars.ReturnMessage(False, user_res["message"]).send()
+
+        users = {}
+        for order_id, user_id, bought, ordered in user_res["rows"]:
+            user = users.get(user_id)
+            if user is None:
+                user = users[user_id] = User(user_id)
+                user.tickets_bought = set(bought.split(";")) if bought else set()
+                user.tickets_ordered = set(ordered.split(";")) if ordered else set()
+            user.tickets_bought -= codes_by_order[order_id]
+            user.tickets_ordered -= codes_by_order[order_id]
+
+        edit_res = self.db_man.edit_rows(
+            glvars.users_table,
+            ("id",),
+            ("tickets_bought", "tickets_ordered"),
+            ((";".join(user.tickets_bought), ";".join(user.tickets_ordered), user.id) for user in users.values()),
+            db_conn,
+        )
+        if not edit_res["success"]:
+            return glvars.ReturnMessage(False, edit_res["message"]).send()
+
+        return glvars.ReturnData(True, "Updated buyers", buyer_ids=sorted(users)).send()
+
+    # Order ids arrive as JSON numbers or strings. Returns (unique int ids, results for the unusable ones).
+    def parse_order_ids(self, order_ids):
+        ids = []
+        results = {}
+        for order_id in order_ids or ():
+            try:
+                ids.append(int(order_id))
+            except (TypeError, ValueError):
+                results[str(order_id)] = {"success": False, "message": "Invalid order id!"}
+
+        return list(dict.fromkeys(ids)), results
+
+    def get_orders(self, limit=15, offset=0, q=None, search_for=None, cursor=None, processing_only=False):
+        columns = f"o.id, u.id, u.name, (SELECT group_concat(i.ticket_code, ';') FROM {glvars.order_items_table} i WHERE i.order_id = o.id), CASE WHEN o.is_in_cart = 1 THEN 'ordered' WHEN o.confirmed = 0 THEN 'processing' WHEN o.confirmed = 1 THEN 'confirmed' END AS status, o.id"
+        select = f"SELECT {columns} FROM {glvars.orders_table} o JOIN {glvars.users_table} u ON o.buyer_id = u.id"
+        where = []
+        params = []
+
+        if processing_only:
+            where.append("o.confirmed = 0 AND o.is_in_cart = 0")
+        if q and search_for:
+            if not glvars.is_column_name(search_for):
+                return glvars.ReturnMessage(False, "Invalid search type!").send()
+
+            # Buyer searches are ranked through the users full-text index
+            fts_column = glvars.fts_column(search_for, glvars.users_fts_columns)
+            if fts_column and search_for.split(".")[0] != "o" and len(str(q)) >= glvars.fts_min_length:
+                query = f"SELECT {columns} FROM {glvars.users_fts_table} JOIN {glvars.orders_table} o ON o.buyer_id = {glvars.users_fts_table}.rowid JOIN {glvars.users_table} u ON o.buyer_id = u.id WHERE {' AND '.join(where + [f'{glvars.users_fts_table} MATCH ?'])} ORDER BY {glvars.users_fts_table}.rank, o.id"
+                res = self.db_man.execute_ranked_page(
+                    query, (glvars.fts_match(fts_column, q),), limit=limit, cursor=cursor, offset=offset
+                )
+                if not res["success"]:
+                    return glvars.ReturnMessage(False, res["message"]).send()
+
+                return glvars.ReturnData(
+                    True,
+                    "Here's the orders!",
+                    data=res["data"],
+                    next_cursor=res["next_cursor"],
+                    prev_cursor=res["prev_cursor"],
+                ).send()
+
+            where.append(f"{search_for} LIKE ?")
+            params.append(f"%{q}%")
+
+        res = self.db_man.execute_page(
+            select, "o.id", where=where, params=params, limit=limit, cursor=cursor, offset=offset
+        )
+        if not res["success"]:
+            return glvars.ReturnMessage(False, res["message"]).send()
+
+        return glvars.ReturnData(
+            True,
+            "Here's the orders!",
+            data=res["data"],
+            next_cursor=res["next_cursor"],
+            prev_cursor=res["prev_cursor"],
+        ).send()
+
+    def get_order(self, order_id):
+        query = f"SELECT id, buyer_id, amount_bought, tickets_bought, img_link, is_in_cart FROM {glvars.orders_table} WHERE id = ?"
+        order_res = self.db_man.execute_query(query, (order_id,))
+        if not isinstance(order_res, list) or not order_res:
+            return glvars.ReturnMessage(False, "Order not found!").send()
+
+        items_query = f"SELECT ticket_code FROM {glvars.order_items_table} WHERE order_id = ?"
+        items_res = self.db_man.execute_query(items_query, (order_id,))
+        if not isinstance(items_res, list):
+            return glvars.ReturnMessage(False, "Could not load the order's tickets!").send()
+
+        order = Cart()
+        order.import_from_db(order_res[0], items=[row[0] for row in items_res])
+        return glvars.ReturnData(True, "Order found!", data=order).send()
+
+    # The full cart dict behind a slim session's cart id. An unsaved cart, or one that is gone or not
+    # the user's, comes back as a new empty cart like create_cart's.
+    def load_session_cart(self, cart_id, user_id):
+        cart = Cart(0, user_id)
+        if cart_id:
+            order_res = self.get_order(cart_id)
+            if order_res["success"] and order_res["data"].user_id == user_id:
+                cart = order_res["data"]
+                cart.is_in_cart = bool(cart.is_in_cart)
+                cart.img_link = cart.img_link or ""
+
+        return glvars.ReturnData(True, "Loaded cart", cart=cart.to_dict()).send()
+
+    def unlink_items(self, order_id, ticket_codes, db_conn):
+        return self.db_man.delete_rows(
+            glvars.order_items_table,
+            ("order_id", "ticket_code"),
+            ((order_id, code) for code in ticket_codes),
+            db_conn,
+        )
 
     def save_to_db(self, user_session, cart_session, given_db_conn=None):
         # Save User
@@ -317,7 +879,7 @@ class OrderManager:
         if response["success"] == False:
             return glvars.ReturnMessage(False, response["message"]).send()
 
-        # Save Cart
+        # Save Cart. img_link is only ever written at checkout (confirm_bought)
         cart = Cart()
         cart.import_from_dict(cart_session)
         cart_dict = cart.to_dict()
@@ -326,13 +888,12 @@ class OrderManager:
             glvars.orders_table,
             ("id",),
             (cart.id,),
-            ("buyer_id", "amount_bought", "tickets_bought", "img_link", "is_in_cart"),
+            ("buyer_id", "amount_bought", "is_in_cart", "updated_at"),
             (
                 cart_dict["buyer_id"],
                 cart_dict["amount_bought"],
-                cart_dict["tickets_bought"],
-                cart_dict["img_link"],
                 cart_dict["is_in_cart"],
+                glvars.now_epoch(),
             ),
             db_conn,
         )
@@ -345,48 +906,41 @@ class OrderManager:
             if not commit_res["success"]:
                 self.db_man.rollback(db_conn)
                 return glvars.ReturnMessage(False, commit_res["message"]).send()
+            self.forget_user(user.id)
 
         return glvars.ReturnMessage(True, "Successfully saved to the database").send()
 
+    # The cart only gets an orders row once a ticket goes in (see persist_cart), so opening /cart/ writes nothing
     def create_cart(self, user_session):
         user = User()
         user.import_from_dict(user_session)
 
-        db_conn = self.db_man.get_conn()
-        response = self.db_man.add_row(
-            glvars.orders_table, ("buyer_id",), (user.id,), db_conn
-        )
-        print(f"CREATE CART: {response}")
+        cart = Cart(0, user.id)
+        return glvars.ReturnData(True, "Created new cart", cart=cart.to_dict()).send()
 
-        commit_res = self.db_man.commit(db_conn)
-        if not commit_res["success"]:
-            self.db_man.rollback(db_conn)
-            return glvars.ReturnMessage(
-                False, f"Could not commit data: {commit_res['message']}"
-            ).send()
-        if not response["success"]:
-            self.db_man.rollback(db_conn)
-            return glvars.ReturnMessage(
-                False, f"Something went wrong: {response['message']}"
+    # Gives a session cart its orders row, inside the caller's transaction. A cart whose row was
+    # cleaned up in the meantime starts over in a new row; its tickets were released with the old one.
+    def persist_cart(self, cart, db_conn):
+        if cart.id:
+            row_res = self.db_man.fetch_no_commit(
+                f"SELECT 1 FROM {glvars.orders_table} WHERE id = ? AND is_in_cart = 1", (cart.id,), db_conn
             )
+            if not row_res["success"]:
+                return glvars.ReturnMessage(False, row_res["message"]).send()
+            if row_res["rows"]:
+                return glvars.ReturnMessage(True, "Cart already saved").send()
 
-        cart = Cart(response["id_affected"], user.id)
+            cart.items.clear()
+            cart.items_len = 0
 
-        query = f"SELECT id, buyer_id, amount_bought, tickets_bought, img_link, is_in_cart FROM {glvars.orders_table} WHERE id = ?"
-        response = self.db_man.execute_query(query, (cart.id,))
-        print("SUPPOSED PARAM", (cart.id,))
-        print(
-            "TYPE_PARAM",
-            type(
-                cart.id,
-            ),
+        response = self.db_man.add_row(
+            glvars.orders_table, ("buyer_id", "updated_at"), (cart.user_id, glvars.now_epoch()), db_conn
         )
-        print("RESPONSE:", response)
-        cart.import_from_db(response[0])
-
-        # print(response[0])
+        if not response["success"]:
+            return glvars.ReturnMessage(False, f"Something went wrong in making a cart: {response['message']}").send()
 
-        return glvars.ReturnData(True, "Created new cart", cart=cart.to_dict()).send()
+        cart.id = response["id_affected"]
+        return glvars.ReturnMessage(True, "Cart saved").send()
 
     def edit_note(self, note, ticket_code):
         ticket_get = self.tickets_man.get_ticket(ticket_code)
@@ -0,0 +1,120 @@
+import functions.global_vars as glvars
+import heapq
+import threading
+import time
+
+
+# Min-heap of (deadline, code) for every ticket that is waiting to expire. The worker sleeps until
+# the earliest deadline and releases whatever is due, so each event costs one heap push and one pop.
+# Entries are never removed early: when a ticket is bought or released first, its old entry fires
+# anyway and the release query (which re-checks expire_at and status) simply matches nothing.
+class ExpiryScheduler:
+    def __init__(self, app, order_man, retry_delay=glvars.expiry_retry_delay):
+        self.app = app
+        self.order_man = order_man
+        self.retry_delay = retry_delay
+
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._stats = {'scheduled': 0, 'fired': 0, 'released': 0, 'errors': 0, 'retried': 0}
+
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return glvars.ReturnMessage(False, 'Expiry scheduler already running').send()
+            self._running = True
+
+        loaded = self.load()
+        self._thread = threading.Thread(target=self.run, name='expiry-scheduler', daemon=True)
+        self._thread.start()
+        return glvars.ReturnMessage(True, f'Expiry scheduler started with {loaded} pending deadlines').send()
+
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+
+    # Pending deadlines at startup, including ones that already passed while the app was down
+    def load(self):
+        query = f'SELECT code, expire_at FROM {glvars.tickets_table} WHERE expire_at IS NOT NULL AND status IN (?, ?)'
+        rows = self.order_man.db_man.execute_query(query, (glvars.status_ordered, glvars.status_processing))
+        if not isinstance(rows, list):
+            print(f'EXPIRY SCHEDULER: could not load deadlines: {rows}')
+            return 0
+
+        entries = [(expire_at, code) for code, expire_at in rows]
+        with self._cond:
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+            self._stats['scheduled'] += len(entries)
+            self._cond.notify()
+        return len(entries)
+
+
+    # Called right after Ticket.order / Ticket.purchase set a new expire_at (epoch seconds)
+    def schedule(self, codes, deadline):
+        if deadline is None:
+            return
+
+        with self._cond:
+            if not self._running:
+                return
+            for code in codes:
+                heapq.heappush(self._heap, (deadline, str(code)))
+            self._stats['scheduled'] += len(codes)
+            # Only wake the worker if its current sleep would overshoot
+            if self._heap[0][0] == deadline:
+                self._cond.notify()
+
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._heap or self._heap[0][0] > time.time()):
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if not self._running:
+                    return
+
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[1])
+                self._stats['fired'] += len(due)
+
+            self.release(due)
+
+
+    # run() has already popped the codes, so a failed release puts them back to be tried again shortly
+    def release(self, codes):
+        try:
+            with self.app.app_context():
+                res = self.order_man.release_expired(pause=0, log=lambda message: None, codes=codes)
+        except Exception as e:
+            res = glvars.ReturnMessage(False, str(e)).send()
+
+        with self._cond:
+            if res['success']:
+                self._stats['released'] += res['released']
+            else:
+                self._stats['errors'] += 1
+                self._stats['retried'] += len(codes)
+                retry_at = time.time() + self.retry_delay
+                for code in codes:
+                    heapq.heappush(self._heap, (retry_at, code))
+                self._cond.notify()
+        if not res['success']:
+            print(f"EXPIRY SCHEDULER: release failed, retrying {len(codes)} codes in {self.retry_delay}s: {res['message']}")
+        elif res['released']:
+            print(f"EXPIRY SCHEDULER: {res['message']}")
+
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=len(self._heap), running=self._running)
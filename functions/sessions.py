@@ -0,0 +1,242 @@
+import functions.global_vars as glvars
+import atexit
+import threading
+from collections import OrderedDict
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from flask_session._utils import total_seconds
+
+# Server-side session stores for Flask-Session. Session data is serialized with Flask-Session's
+# msgspec serializer (msgpack) and kept either in the sessions table of the app database or in an
+# in-process LRU that writes behind to that table. SESSION_BACKEND picks one (see make_session_interface).
+
+
+class SQLiteSession(ServerSideSession):
+    pass
+
+
+# One row per session in the app database. Expired rows are ignored on read and deleted in bulk
+# through idx_sessions_expires_at, on average once every SESSION_CLEANUP_N_REQUESTS requests.
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    session_class = SQLiteSession
+    ttl = False
+
+    def __init__(self, app, db_man, cleanup_n_requests=glvars.session_cleanup_n_requests):
+        self.db_man = db_man
+        self.stats = {'reads': 0, 'misses': 0, 'writes': 0, 'deletes': 0, 'expired': 0}
+        super().__init__(
+            app,
+            key_prefix=app.config.get('SESSION_KEY_PREFIX', 'session:'),
+            permanent=app.config.get('SESSION_PERMANENT', True),
+            serialization_format='msgpack',
+            cleanup_n_requests=cleanup_n_requests,
+        )
+
+    # The session is loaded before the route runs and saved after routes.release_connection has given
+    # the route's connection back, so each runs on a checkout of its own that is released right away and
+    # the store never holds a pool slot next to the route's. If the request does still hold a connection
+    # it is reused rather than taking a second slot. This does not rely on the app releasing g._database.
+    def _run(self, query, params=()):
+        db_conn, owned = self.db_man.borrow_conn(attach=False)
+        try:
+            rows = db_conn.execute(query, params).fetchall()
+            db_conn.commit()
+            return rows
+        finally:
+            if owned:
+                self.db_man.release_conn(db_conn)
+
+    # (data, expires_at) or None
+    def load(self, store_id):
+        rows = self._run(
+            f'SELECT data, expires_at FROM {glvars.sessions_table} WHERE id = ? AND expires_at > ?',
+            (store_id, glvars.now_epoch())
+        )
+        return rows[0] if rows else None
+
+    def store(self, items):
+        self._run_many(
+            f'INSERT INTO {glvars.sessions_table} (id, data, expires_at) VALUES (?, ?, ?) '
+            f'ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at',
+            items,
+        )
+
+    def _run_many(self, query, rows):
+        db_conn, owned = self.db_man.borrow_conn(attach=False)
+        try:
+            db_conn.executemany(query, rows)
+            db_conn.commit()
+        finally:
+            if owned:
+                self.db_man.release_conn(db_conn)
+
+    def _retrieve_session_data(self, store_id):
+        self.stats['reads'] += 1
+        row = self.load(store_id)
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        return self.serializer.decode(row[0])
+
+    def _delete_session(self, store_id):
+        self.stats['deletes'] += 1
+        self._run(f'DELETE FROM {glvars.sessions_table} WHERE id = ?', (store_id,))
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        self.stats['writes'] += 1
+        expires_at = glvars.now_epoch() + int(total_seconds(session_lifetime))
+        self.store([(store_id, self.serializer.encode(session), expires_at)])
+
+    def _delete_expired_sessions(self):
+        deleted = self._run(
+            f'DELETE FROM {glvars.sessions_table} WHERE expires_at <= ? RETURNING id', (glvars.now_epoch(),)
+        )
+        self.stats['expired'] += len(deleted)
+        return len(deleted)
+
+    def session_stats(self):
+        return dict(self.stats, backend='sqlite')
+
+
+# Sessions live in an in-process LRU of encoded sessions; changes reach the sessions table at most
+# SESSION_FLUSH_INTERVAL seconds later (or when a dirty session is evicted). Misses fall through to the
+# table, so sessions survive restarts up to the last flush. Every worker process has its own LRU, so
+# this is meant for a single-process deployment.
+class MemorySessionInterface(SQLiteSessionInterface):
+    def __init__(self, app, db_man, max_entries=glvars.session_memory_max, flush_interval=glvars.session_flush_interval,
+                 cleanup_n_requests=glvars.session_cleanup_n_requests):
+        super().__init__(app, db_man, cleanup_n_requests)
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+
+        # store_id -> (encoded session or None if deleted, expires_at)
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.stats.update({'hits': 0, 'flushes': 0, 'flushed': 0, 'evicted': 0})
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    # The flush thread starts with the first write, so importing routes (prune job, forked hash workers)
+    # does not start one. Whatever is still dirty at exit is flushed then.
+    def _start(self):
+        self._thread = threading.Thread(target=self._flush_loop, name='session-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _put(self, store_id, data, expires_at, dirty):
+        evicted = []
+        with self._lock:
+            if dirty and self._thread is None:
+                self._start()
+            self._cache[store_id] = (data, expires_at)
+            self._cache.move_to_end(store_id)
+            if dirty:
+                self._dirty.add(store_id)
+
+            while len(self._cache) > self.max_entries:
+                old_id, old_entry = self._cache.popitem(last=False)
+                self.stats['evicted'] += 1
+                if old_id in self._dirty:
+                    self._dirty.discard(old_id)
+                    evicted.append((old_id, old_entry))
+
+        # A dirty session that falls out of the LRU is written straight away so it is not lost
+        if evicted:
+            self._write(evicted)
+
+    def _retrieve_session_data(self, store_id):
+        self.stats['reads'] += 1
+        with self._lock:
+            entry = self._cache.get(store_id)
+            if entry is not None:
+                self._cache.move_to_end(store_id)
+
+        if entry is not None:
+            data, expires_at = entry
+            if data is None or expires_at <= glvars.now_epoch():
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            return self.serializer.decode(data)
+
+        row = self.load(store_id)
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self._put(store_id, row[0], row[1], dirty=False)
+        return self.serializer.decode(row[0])
+
+    def _delete_session(self, store_id):
+        self.stats['deletes'] += 1
+        # Remembered as deleted until the flush removes the row too
+        self._put(store_id, None, 0, dirty=True)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        self.stats['writes'] += 1
+        expires_at = glvars.now_epoch() + int(total_seconds(session_lifetime))
+        self._put(store_id, self.serializer.encode(session), expires_at, dirty=True)
+
+    def _write(self, entries):
+        upserts = [(store_id, data, expires_at) for store_id, (data, expires_at) in entries if data is not None]
+        deletes = [(store_id,) for store_id, (data, _) in entries if data is None]
+        if upserts:
+            self.store(upserts)
+        if deletes:
+            self._run_many(f'DELETE FROM {glvars.sessions_table} WHERE id = ?', deletes)
+
+    def flush(self):
+        with self._lock:
+            entries = [(store_id, self._cache[store_id]) for store_id in self._dirty if store_id in self._cache]
+            self._dirty.clear()
+
+        if entries:
+            try:
+                self._write(entries)
+            except Exception:
+                # Put them back so the next flush tries again
+                with self._lock:
+                    self._dirty.update(store_id for store_id, _ in entries)
+                raise
+
+        self.stats['flushes'] += 1
+        self.stats['flushed'] += len(entries)
+        return len(entries)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'SESSION FLUSH FAILED: {e}')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _delete_expired_sessions(self):
+        now = glvars.now_epoch()
+        with self._lock:
+            expired = [store_id for store_id, (data, expires_at) in self._cache.items()
+                       if data is not None and expires_at <= now and store_id not in self._dirty]
+            for store_id in expired:
+                del self._cache[store_id]
+        return super()._delete_expired_sessions()
+
+    def session_stats(self):
+        with self._lock:
+            cached, dirty = len(self._cache), len(self._dirty)
+        return dict(self.stats, backend='memory', cached=cached, dirty=dirty)
+
+
+# None means Flask-Session's own filesystem store, configured in routes.py
+def make_session_interface(app, db_man, backend=glvars.session_backend):
+    if backend == 'sqlite':
+        return SQLiteSessionInterface(app, db_man)
+    if backend == 'memory':
+        return MemorySessionInterface(app, db_man)
+    if backend == 'filesystem':
+        return None
+    raise ValueError(f'Unknown SESSION_BACKEND {backend}, expected sqlite, memory or filesystem')
@@ -0,0 +1,88 @@
+import functions.global_vars as glvars
+import io
+
+# Pillow is optional: without it thumbnails are turned off and callers serve the full image
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Small fixed-size renditions of blobs, rendered on first request and kept in the blob store.
+# thumbnails maps (source hash, size) to the rendition's own blob hash.
+class ThumbnailManager:
+    def __init__(self, db_man, blob_man):
+        self.db_man = db_man
+        self.blob_man = blob_man
+        self.enabled = Image is not None
+
+    # Only the configured sizes are ever rendered, so clients cannot fill the store with odd sizes
+    def pick_size(self, size):
+        for allowed in glvars.thumbnail_sizes:
+            if size <= allowed:
+                return allowed
+        return glvars.thumbnail_sizes[-1]
+
+    def get_thumbnail(self, source_hash, size):
+        size = self.pick_size(size)
+        res = self.db_man.execute_query(
+            f"SELECT blob_hash FROM {glvars.thumbnails_table} WHERE source_hash = ? AND size = ?", (source_hash, size)
+        )
+        if not isinstance(res, list):
+            return glvars.ReturnMessage(False, f"Could not load thumbnail: {res}").send()
+        if res:
+            return glvars.ReturnData(True, "Thumbnail found", hash=res[0][0], size=size).send()
+
+        if not self.enabled:
+            return glvars.ReturnMessage(False, "Thumbnails need Pillow!").send()
+
+        source = self.blob_man.read_blob(source_hash)
+        if not source["success"]:
+            return glvars.ReturnMessage(False, source["message"]).send()
+
+        render_res = self.render(source["data"], size)
+        if not render_res["success"]:
+            return glvars.ReturnMessage(False, render_res["message"]).send()
+
+        db_conn = self.db_man.get_conn()
+        blob_res = self.blob_man.put_blob(render_res["data"], render_res["content_type"], db_conn)
+        if not blob_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, blob_res["message"]).send()
+
+        # Two requests may render the same thumbnail at once; both results are the same bytes
+        link_res = self.db_man.exec_no_commit(
+            f"INSERT OR IGNORE INTO {glvars.thumbnails_table} (source_hash, size, blob_hash) VALUES (?, ?, ?)",
+            (source_hash, size, blob_res["hash"]),
+            db_conn,
+        )
+        if not link_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, link_res["message"]).send()
+
+        commit_res = self.db_man.commit(db_conn)
+        if not commit_res["success"]:
+            self.db_man.rollback(db_conn)
+            return glvars.ReturnMessage(False, commit_res["message"]).send()
+
+        return glvars.ReturnData(True, "Thumbnail rendered", hash=blob_res["hash"], size=size).send()
+
+    # Fits the image in a size x size box. Transparent images stay PNG, everything else becomes JPEG.
+    def render(self, data, size):
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                # Lets JPEGs decode straight at a reduced scale instead of at full resolution
+                img.draft("RGB", (size, size))
+                img.thumbnail((size, size))
+
+                out = io.BytesIO()
+                if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                    img.save(out, "PNG", optimize=True)
+                    content_type = "image/png"
+                else:
+                    img.convert("RGB").save(out, "JPEG", quality=glvars.thumbnail_quality, optimize=True)
+                    content_type = "image/jpeg"
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            return glvars.ReturnMessage(False, f"Could not render thumbnail: {e}").send()
+
+        return glvars.ReturnData(True, "Rendered", data=out.getvalue(), content_type=content_type).send()
@@ -1,11 +1,15 @@
 import functions.global_vars as glvars
-import datetime
+from bisect import bisect_left, bisect_right
+import heapq
+import json
+import threading
+import time
 
 class Ticket:
     def __init__(self, code=0):
         self.code = code
         self.status = ''
-        self.expire_at = ''
+        self.expire_at = None
         self.buyer_id = None
         self.note_for = ''
 
@@ -21,6 +25,14 @@ class Ticket:
         return return_dict
 
 
+    # to_dict with the stored status/expire_at turned into the names and times clients see
+    def to_json(self):
+        return_dict = self.to_dict()
+        return_dict['status'] = glvars.status_name(self.status)
+        return_dict['expire_at'] = glvars.format_expire_at(self.expire_at, self.status)
+        return return_dict
+
+
     def import_from_db(self, db_input):
         if db_input == None or not isinstance(db_input, (list, tuple)):
             return glvars.ReturnMessage(False, 'Invalid data to import').send()
@@ -57,24 +69,21 @@ class Ticket:
     def reset(self):
         self.buyer_id = None
         self.note_for = ''
-        self.status = glvars.status_codes[0]
+        self.status = glvars.status_available
         self.expire_at = None
 
 
     def is_available(self):
         # print('Ticket Status: ', self.status)
-        # print('Status Code 0: ', glvars.status_codes[0])
-        # print('Ticket Code == Status Code 0 ? ', self.status == glvars.status_codes[0])
-        return bool(self.status == glvars.status_codes[0])
+        return bool(self.status == glvars.status_available)
     
 
     def order(self, buyer_id):
         if not self.is_available():
             return glvars.ReturnMessage(False, 'Ticket not available').send()
         
-        self.status = glvars.status_codes[1]
-        current_time = datetime.datetime.now().strftime(glvars.format_code)
-        self.expire_at = glvars.set_exp_time(current_time, time_unit='hours', time_units=glvars.expire_hours[0])
+        self.status = glvars.status_ordered
+        self.expire_at = glvars.expire_after(glvars.expire_hours[0])
         self.buyer_id = buyer_id
         return self.to_dict()
     
@@ -83,28 +92,27 @@ class Ticket:
         if self.is_available():
             return glvars.ReturnMessage(False, 'Ticket not ordered').send()
         
-        self.status = glvars.status_codes[0]
+        self.status = glvars.status_available
         self.expire_at = None
         self.buyer_id = None
         return self.to_dict()
     
 
     def purchase(self):
-        if self.status != glvars.status_codes[1]:
+        if self.status != glvars.status_ordered:
             return glvars.ReturnMessage(False, 'Ticket not ordered yet').send()
         
-        self.status = glvars.status_codes[2]
-        current_time = datetime.datetime.now().strftime(glvars.format_code)
-        self.expire_at = glvars.set_exp_time(current_time, time_unit='hours', time_units=glvars.expire_hours[1])
+        self.status = glvars.status_processing
+        self.expire_at = glvars.expire_after(glvars.expire_hours[1])
         return self.to_dict()
     
 
     def confirm(self):
-        if self.status != glvars.status_codes[2]:
+        if self.status != glvars.status_processing:
             return glvars.ReturnMessage(False, 'Ticket not bought yet').send()
         
-        self.status = glvars.status_codes[3]
-        self.expire_at = 'never'
+        self.status = glvars.status_confirmed
+        self.expire_at = None
         return glvars.ReturnData(True, 'Confirmed ticket!', data=self.to_dict()).send()
         
     
@@ -117,35 +125,281 @@ class Ticket:
     
 
 
+# Sorted list of available codes plus one '\n'-joined copy of it, so a substring lookup is a
+# str.find() over a single buffer instead of a LIKE scan. Changes are applied to the list right
+# away and the buffer is rebuilt on the next lookup.
+# With lazy expiry it also keeps the deadline of every held ticket in a heap, and moves holds
+# back into the available codes as their deadlines pass.
+class AvailableTicketsIndex:
+    def __init__(self, db_man, refresh_seconds=glvars.ticket_index_refresh):
+        self.db_man = db_man
+        self.refresh_seconds = refresh_seconds
+
+        self._codes = []
+        self._blob = ''
+        self._starts = []
+        self._dirty = True
+        self._built_at = None
+        self._lock = threading.RLock()
+
+        # code -> current expire_at, plus a (expire_at, code) heap that may hold outdated entries
+        self._holds = {}
+        self._deadlines = []
+
+
+    def rebuild(self):
+        # Literal status so the planner can use idx_tickets_available
+        query = f"SELECT code, status, expire_at FROM {glvars.tickets_table} WHERE status = {glvars.status_available}"
+        if glvars.lazy_expiry:
+            query += f" OR (status IN ({glvars.status_ordered}, {glvars.status_processing}) AND expire_at IS NOT NULL)"
+
+        res = self.db_man.execute_query(query)
+        if not isinstance(res, list):
+            return glvars.ReturnMessage(False, f'Could not load available tickets: {res}').send()
+
+        codes = sorted(str(row[0]) for row in res if row[1] == glvars.status_available)
+        holds = {str(row[0]): row[2] for row in res if row[1] != glvars.status_available}
+        with self._lock:
+            self._codes = codes
+            self._holds = holds
+            self._deadlines = [(expire_at, code) for code, expire_at in holds.items()]
+            heapq.heapify(self._deadlines)
+            self._dirty = True
+            self._built_at = time.monotonic()
+
+        return glvars.ReturnData(True, 'Rebuilt ticket index', size=len(codes)).send()
+
+
+    # Forces a reload from the database on the next lookup
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+
+    def add(self, *codes):
+        with self._lock:
+            for code in map(str, codes):
+                self._holds.pop(code, None)
+                i = bisect_left(self._codes, code)
+                if i == len(self._codes) or self._codes[i] != code:
+                    self._codes.insert(i, code)
+                    self._dirty = True
+
+
+    def discard(self, *codes):
+        with self._lock:
+            for code in map(str, codes):
+                i = bisect_left(self._codes, code)
+                if i < len(self._codes) and self._codes[i] == code:
+                    del self._codes[i]
+                    self._dirty = True
+
+
+    # Lazy expiry only: the codes are taken off sale and come back once expire_at passes
+    def hold(self, codes, expire_at):
+        if not glvars.lazy_expiry or not expire_at:
+            return
+
+        with self._lock:
+            self.discard(*codes)
+            for code in map(str, codes):
+                self._holds[code] = expire_at
+                heapq.heappush(self._deadlines, (expire_at, code))
+
+
+    # The hold ended for good (e.g. the ticket was confirmed)
+    def forget(self, *codes):
+        with self._lock:
+            for code in map(str, codes):
+                self._holds.pop(code, None)
+
+
+    def __len__(self):
+        return len(self._codes)
+
+
+    def _release_lapsed(self):
+        now = glvars.now_epoch()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            expire_at, code = heapq.heappop(self._deadlines)
+            # Skip entries the ticket has since moved past (bought, released, held again)
+            if self._holds.get(code) != expire_at:
+                continue
+
+            del self._holds[code]
+            i = bisect_left(self._codes, code)
+            if i == len(self._codes) or self._codes[i] != code:
+                self._codes.insert(i, code)
+                self._dirty = True
+
+
+    def _ensure_fresh(self):
+        if self._built_at is None or (self.refresh_seconds > 0 and time.monotonic() - self._built_at > self.refresh_seconds):
+            self.rebuild()
+
+        if self._deadlines:
+            self._release_lapsed()
+
+        if self._dirty:
+            starts = []
+            position = 1
+            for code in self._codes:
+                starts.append(position)
+                position += len(code) + 1
+            starts.append(position)
+
+            self._blob = '\n' + '\n'.join(self._codes) + '\n'
+            self._starts = starts
+            self._dirty = False
+
+
+    # Indexes of matching codes, walking forward from start or backward from end
+    def _matches(self, q, start, end, backward=False):
+        if not q:
+            indexes = range(end - 1, start - 1, -1) if backward else range(start, end)
+            yield from indexes
+            return
+
+        low = self._starts[start]
+        high = self._starts[end]
+        while low < high:
+            found = self._blob.rfind(q, low, high) if backward else self._blob.find(q, low, high)
+            if found == -1:
+                return
+
+            i = bisect_right(self._starts, found) - 1
+            yield i
+            if backward:
+                high = self._starts[i]
+            else:
+                low = self._starts[i + 1]
+
+
+    # Same contract as DBManager.execute_page, keyed on the ticket code
+    def page(self, q=None, limit=28, cursor=None, offset=0):
+        q = str(q) if q else None
+        if q and '\n' in q:
+            q = None
+
+        direction = 'next'
+        key = None
+        if cursor:
+            cursor_data = glvars.decode_cursor(cursor)
+            if not cursor_data or cursor_data.get('d') not in ('next', 'prev') or 'k' not in cursor_data:
+                return glvars.ReturnMessage(False, 'Invalid cursor').send()
+            direction = cursor_data['d']
+            key = str(cursor_data['k'])
+            offset = 0
+
+        with self._lock:
+            self._ensure_fresh()
+            total = len(self._codes)
+
+            if direction == 'next':
+                start = bisect_right(self._codes, key) if key is not None else 0
+                found = []
+                for i in self._matches(q, start, total):
+                    found.append(i)
+                    if len(found) > limit + max(offset, 0):
+                        break
+                found = found[max(offset, 0):]
+            else:
+                end = bisect_left(self._codes, key)
+                found = []
+                for i in self._matches(q, 0, end, backward=True):
+                    found.append(i)
+                    if len(found) > limit:
+                        break
+                found.reverse()
+
+            has_more = len(found) > limit
+            if direction == 'next':
+                codes = [self._codes[i] for i in found[:limit]]
+            else:
+                codes = [self._codes[i] for i in found[-limit:]]
+
+        next_cursor = None
+        prev_cursor = None
+        if codes:
+            if direction == 'next':
+                next_cursor = glvars.encode_cursor(k=codes[-1], d='next') if has_more else None
+                prev_cursor = glvars.encode_cursor(k=codes[0], d='prev') if cursor or offset > 0 else None
+            else:
+                next_cursor = glvars.encode_cursor(k=codes[-1], d='next')
+                prev_cursor = glvars.encode_cursor(k=codes[0], d='prev') if has_more else None
+
+        return glvars.ReturnData(True, 'Page loaded', data=codes, next_cursor=next_cursor, prev_cursor=prev_cursor).send()
+
+
 class TicketsManager:
     def __init__(self, db_man):
         self.db_man = db_man
+        self.index = AvailableTicketsIndex(db_man)
+        # ExpiryScheduler, told about every new expire_at when set
+        self.scheduler = None
+
+
+    # Called whenever tickets get a new expire_at (Ticket.order / Ticket.purchase)
+    # Call once the reserve/purchase is committed, so a rolled back one never takes codes off sale
+    def track_expiry(self, codes, expire_at):
+        if not codes:
+            return
+        if self.scheduler:
+            self.scheduler.schedule(codes, expire_at)
+        self.index.hold(codes, expire_at)
 
 
     # READ
-    def get_records(self, limit=10, offset=0, q=None, search_for=None):
+    def get_records(self, limit=10, offset=0, q=None, search_for=None, cursor=None):
         if str(q).lower() == 'all' and str(search_for).lower() == 'status':
             q = None
             search_for = None
 
-        params = str()
-        query = f"SELECT t.code, u.name, t.note_for, t.status, t.expire_at FROM {glvars.tickets_table} t LEFT JOIN {glvars.users_table} u ON t.buyer_id = u.id LIMIT {limit} OFFSET {offset}"
+        columns = "t.code, u.name, t.note_for, t.status, t.expire_at"
+        source, source_params = glvars.tickets_source()
+        select = f"SELECT {columns} FROM {source} t LEFT JOIN {glvars.users_table} u ON t.buyer_id = u.id"
+        where = ()
+        params = ()
+
+        if q and search_for:
+            if not glvars.is_column_name(search_for):
+                return glvars.ReturnMessage(False, 'Invalid search type!').send()
+
+            # Ranked full-text search by ticket code/note or by the buyer's name
+            if len(str(q)) >= glvars.fts_min_length:
+                ticket_column = glvars.fts_column(search_for, glvars.tickets_fts_columns)
+                if ticket_column and search_for.split('.')[0] != 'u':
+                    query = f"SELECT {columns} FROM {glvars.tickets_fts_table} JOIN {source} t ON t.rowid = {glvars.tickets_fts_table}.rowid LEFT JOIN {glvars.users_table} u ON t.buyer_id = u.id WHERE {glvars.tickets_fts_table} MATCH ? ORDER BY {glvars.tickets_fts_table}.rank, t.code"
+                    return self.search_records(query, (*source_params, glvars.fts_match(ticket_column, q)), limit, cursor, offset)
+
+                user_column = glvars.fts_column(search_for, glvars.users_fts_columns)
+                if user_column:
+                    query = f"SELECT {columns} FROM {glvars.users_fts_table} JOIN {source} t ON t.buyer_id = {glvars.users_fts_table}.rowid JOIN {glvars.users_table} u ON t.buyer_id = u.id WHERE {glvars.users_fts_table} MATCH ? ORDER BY {glvars.users_fts_table}.rank, t.code"
+                    return self.search_records(query, (*source_params, glvars.fts_match(user_column, q)), limit, cursor, offset)
+
+            where = (f'{search_for} LIKE ?',)
+            params = (f'%{q}%',)
+            # Statuses are stored as numbers, so match the search against their names instead
+            if search_for.split('.')[-1] == 'status':
+                where = (f'{search_for} IN (SELECT value FROM json_each(?))',)
+                params = (json.dumps([i for i, name in enumerate(glvars.status_codes) if str(q).lower() in name.lower()]),)
+
+        res = self.db_man.execute_page(select, 't.code', where=where, params=(*source_params, *params), limit=limit, cursor=cursor, offset=offset)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
+
+        data = [glvars.ticket_row_to_json(row, 3, 4) for row in res['data']]
+        return glvars.ReturnData(True, "Here's the tickets!", data=data, next_cursor=res['next_cursor'], prev_cursor=res['prev_cursor']).send()
+    
 
-        if q:
-            params = f'%{q}%'
-            query = f"SELECT t.code, u.name, t.note_for, t.status, t.expire_at FROM {glvars.tickets_table} t LEFT JOIN {glvars.users_table} u ON t.buyer_id = u.id WHERE {search_for} LIKE ? LIMIT {limit} OFFSET {offset}"
+    def search_records(self, query, params, limit, cursor, offset):
+        res = self.db_man.execute_ranked_page(query, params, limit=limit, cursor=cursor, offset=offset)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
 
-        # print('Query: ', query)
-        # print('Params: ', params)
-        # print('Search For: ', search_for)
+        data = [glvars.ticket_row_to_json(row, 3, 4) for row in res['data']]
+        return glvars.ReturnData(True, "Here's the tickets!", data=data, next_cursor=res['next_cursor'], prev_cursor=res['prev_cursor']).send()
 
-        if search_for:
-            res = self.db_man.execute_query(query, (params,))
-        else:
-            res = self.db_man.execute_query(query)
-        
-        return glvars.ReturnData(True, "Here's the tickets!", data=res).send()
-    
 
     # GET A TICKET
     def get_ticket(self, code=None):
@@ -155,14 +409,128 @@ class TicketsManager:
         ticket = Ticket(code)
         query = f'SELECT code, status, expire_at, buyer_id, note_for FROM {glvars.tickets_table} WHERE code = ?'
 
-        try:
-            ticket.import_from_db(self.db_man.execute_query(query, (code,))[0])
-        except IndexError:
+        res = self.db_man.execute_query(query, (code,))
+        if not isinstance(res, list):
+            return glvars.ReturnMessage(False, f'Could not load ticket: {res}').send()
+        if not res:
             return glvars.ReturnMessage(False, 'Ticket not found!').send()
+        ticket.import_from_db(res[0])
 
         return glvars.ReturnData(True, 'Ticket Found!', data=ticket).send()
     
 
+    # Compare-and-set: the UPDATE only matches while the ticket is still available, so two buyers
+    # racing for the same code can never both win. Nothing is read before the write.
+    def reserve_ticket(self, code=None, buyer_id=None, db_conn=None):
+        if isinstance(db_conn, type(None)):
+            return glvars.ReturnMessage(False, 'Invalid db conn for reserve_ticket!').send()
+
+        if not code:
+            return glvars.ReturnMessage(False, 'No code given.').send()
+
+        ticket = Ticket(code)
+        ticket.status = glvars.status_available
+        ticket.order(buyer_id)
+
+        reservable, reservable_params = glvars.reservable_condition()
+        query = f'UPDATE {glvars.tickets_table} SET status = ?, buyer_id = ?, expire_at = ? WHERE code = ? AND {reservable}'
+        res = self.db_man.exec_no_commit(query, (ticket.status, ticket.buyer_id, ticket.expire_at, code, *reservable_params), db_conn)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
+
+        if res['rows_affected'] != 1:
+            # Only the losing path pays for telling "taken" apart from "missing", on the same conn
+            exists = self.db_man.fetch_no_commit(f'SELECT 1 FROM {glvars.tickets_table} WHERE code = ?', (code,), db_conn)
+            if not exists['success']:
+                return glvars.ReturnMessage(False, exists['message']).send()
+            if not exists['rows']:
+                return glvars.ReturnMessage(False, 'Ticket not found!').send()
+            return glvars.ReturnMessage(False, 'Ticket already ordered!').send()
+
+        return glvars.ReturnData(True, 'Reserved ticket!', data=ticket).send()
+
+
+    # Set-based reserve_ticket: one UPDATE for the whole batch, RETURNING tells which codes were won.
+    # Returns {code: message} for the ones that were not.
+    def reserve_tickets(self, codes=None, buyer_id=None, db_conn=None):
+        if isinstance(db_conn, type(None)):
+            return glvars.ReturnMessage(False, 'Invalid db conn for reserve_tickets!').send()
+
+        codes = list(dict.fromkeys(map(str, codes or ())))
+        if not codes:
+            return glvars.ReturnMessage(False, 'No codes given.').send()
+
+        ticket = Ticket()
+        ticket.status = glvars.status_available
+        ticket.order(buyer_id)
+
+        reservable, reservable_params = glvars.reservable_condition()
+        query = f'UPDATE {glvars.tickets_table} SET status = ?, buyer_id = ?, expire_at = ? ' \
+                f'WHERE code IN (SELECT value FROM json_each(?)) AND {reservable} RETURNING code'
+        res = self.db_man.fetch_no_commit(query, (ticket.status, ticket.buyer_id, ticket.expire_at, json.dumps(codes), *reservable_params), db_conn)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
+        reserved = {row[0] for row in res['rows']}
+
+        failed = [code for code in codes if code not in reserved]
+        existing = set()
+        if failed:
+            query = f'SELECT code FROM {glvars.tickets_table} WHERE code IN (SELECT value FROM json_each(?))'
+            res = self.db_man.fetch_no_commit(query, (json.dumps(failed),), db_conn)
+            if not res['success']:
+                return glvars.ReturnMessage(False, res['message']).send()
+            existing = {row[0] for row in res['rows']}
+
+        failed = {code: 'Ticket already ordered!' if code in existing else 'Ticket not found!' for code in failed}
+        reserved = [code for code in codes if code in reserved]
+        return glvars.ReturnData(True, f'Reserved {len(reserved)} tickets!', reserved=reserved, failed=failed, expire_at=ticket.expire_at).send()
+
+
+    # Gives back reservations, but only ones the buyer still holds: with lazy expiry a lapsed hold
+    # may already belong to someone else.
+    def release_tickets(self, codes=None, buyer_id=None, db_conn=None):
+        if isinstance(db_conn, type(None)):
+            return glvars.ReturnMessage(False, 'Invalid db conn for release_tickets!').send()
+
+        codes = list(dict.fromkeys(map(str, codes or ())))
+        if not codes:
+            return glvars.ReturnData(True, 'No codes given.', released=[]).send()
+
+        query = f'UPDATE {glvars.tickets_table} SET status = ?, buyer_id = NULL, expire_at = NULL ' \
+                f'WHERE code IN (SELECT value FROM json_each(?)) AND buyer_id = ? AND status = ? RETURNING code'
+        res = self.db_man.fetch_no_commit(query, (glvars.status_available, json.dumps(codes), buyer_id, glvars.status_ordered), db_conn)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
+
+        return glvars.ReturnData(True, 'Released tickets', released=[row[0] for row in res['rows']]).send()
+
+
+    # ordered -> processing for every code the buyer still holds, in one UPDATE.
+    # Codes that were released or taken in the meantime come back in failed.
+    def purchase_tickets(self, codes=None, buyer_id=None, note=None, db_conn=None):
+        if isinstance(db_conn, type(None)):
+            return glvars.ReturnMessage(False, 'Invalid db conn for purchase_tickets!').send()
+
+        codes = list(dict.fromkeys(map(str, codes or ())))
+        if not codes:
+            return glvars.ReturnMessage(False, 'No codes given.').send()
+
+        ticket = Ticket()
+        ticket.status = glvars.status_ordered
+        ticket.purchase()
+
+        query = f'UPDATE {glvars.tickets_table} SET status = ?, expire_at = ?, note_for = COALESCE(?, note_for) ' \
+                f'WHERE code IN (SELECT value FROM json_each(?)) AND buyer_id = ? AND status = ? RETURNING code'
+        res = self.db_man.fetch_no_commit(query, (ticket.status, ticket.expire_at, note or None, json.dumps(codes), buyer_id, glvars.status_ordered), db_conn)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
+        bought = {row[0] for row in res['rows']}
+
+        failed = {code: 'Ticket no longer reserved for you!' for code in codes if code not in bought}
+        bought = [code for code in codes if code in bought]
+        return glvars.ReturnData(True, f'Bought {len(bought)} tickets!', bought=bought, failed=failed, expire_at=ticket.expire_at).send()
+
+
     def edit_ticket(self, code=None, edit_vars=None, edit_values=None, db_conn=None):
         if isinstance(db_conn, type(None)):
             return glvars.ReturnMessage(False, 'Invalid db conn for edit_ticket!').send()
@@ -191,6 +559,8 @@ class TicketsManager:
         commit_res = self.db_man.commit(db_conn)
         if not commit_res['success']:
             return glvars.ReturnMessage(False, f"Reason cannot delete ticket: {commit_res['message']}").send()
+
+        self.index.discard(code)
         
         return glvars.ReturnMessage(True, 'Successfully deleted ticket!').send()
 
@@ -217,5 +587,16 @@ class TicketsManager:
     
 
 
+    # Codes that already exist are skipped rather than failing the whole batch
+    def add_tickets(self, codes=None, db_conn=None):
+        if isinstance(db_conn, type(None)):
+            return glvars.ReturnMessage(False, 'Invalid db conn for add_tickets!').send()
 
+        if codes is None:
+            return glvars.ReturnMessage(False, 'No codes provided!').send()
+
+        res = self.db_man.add_rows(glvars.tickets_table, ('code',), ((code,) for code in codes), db_conn, on_conflict='IGNORE')
+        if not res['success']:
+            return glvars.ReturnMessage(False, f"Something went wrong in add tickets: {res['message']}").send()
 
+        return glvars.ReturnData(True, 'Added Tickets!', added=res['rows_affected']).send()
@@ -1,6 +1,13 @@
-import bcrypt
 from flask import session, jsonify
+from collections import OrderedDict
 from collections.abc import Iterable
+from itertools import islice
+import csv
+import io
+import json
+import threading
+import time
+from functions.hashing import PasswordHasher
 import functions.global_vars as glvars
 
 class User():
@@ -146,12 +153,139 @@ class User():
         var_to_change.remove(value)
         return self.to_dict()
 
+
+    # Its own ticket sets, so changing the copy leaves the original alone
+    def copy(self):
+        user = User()
+        user.__dict__.update(self.__dict__)
+        user.tickets_ordered = set(self.tickets_ordered)
+        user.tickets_bought = set(self.tickets_bought)
+        return user
+
         
 
 
+# Hydrated User objects by id, least recently used first, each good for ttl seconds (0 keeps them until
+# evicted or invalidated). Writes in this process invalidate their user; the TTL bounds how long a change
+# made by another worker process can go unseen. get() and put() hand out copies, so callers may change them.
+class UserCache:
+    def __init__(self, max_size=glvars.user_cache_size, ttl=glvars.user_cache_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation. A load that started before one may have read the old row,
+        # so put() drops it (see token()).
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0, 'stale_puts': 0}
+
+
+    def token(self):
+        with self._lock:
+            return self._generation
+
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            user, loaded_at = entry
+            if self.ttl and time.monotonic() - loaded_at > self.ttl:
+                del self._users[user_id]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._users.move_to_end(user_id)
+            self._stats['hits'] += 1
+        return user.copy()
+
+
+    def put(self, user_id, user, token):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            if token != self._generation:
+                self._stats['stale_puts'] += 1
+                return
+
+            self._users[user_id] = (user.copy(), time.monotonic())
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+                self._stats['evicted'] += 1
+
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                if self._users.pop(user_id, None) is not None:
+                    self._stats['invalidated'] += 1
+
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._users.clear()
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            size = len(self._users)
+
+        lookups = stats['hits'] + stats['misses']
+        return dict(stats, size=size, max_size=self.max_size, ttl=self.ttl,
+                    hit_rate=round(stats['hits'] / lookups, 3) if lookups else None)
+
+
+# Password hashing is refused when the hasher's queue is full; clients get a 503 to retry on
+def busy_response(res):
+    return glvars.ReturnMessage(False, res['message']).response(), 503, {'Retry-After': '1'}
+
+
+import_columns = ('name', 'phone_number', 'password', 'address', 'email', 'role')
+
+
+# Rows of an uploaded user file as (line number, dict), read a line at a time from a binary stream
+def iter_csv_rows(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def iter_ndjson_rows(stream):
+    for line_num, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8-sig'), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+def check_import_row(row):
+    if row is None:
+        return 'Not a JSON object!'
+    for field in ('name', 'phone_number', 'password'):
+        if not str(row.get(field) or '').strip():
+            return f'Missing {field}!'
+    if (row.get('role') or 'user') not in glvars.roles:
+        return f"Unknown role {row.get('role')}!"
+    return None
+
+
 class Authentication():
-    def __init__(self, db_man_class):
+    def __init__(self, db_man_class, hasher=None):
         self.db_man = db_man_class
+        self.hasher = hasher or PasswordHasher(workers=0)
 
 
     def register(self, json_data):
@@ -159,14 +293,17 @@ class Authentication():
             return glvars.ReturnMessage(False, 'Something Went Wrong :(').response()
         
         query = f"SELECT COUNT(*) FROM {glvars.users_table} WHERE phone_number = ?"
-        check_count = self.db_man.execute_query(query, (json_data['phone_number'],))[0][0]
-        if check_count != 0:
+        check_res = self.db_man.execute_query(query, (json_data['phone_number'],))
+        if not isinstance(check_res, list):
+            return glvars.ReturnMessage(False, f'Could not check the phone number: {check_res}').response()
+        if check_res[0][0] != 0:
             return glvars.ReturnMessage(False, 'Phone Number already has an account!').response()
         
         # Hash the password
-        salt = bcrypt.gensalt(rounds=12)
-        byte_pass = json_data['password'].encode('utf-8')
-        pass_hash = bcrypt.hashpw(byte_pass, salt)
+        hash_res = self.hasher.hash(json_data['password'])
+        if not hash_res['success']:
+            return busy_response(hash_res) if hash_res['busy'] else glvars.ReturnMessage(False, hash_res['message']).response()
+        pass_hash = hash_res['hash']
 
         # Construct new dictionary for database
         new_dict = json_data.copy()
@@ -198,6 +335,8 @@ class Authentication():
         query = "SELECT password, id, name, email, address, phone_number, role, tickets_bought, tickets_ordered, pfp FROM users WHERE phone_number = ?"
         
         db_result = self.db_man.execute_query(query, (dict_check['logininfo'],))
+        if not isinstance(db_result, list):
+            return {'success': False, 'message': f'Could not load the account: {db_result}'}
         if not db_result:
             return {'success': False, 'message': 'Account not registered!'}
         db_data = db_result[0]
@@ -205,7 +344,10 @@ class Authentication():
         if not db_data:
             return {'success': False, 'message': 'Account not registered.'}
         
-        if not bcrypt.checkpw(json_data['password'].encode('utf-8'), db_data[0]):
+        check_res = self.hasher.check(json_data['password'], db_data[0])
+        if not check_res['success']:
+            return busy_response(check_res) if check_res['busy'] else {'success': False, 'message': check_res['message']}
+        if not check_res['valid']:
             return {'success': False, 'message': 'Invalid password.'}
         
         new_dict = json_data.copy()
@@ -221,40 +363,74 @@ class Authentication():
         from functions.cart import Cart
         cart_obj = Cart()
         cart_res = self.db_man.execute_query(f"SELECT id, buyer_id, amount_bought, tickets_bought, img_link, is_in_cart FROM {glvars.orders_table} WHERE buyer_id = ?AND is_in_cart = 1", (user_obj.id,))
-        session['cart'] = None
-        if cart_res:
-            cart_obj.import_from_db(cart_res[0])
-            session['cart'] = cart_obj.to_dict()
-
-        session['user_info'] = user_obj.to_dict()
+        cart_dict = None
+        if isinstance(cart_res, list) and cart_res:
+            items_res = self.db_man.execute_query(f"SELECT ticket_code FROM {glvars.order_items_table} WHERE order_id = ?", (cart_res[0][0],))
+            cart_obj.import_from_db(cart_res[0], items=[row[0] for row in items_res] if isinstance(items_res, list) else [])
+            cart_dict = cart_obj.to_dict()
+
+        user_dict = user_obj.to_dict()
+        session['cart'] = glvars.session_cart(cart_dict)
+        session['user_info'] = glvars.session_user(user_dict)
         # print(f'User OBJ: {user_obj.to_dict()}')
 
-        return glvars.ReturnData(True, 'Logged In!', user_info=session['user_info'], cart=session['cart']).response()
+        return glvars.ReturnData(True, 'Logged In!', user_info=user_dict, cart=cart_dict).response()
 
 
 
 class UserManager():
-    def __init__(self, db_man):
+    def __init__(self, db_man, hasher=None, cache=None):
         self.db_man = db_man
+        self.hasher = hasher or PasswordHasher(workers=0)
+        self.cache = cache or UserCache()
 
 
-    def get_users(self, limit=10, offset=0, q=None, search_for='id'):
-        params = str()
-        query = f"SELECT id, name, role, tickets_ordered, tickets_bought, phone_number, email, address FROM {glvars.users_table} LIMIT {limit} OFFSET {offset}"
+    def get_users(self, limit=10, offset=0, q=None, search_for='id', cursor=None):
+        columns = "id, name, role, tickets_ordered, tickets_bought, phone_number, email, address"
+        select = f"SELECT {columns} FROM {glvars.users_table}"
+        where = ()
+        params = ()
 
         if q:
-            params = f'%{q}%'    
-            query = f"SELECT id, name, role, tickets_ordered, tickets_bought, phone_number, email, address FROM {glvars.users_table} WHERE {search_for} LIKE ? LIMIT {limit} OFFSET {offset}"
-            res = self.db_man.execute_query(query, (params,))
-        else:
-            res = self.db_man.execute_query(query)
+            if not glvars.is_column_name(search_for):
+                return glvars.ReturnMessage(False, 'Invalid search type!').send()
 
-        return glvars.ReturnData(True, "Here's the users!", data=res).send()
+            fts_column = glvars.fts_column(search_for, glvars.users_fts_columns)
+            if fts_column and len(str(q)) >= glvars.fts_min_length:
+                aliased_columns = ', '.join(f'u.{column}' for column in columns.split(', '))
+                query = f"SELECT {aliased_columns} FROM {glvars.users_fts_table} JOIN {glvars.users_table} u ON u.id = {glvars.users_fts_table}.rowid WHERE {glvars.users_fts_table} MATCH ? ORDER BY {glvars.users_fts_table}.rank, u.id"
+                res = self.db_man.execute_ranked_page(query, (glvars.fts_match(fts_column, q),), limit=limit, cursor=cursor, offset=offset)
+                if not res['success']:
+                    return glvars.ReturnMessage(False, res['message']).send()
 
+                return glvars.ReturnData(True, "Here's the users!", data=res['data'], next_cursor=res['next_cursor'], prev_cursor=res['prev_cursor']).send()
+
+            where = (f'{search_for} LIKE ?',)
+            params = (f'%{q}%',)
+
+        res = self.db_man.execute_page(select, 'id', where=where, params=params, limit=limit, cursor=cursor, offset=offset)
+        if not res['success']:
+            return glvars.ReturnMessage(False, res['message']).send()
+
+        return glvars.ReturnData(True, "Here's the users!", data=res['data'], next_cursor=res['next_cursor'], prev_cursor=res['prev_cursor']).send()
+
+    # Ids come in as ints or as strings from JSON bodies; the cache key is always the int
     def get_user(self, id):
+        try:
+            user_id = int(id)
+        except (TypeError, ValueError):
+            return glvars.ReturnMessage(False, 'User not found!').send()
+
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return glvars.ReturnData(True, 'Got user!', data=cached).send()
+
+        token = self.cache.token()
         user = User()
-        query = f'SELECT id, name, email, address, phone_number, role, tickets_ordered, tickets_bought, pfp FROM {glvars.users_table} WHERE id = ?'
-        res = self.db_man.execute_query(query, (id,))
+        query = f'SELECT id, name, email, address, phone_number, role, tickets_bought, tickets_ordered, pfp FROM {glvars.users_table} WHERE id = ?'
+        res = self.db_man.execute_query(query, (user_id,))
+        if not isinstance(res, list):
+            return glvars.ReturnMessage(False, f'Could not load user: {res}').send()
 
         try:
             if not res[0]:
@@ -264,17 +440,25 @@ class UserManager():
                 return glvars.ReturnMessage(False, try_import['message']).send()
         except IndexError:
             return glvars.ReturnMessage(False, 'User not found!').send()
-        
+
+        self.cache.put(user_id, user, token)
         return glvars.ReturnData(True, 'Got user!', data=user).send()
+
+
+    # Call after committing a change to a user's row. edit_user/delete_user already drop the entry when
+    # they write, but a get_user before the commit can still cache the old row.
+    def forget_user(self, *user_ids):
+        self.cache.invalidate(*(int(user_id) for user_id in user_ids if str(user_id).isdigit()))
     
     
     def add_user(self, name, phone_number, password, address, db_conn=None):
         if isinstance(db_conn, type(None)):
             return glvars.ReturnMessage(False, 'Invalid db conn!').send()
 
-        salt = bcrypt.gensalt(rounds=12)
-        byte_pass = password.encode('utf-8')
-        pass_hash = bcrypt.hashpw(byte_pass, salt)
+        hash_res = self.hasher.hash(password)
+        if not hash_res['success']:
+            return hash_res
+        pass_hash = hash_res['hash']
 
         res = self.db_man.add_row(glvars.users_table, ('name', 'phone_number', 'password', 'address'), (name, phone_number, pass_hash, address), db_conn)
 
@@ -296,18 +480,19 @@ class UserManager():
         
         for i, var in enumerate(edit_vars):
             if var == 'password':
-                salt = bcrypt.gensalt(rounds=12)
-                byte_pass = edit_values[i].encode('utf-8')
-                pass_hash = bcrypt.hashpw(byte_pass, salt)
+                hash_res = self.hasher.hash(edit_values[i])
+                if not hash_res['success']:
+                    return hash_res
 
                 try:
-                    edit_values[i] = pass_hash
+                    edit_values[i] = hash_res['hash']
                 except Exception as e:
                     return glvars.ReturnMessage(False, f'Something went wrong hashing the password: {e}').send()
                 
         print(f'EDIT_VARS: {edit_vars}')
         print(f'EDIT_VALUES: {edit_values}')
         edit_res = self.db_man.edit_row(glvars.users_table, ('id',), (u_id,), edit_vars, edit_values, db_conn)
+        self.forget_user(u_id)
 
         if not edit_res['success']:
             return glvars.ReturnMessage(False, edit_res['message']).send()
@@ -315,6 +500,95 @@ class UserManager():
         return glvars.ReturnMessage(True, 'Edited User!').send()
     
 
+    # Bulk add_user for a stream of (line number, dict) rows. Each batch has its passwords hashed in
+    # parallel and is inserted in one transaction; bad rows are reported by line and skipped.
+    def import_users(self, rows, batch_size=glvars.user_import_batch, max_errors=glvars.user_import_max_errors):
+        start = time.perf_counter()
+        totals = {'rows': 0, 'imported': 0, 'failed': 0, 'batches': 0}
+        errors = []
+
+        def fail(line_num, message):
+            totals['failed'] += 1
+            if len(errors) < max_errors:
+                errors.append({'line': line_num, 'message': message})
+
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            totals['rows'] += len(batch)
+
+            valid = {}
+            for line_num, row in batch:
+                message = check_import_row(row)
+                phone_number = str(row['phone_number']).strip() if message is None else None
+                if message is None and phone_number in valid:
+                    message = 'Phone number repeated in the file!'
+                if message:
+                    fail(line_num, message)
+                    continue
+                valid[phone_number] = (line_num, row)
+
+            # Taken numbers are weeded out before hashing, which is the expensive part
+            taken = self.db_man.execute_query(
+                f"SELECT phone_number FROM {glvars.users_table} WHERE phone_number IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(valid.keys())),)
+            )
+            if not isinstance(taken, list):
+                return glvars.ReturnMessage(False, f'Could not check phone numbers: {taken}').send()
+            for (phone_number,) in taken:
+                fail(valid.pop(phone_number)[0], 'Phone Number already has an account!')
+            if not valid:
+                continue
+
+            hash_res = self.hasher.hash_many([str(row['password']) for _, row in valid.values()])
+            # Bulk work waits for room instead of failing, logins keep their share of the queue
+            waited = 0
+            while not hash_res['success'] and hash_res.get('busy') and waited < self.hasher.timeout:
+                time.sleep(0.25)
+                waited += 0.25
+                hash_res = self.hasher.hash_many([str(row['password']) for _, row in valid.values()])
+            if not hash_res['success']:
+                for line_num, _ in valid.values():
+                    fail(line_num, hash_res['message'])
+                continue
+
+            db_conn = self.db_man.get_conn()
+            insert_res = self.db_man.add_rows(
+                glvars.users_table,
+                import_columns,
+                (
+                    (str(row['name']).strip(), phone_number, pass_hash, row.get('address') or '', row.get('email') or None, row.get('role') or 'user')
+                    for (phone_number, (_, row)), pass_hash in zip(valid.items(), hash_res['hashes'])
+                ),
+                db_conn,
+            )
+            if not insert_res['success']:
+                self.db_man.rollback(db_conn)
+                for line_num, _ in valid.values():
+                    fail(line_num, insert_res['message'])
+                continue
+
+            commit_res = self.db_man.commit(db_conn)
+            if not commit_res['success']:
+                self.db_man.rollback(db_conn)
+                return glvars.ReturnMessage(False, commit_res['message']).send()
+
+            totals['imported'] += len(valid)
+            totals['batches'] += 1
+
+        elapsed = time.perf_counter() - start
+        return glvars.ReturnData(
+            True,
+            f"Imported {totals['imported']} of {totals['rows']} users",
+            **totals,
+            errors=errors,
+            errors_truncated=totals['failed'] > len(errors),
+            elapsed_ms=round(elapsed * 1000, 2),
+            rows_per_sec=round(totals['rows'] / elapsed, 1) if elapsed else None,
+        ).send()
+
     def delete_user(self, id, db_conn):
         if isinstance(db_conn, type(None)):
             return glvars.ReturnMessage(False, 'DB CONN NOT PROVIDED!').send()
@@ -323,6 +597,7 @@ class UserManager():
             return glvars.ReturnMessage(False, 'CANNOT DELETE ADMIN!').send()
 
         res = self.db_man.delete_row(glvars.users_table, 'id', str(id), db_conn)
+        self.forget_user(id)
         if not res['success']:
             return glvars.ReturnMessage(False, f"Error: {res['message']}").send()
         
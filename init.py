@@ -2,6 +2,7 @@ import sqlite3
 import os
 import functions.users as usr
 import functions.db_man as db
+import functions.migrations as migrations
 from dotenv import load_dotenv, set_key
 import secrets
 
@@ -29,34 +30,13 @@ def setup_env():
         print("SECRET_KEY already exists in .env")
 
 def create_db():
-    db_file_name = db_path
-    sql_script_path = 'db_queries.sql' # Your .sql file path
-
     try:
-        conn = sqlite3.connect(db_file_name)
-        cursor = conn.cursor()
-        print(f"Connected to '{db_file_name}'.")
-
-        # 1. Open and read the .sql file
-        if os.path.exists(sql_script_path):
-            with open(sql_script_path, 'r') as sql_file:
-                sql_script = sql_file.read()
-            
-            # 2. Execute the entire script
-            cursor.executescript(sql_script)
-            conn.commit()
-            print(f"Script '{sql_script_path}' executed successfully.")
-        else:
-            print(f"Error: The file '{sql_script_path}' was not found.")
-
+        applied = migrations.upgrade(db_path)
+        print(f"Applied migrations to '{db_path}': {applied}" if applied else f"'{db_path}' is up to date.")
     except sqlite3.Error as e:
         print(f"SQLite error: {e}")
     except Exception as e:
         print(f"General error: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
 
 
 def create_admin():
@@ -74,6 +54,7 @@ def create_admin():
         print(f"ERROR CREATING ADMIN! {edit_res['message']}")
     
     commit_res = db_man.commit(db_conn)
+    db_man.release_conn(db_conn)
     if not commit_res['success']:
         print(f"Could not commit changes: {commit_res['message']}")
         return
@@ -2,12 +2,20 @@
 # from threading import Thread
 
 # from functions.global_vars import setup_logger
-from routes import app
+import functions.global_vars as glvars
+from routes import app, expiry_scheduler, hasher
 
 # setup_logger()
 
 application = app
 
+# Before any app threads exist, so the bcrypt worker processes fork from a quiet process
+print(hasher.start()["message"])
+
+# Releases lapsed tickets within a second of their deadline; prune_tickets.py stays as a safety net
+if glvars.expiry_scheduler_enabled:
+    print(expiry_scheduler.start()["message"])
+
 if __name__ == "__main__":
     # Thread(target=prune_tickets.loop).start()
     application.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,16 @@
+-- Indexes for the predicates the storefront, cart and admin views filter on.
+-- Partial indexes only cover the rows those queries can match.
+
+CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets (status);
+
+CREATE INDEX IF NOT EXISTS idx_tickets_available ON tickets (code) WHERE status = 'available';
+
+CREATE INDEX IF NOT EXISTS idx_tickets_buyer_id ON tickets (buyer_id) WHERE buyer_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_tickets_expire_at ON tickets (expire_at) WHERE expire_at IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_orders_buyer_cart ON orders (buyer_id, is_in_cart);
+
+CREATE INDEX IF NOT EXISTS idx_orders_processing ON orders (id) WHERE is_in_cart = 0 AND confirmed = 0;
+
+CREATE INDEX IF NOT EXISTS idx_users_phone_number ON users (phone_number);
@@ -0,0 +1,21 @@
+-- One row per ticket in an order. Replaces the ';'-joined orders.tickets_bought,
+-- which is kept for old rows but no longer maintained.
+
+CREATE TABLE IF NOT EXISTS order_items (
+    order_id INTEGER NOT NULL,
+    ticket_code TEXT NOT NULL,
+    PRIMARY KEY (order_id, ticket_code),
+    FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
+    FOREIGN KEY(ticket_code) REFERENCES tickets(code)
+);
+
+-- The primary key already serves lookups by order_id
+CREATE INDEX IF NOT EXISTS idx_order_items_ticket_code ON order_items (ticket_code);
+
+INSERT OR IGNORE INTO order_items (order_id, ticket_code)
+WITH RECURSIVE split(order_id, ticket_code, rest) AS (
+    SELECT id, '', tickets_bought || ';' FROM orders WHERE tickets_bought IS NOT NULL AND tickets_bought != ''
+    UNION ALL
+    SELECT order_id, substr(rest, 1, instr(rest, ';') - 1), substr(rest, instr(rest, ';') + 1) FROM split WHERE rest != ''
+)
+SELECT order_id, ticket_code FROM split WHERE ticket_code != '';
@@ -0,0 +1,49 @@
+-- FTS5 indexes for the admin search boxes. The trigram tokenizer keeps the old
+-- "contains" semantics of LIKE '%q%' (for queries of 3+ characters) without a table scan.
+-- Both are external-content tables kept in sync by triggers; order searches by
+-- buyer go through users_fts.
+
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    name, phone_number, address, email,
+    content='users', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+    INSERT INTO users_fts (rowid, name, phone_number, address, email)
+    VALUES (new.id, new.name, new.phone_number, new.address, new.email);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+    INSERT INTO users_fts (users_fts, rowid, name, phone_number, address, email)
+    VALUES ('delete', old.id, old.name, old.phone_number, old.address, old.email);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF name, phone_number, address, email ON users BEGIN
+    INSERT INTO users_fts (users_fts, rowid, name, phone_number, address, email)
+    VALUES ('delete', old.id, old.name, old.phone_number, old.address, old.email);
+    INSERT INTO users_fts (rowid, name, phone_number, address, email)
+    VALUES (new.id, new.name, new.phone_number, new.address, new.email);
+END;
+
+INSERT INTO users_fts (users_fts) VALUES ('rebuild');
+
+-- tickets has no INTEGER PRIMARY KEY, so run INSERT INTO tickets_fts (tickets_fts) VALUES ('rebuild') after a VACUUM
+CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+    code, note_for,
+    content='tickets', content_rowid='rowid', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS tickets_fts_insert AFTER INSERT ON tickets BEGIN
+    INSERT INTO tickets_fts (rowid, code, note_for) VALUES (new.rowid, new.code, new.note_for);
+END;
+
+CREATE TRIGGER IF NOT EXISTS tickets_fts_delete AFTER DELETE ON tickets BEGIN
+    INSERT INTO tickets_fts (tickets_fts, rowid, code, note_for) VALUES ('delete', old.rowid, old.code, old.note_for);
+END;
+
+CREATE TRIGGER IF NOT EXISTS tickets_fts_update AFTER UPDATE OF code, note_for ON tickets BEGIN
+    INSERT INTO tickets_fts (tickets_fts, rowid, code, note_for) VALUES ('delete', old.rowid, old.code, old.note_for);
+    INSERT INTO tickets_fts (rowid, code, note_for) VALUES (new.rowid, new.code, new.note_for);
+END;
+
+INSERT INTO tickets_fts (tickets_fts) VALUES ('rebuild');
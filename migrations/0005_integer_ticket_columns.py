@@ -0,0 +1,71 @@
+import functions.global_vars as glvars
+from datetime import datetime
+
+# tickets.status becomes its index in glvars.status_codes and tickets.expire_at becomes epoch seconds.
+# 'never' (confirmed tickets) becomes NULL. SQLite cannot change column types in place, so the table
+# is rebuilt with the same rowids (tickets_fts points at them) and its indexes and triggers recreated.
+
+schema = '''
+CREATE TABLE tickets_new (
+    code TEXT UNIQUE PRIMARY KEY,
+    status INTEGER NOT NULL DEFAULT 0,
+    expire_at INTEGER DEFAULT NULL,
+    buyer_id INTEGER DEFAULT NULL,
+    note_for TEXT DEFAULT NULL,
+    CONSTRAINT status CHECK (status BETWEEN 0 AND 3),
+    FOREIGN KEY(buyer_id) REFERENCES users(id)
+);
+'''
+
+indexes = [
+    'CREATE INDEX idx_tickets_status ON tickets (status)',
+    'CREATE INDEX idx_tickets_available ON tickets (code) WHERE status = 0',
+    'CREATE INDEX idx_tickets_buyer_id ON tickets (buyer_id) WHERE buyer_id IS NOT NULL',
+    'CREATE INDEX idx_tickets_expire_at ON tickets (expire_at) WHERE expire_at IS NOT NULL',
+]
+
+triggers = [
+    '''CREATE TRIGGER tickets_fts_insert AFTER INSERT ON tickets BEGIN
+        INSERT INTO tickets_fts (rowid, code, note_for) VALUES (new.rowid, new.code, new.note_for);
+    END''',
+    '''CREATE TRIGGER tickets_fts_delete AFTER DELETE ON tickets BEGIN
+        INSERT INTO tickets_fts (tickets_fts, rowid, code, note_for) VALUES ('delete', old.rowid, old.code, old.note_for);
+    END''',
+    '''CREATE TRIGGER tickets_fts_update AFTER UPDATE OF code, note_for ON tickets BEGIN
+        INSERT INTO tickets_fts (tickets_fts, rowid, code, note_for) VALUES ('delete', old.rowid, old.code, old.note_for);
+        INSERT INTO tickets_fts (rowid, code, note_for) VALUES (new.rowid, new.code, new.note_for);
+    END''',
+]
+
+
+def to_status(status):
+    if isinstance(status, int):
+        return status
+    return glvars.status_codes.index(status) if status in glvars.status_codes else 0
+
+
+def to_epoch(expire_at):
+    if expire_at is None or isinstance(expire_at, int):
+        return expire_at
+    try:
+        return int(datetime.strptime(expire_at, glvars.format_code).timestamp())
+    except ValueError:
+        return None
+
+
+def upgrade(db_conn):
+    db_conn.execute(schema)
+
+    rows = db_conn.execute('SELECT rowid, code, status, expire_at, buyer_id, note_for FROM tickets')
+    db_conn.executemany(
+        'INSERT INTO tickets_new (rowid, code, status, expire_at, buyer_id, note_for) VALUES (?, ?, ?, ?, ?, ?)',
+        ((rowid, code, to_status(status), to_epoch(expire_at), buyer_id, note_for) for rowid, code, status, expire_at, buyer_id, note_for in rows)
+    )
+
+    # Takes the old indexes and FTS triggers with it
+    db_conn.execute('DROP TABLE tickets')
+    db_conn.execute('ALTER TABLE tickets_new RENAME TO tickets')
+
+    for statement in indexes + triggers:
+        db_conn.execute(statement)
+    db_conn.execute("INSERT INTO tickets_fts (tickets_fts) VALUES ('rebuild')")
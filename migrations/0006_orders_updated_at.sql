@@ -0,0 +1,7 @@
+-- Last time a cart was changed, in epoch seconds. Carts untouched for CART_TTL_HOURS are cleaned up.
+ALTER TABLE orders ADD COLUMN updated_at INTEGER DEFAULT NULL;
+
+-- Existing carts get a full TTL from the upgrade instead of being swept straight away
+UPDATE orders SET updated_at = CAST(strftime('%s', 'now') AS INTEGER);
+
+CREATE INDEX IF NOT EXISTS idx_orders_cart_updated_at ON orders (updated_at) WHERE is_in_cart = 1;
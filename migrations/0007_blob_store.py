@@ -0,0 +1,47 @@
+import functions.global_vars as glvars
+import hashlib
+import time
+
+# Payment screenshots move out of orders.img_link (base64 data URLs) into the content-addressed
+# blobs table; img_link keeps only the SHA-256 of the image. Orders are converted batch by batch
+# so the whole set of images is never held in memory at once.
+
+schema = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT NOT NULL UNIQUE,
+    content_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    created_at INTEGER NOT NULL
+);
+'''
+
+batch_size = 100
+
+
+def upgrade(db_conn):
+    db_conn.execute(schema)
+
+    last_id = 0
+    while True:
+        rows = db_conn.execute(
+            "SELECT id, img_link FROM orders WHERE id > ? AND img_link LIKE 'data:%' ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        for order_id, img_link in rows:
+            decoded = glvars.decode_data_url(img_link)
+            if decoded is None:
+                continue
+
+            content_type, data = decoded
+            digest = hashlib.sha256(data).hexdigest()
+            db_conn.execute(
+                'INSERT OR IGNORE INTO blobs (hash, content_type, size, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                (digest, content_type, len(data), data, int(time.time()))
+            )
+            db_conn.execute('UPDATE orders SET img_link = ? WHERE id = ?', (digest, order_id))
+
+        last_id = rows[-1][0]
@@ -0,0 +1,48 @@
+import functions.global_vars as glvars
+import hashlib
+import time
+
+# thumbnails maps a source blob and a size to the blob holding that rendition.
+# Profile pictures get their own copy in the blob store too (users.pfp_hash), so they can be
+# thumbnailed and cached like order images. users.pfp keeps the data URL for existing clients.
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS thumbnails (
+        source_hash TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        blob_hash TEXT NOT NULL,
+        PRIMARY KEY (source_hash, size)
+    ) WITHOUT ROWID''',
+    'ALTER TABLE users ADD COLUMN pfp_hash TEXT DEFAULT NULL',
+]
+
+batch_size = 100
+
+
+def upgrade(db_conn):
+    for statement in schema:
+        db_conn.execute(statement)
+
+    last_id = 0
+    while True:
+        rows = db_conn.execute(
+            "SELECT id, pfp FROM users WHERE id > ? AND pfp LIKE 'data:%' ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        for user_id, pfp in rows:
+            decoded = glvars.decode_data_url(pfp)
+            if decoded is None:
+                continue
+
+            content_type, data = decoded
+            digest = hashlib.sha256(data).hexdigest()
+            db_conn.execute(
+                'INSERT OR IGNORE INTO blobs (hash, content_type, size, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                (digest, content_type, len(data), data, int(time.time()))
+            )
+            db_conn.execute('UPDATE users SET pfp_hash = ? WHERE id = ?', (digest, user_id))
+
+        last_id = rows[-1][0]
@@ -0,0 +1,9 @@
+-- Server-side sessions (SESSION_BACKEND=sqlite or memory): msgpack-encoded session data keyed by session id.
+-- expires_at is epoch seconds; the cleanup deletes expired rows through its index.
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires_at INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);
@@ -1,14 +1,22 @@
-from flask import Blueprint, Flask, request, session, g
+from flask import Blueprint, Flask, Response, request, session, g
 from flask_caching import Cache
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+import functions.blobs as blobs
 import functions.global_vars as glvars
+import functions.hashing as hashing
+import functions.migrations as migrations
 import functions.orders as orders
+import functions.sessions as sessions
+import functions.thumbnails as thumbnails
 import functions.tickets as tickets
 import functions.users as usr
 from flask_session import Session
 from functions.db_man import DBManager
+from functions.scheduler import ExpiryScheduler
+import csv
+import io
 
 app = Flask(__name__)
 app.config["TEMPLATE_AUTO_RELOAD"] = True
@@ -26,7 +34,6 @@ app.config["SESSION_FILE_DIR"] = "./tmp/flask_sessions"
 
 app.config["CACHE_TYPE"] = "simple"
 app.config["CACHE_DEFAULT_TIMEOUT"] = 300
-Session(app)
 CORS(
     app,
     supports_credentials=True,
@@ -45,14 +52,116 @@ users_bp = Blueprint("users", __name__, url_prefix="/user")
 orders_bp = Blueprint("order", __name__, url_prefix="/order")
 tickets_bp = Blueprint("tickets", __name__, url_prefix="/tickets")
 
+# Bring the schema up to date before anything touches it
+applied_migrations = migrations.upgrade(glvars.db_path)
+if applied_migrations:
+    print(f"Applied migrations: {applied_migrations}")
+
 # Classes (Managers)
 db_man = DBManager()
-auth_man = usr.Authentication(db_man)
+hasher = hashing.PasswordHasher()
+auth_man = usr.Authentication(db_man, hasher)
 order_man = orders.OrderManager(db_man)
 tickets_man = tickets.TicketsManager(db_man)
-users_man = usr.UserManager(db_man)
+users_man = usr.UserManager(db_man, hasher)
+blob_man = blobs.BlobManager(db_man)
+thumbs_man = thumbnails.ThumbnailManager(db_man, blob_man)
+if not thumbs_man.enabled:
+    print("Thumbnails: Pillow is not installed, sized image requests get the full image")
+
+# Sessions go to the store picked by SESSION_BACKEND; 'filesystem' keeps Flask-Session's own file store
+session_store = sessions.make_session_interface(app, db_man)
+if session_store is None:
+    Session(app)
+else:
+    app.session_interface = session_store
 
 order_man.set_tickets_man(tickets_man)
+order_man.set_blob_man(blob_man)
+order_man.set_users_man(users_man)
+
+# Started by main.py; deadlines are only tracked while it runs
+expiry_scheduler = ExpiryScheduler(app, order_man)
+tickets_man.scheduler = expiry_scheduler
+
+if glvars.ticket_index_enabled:
+    print(f"Ticket index: {tickets_man.index.rebuild()['message']} ({len(tickets_man.index)} available)")
+
+print(f"DB profile '{glvars.db_profile_name}': {db_man.profile_report()}")
+
+
+# The logged-in user and their cart as full dicts, whatever the session holds. A slim session (SLIM_SESSIONS)
+# only has their ids, so they are loaded on first use and kept in g for the rest of the request.
+def current_user():
+    user = session.get("user_info")
+    if not user:
+        return None
+    if not glvars.slim_sessions and "name" in user:
+        return user
+
+    if "_user" not in g:
+        res = users_man.get_user(user["id"])
+        g._user = res["data"].to_dict() if res["success"] else None
+    return g._user
+
+
+def current_cart():
+    cart = session.get("cart")
+    if not cart:
+        return None
+    if not glvars.slim_sessions and "tickets_bought" in cart:
+        return cart
+
+    if "_cart" not in g:
+        user = session.get("user_info")
+        g._cart = order_man.load_session_cart(cart["id"], user["id"] if user else None)["cart"]
+    return g._cart
+
+
+# A slim session is only written when the ids or role actually change
+def set_current_user(user):
+    g._user = user
+    stored = glvars.session_user(user)
+    if session.get("user_info") != stored:
+        session["user_info"] = stored
+
+
+def set_current_cart(cart):
+    g._cart = cart
+    stored = glvars.session_cart(cart)
+    if session.get("cart") != stored:
+        session["cart"] = stored
+
+
+# Available tickets for the storefront, as (code, status, expire_at, buyer_id, note_for) rows.
+# Served from the in-memory index when it is enabled.
+def load_available(q, limit, cursor, offset):
+    if not glvars.ticket_index_enabled:
+        source, source_params = glvars.tickets_source()
+        # Literal status so the planner can use idx_tickets_available
+        where = [f"status = {glvars.status_available}"]
+        params = [*source_params]
+        if q:
+            where.append("code LIKE ?")
+            params.append(f"%{q}%")
+
+        res = db_man.execute_page(
+            f"SELECT code, status, expire_at, buyer_id, note_for FROM {source} t",
+            "code",
+            where=where,
+            params=params,
+            limit=limit,
+            cursor=cursor,
+            offset=offset,
+        )
+        if res["success"]:
+            res["data"] = [glvars.ticket_row_to_json(row, 1, 2) for row in res["data"]]
+        return res
+
+    res = tickets_man.index.page(q, limit, cursor, offset)
+    if res["success"]:
+        res["data"] = [(code, glvars.status_codes[0], None, None, None) for code in res["data"]]
+    return res
 
 
 # The ROOT
@@ -60,26 +169,25 @@ order_man.set_tickets_man(tickets_man)
 def index():
     # query = f"SELECT t.code, t.buyer_id, u.name, u.address, u.phone_number FROM {glvars.tickets_table} t JOIN {glvars.users_table} u ON t.buyer_id = u.id;"
     q = request.args.get("q")
-    offset = request.args.get("offset") or 0
-    limit = request.args.get("limit") or 28
+    offset = request.args.get("offset", 0, type=int)
+    limit = request.args.get("limit", 28, type=int)
+    cursor = request.args.get("cursor") or None
 
-    query = f"SELECT * FROM {glvars.tickets_table} WHERE status = 'available' LIMIT {limit} OFFSET {offset}"
-
-    if q:
-        refined_q = f"%{q}%"
-        query = f"SELECT * FROM {glvars.tickets_table} WHERE status = 'available' AND code LIKE ? LIMIT 28 OFFSET {offset}"
-        data = db_man.execute_query(query, (refined_q,))
-        print("With q: ", data)
-    else:
-        data = db_man.execute_query(query)
-        print("Without q: ", data)
+    res = load_available(q, min(max(limit, 1), 100), cursor, offset)
+    if not res["success"]:
+        return glvars.ReturnMessage(False, res["message"]).response()
 
-    session_data = session.get("user_info")
+    session_data = current_user()
     if not session_data:
         session_data = {}
 
     return glvars.ReturnData(
-        True, "Ok!", data=data, user_session=session_data
+        True,
+        "Ok!",
+        data=res["data"],
+        user_session=session_data,
+        next_cursor=res["next_cursor"],
+        prev_cursor=res["prev_cursor"],
     ).response()
 
 
@@ -88,15 +196,41 @@ def version():
     return glvars.ReturnMessage(True, "Backend: v.0.3.1").response()
 
 
+@app.route("/stats")
+def stats():
+    user = session.get("user_info")
+    if not user or user["role"] != "admin":
+        return glvars.ReturnMessage(False, "You are not an admin!").response()
+
+    return glvars.ReturnData(
+        True,
+        "Stats",
+        db_pool=db_man.pool_stats(),
+        db_profile=db_man.profile_report(),
+        expiry_scheduler=expiry_scheduler.stats(),
+        password_hasher=hasher.stats(),
+        user_cache=users_man.cache.stats(),
+        sessions=session_store.session_stats() if session_store else {"backend": "filesystem"},
+    ).response()
+
+
 @app.route("/search")
 def search():
-    q = request.args.get("q")
-    offset = request.args.get("offset")
+    q = request.args.get("q") or None
+    offset = request.args.get("offset", 0, type=int)
+    cursor = request.args.get("cursor") or None
 
-    query = f"SELECT * FROM {glvars.tickets_table} WHERE status = 'available' AND code LIKE ? LIMIT 28 OFFSET ?"
+    res = load_available(q, 28, cursor, offset)
+    if not res["success"]:
+        return glvars.ReturnMessage(False, res["message"]).response()
 
-    res = db_man.execute_query(query, (q, offset))
-    return glvars.ReturnData(True, "OK!", data=res).response()
+    return glvars.ReturnData(
+        True,
+        "OK!",
+        data=res["data"],
+        next_cursor=res["next_cursor"],
+        prev_cursor=res["prev_cursor"],
+    ).response()
 
 
 @app.route("/bought_data")
@@ -107,13 +241,14 @@ def get_bought_data():
 
     query = f"SELECT t.code, t.status, t.note_for FROM {glvars.tickets_table} t JOIN {glvars.users_table} u ON t.buyer_id = u.id WHERE t.buyer_id = ? AND t.status != ? AND t.status != ?"
 
-    params = [user["id"], "ordered", "available"]
+    params = [user["id"], glvars.status_ordered, glvars.status_available]
 
     res = db_man.execute_query(query, params)
     if not isinstance(res, list) or not res:
         return glvars.ReturnMessage(False, "Not found!").response()
 
-    return glvars.ReturnData(False, "Found!", data=res).response()
+    data = [glvars.ticket_row_to_json(row, 1) for row in res]
+    return glvars.ReturnData(False, "Found!", data=data).response()
 
 
 @app.route("/register", methods=["POST"])
@@ -136,9 +271,10 @@ def logout():
 
 @app.route("/load_user")
 def load_user():
-    if not session.get("user_info"):
+    user = current_user()
+    if not user:
         return glvars.ReturnMessage(False, "User not logged in!").response()
-    return glvars.ReturnData(True, "Ok!", user=session.get("user_info")).response()
+    return glvars.ReturnData(True, "Ok!", user=user).response()
 
 
 @app.route("/is_admin")
@@ -163,16 +299,32 @@ def change_pfp():
         return glvars.ReturnMessage(False, "No picture provided!").response()
     if not user:
         return glvars.ReturnMessage(False, "You are not logged in!").response()
-    
-    user['pfp'] = pfp
-    session['user_info']['pfp'] = pfp
-    edit_user = users_man.edit_user(user['id'], ['pfp',], [pfp,], db_conn)
+
+    # A copy goes to the blob store so /user/pfp_img can serve it and its thumbnails
+    image = glvars.decode_data_url(pfp)
+    if not image:
+        return glvars.ReturnMessage(False, "Not a base64 image!").response()
+    upload = blob_man.spool_upload(io.BytesIO(image[1]))
+    if not upload["success"]:
+        return glvars.ReturnMessage(False, upload["message"]).response()
+    try:
+        blob_res = blob_man.put_upload(upload, db_conn)
+    finally:
+        upload["spool"].close()
+    if not blob_res["success"]:
+        db_man.rollback(db_conn)
+        return glvars.ReturnMessage(False, f"Something went wrong! - {blob_res['message']}").response()
+
+    edit_user = users_man.edit_user(user['id'], ['pfp', 'pfp_hash'], [pfp, blob_res['hash']], db_conn)
     if not edit_user['success']:
         return glvars.ReturnMessage(False, f"Something went wrong! - {edit_user['message']}").response()
     
     commit = db_man.commit(db_conn)
     if not commit['success']:
         return glvars.ReturnMessage(False, f"Something went wrong while committing - {commit['message']}").response()
+    users_man.forget_user(user['id'])
+
+    set_current_user(dict(current_user(), pfp=pfp))
     
     return glvars.ReturnMessage(True, "Changed pfp!").response()
     
@@ -186,42 +338,44 @@ def change_pfp():
 ###############
 @cart_bp.route("/")
 def cart_root():
-    if not session.get("cart"):
-        results = order_man.create_cart(session.get("user_info"))
+    user = current_user()
+    if not user:
+        return glvars.ReturnMessage(False, "Log in first").response()
+
+    if not current_cart():
+        results = order_man.create_cart(user)
         if not results["success"]:
             return glvars.ReturnMessage(
                 False, f"Something went wrong in making a cart: {results['message']}"
             ).response()
-        session["cart"] = results["cart"]
-
-    if not session.get("user_info"):
-        return glvars.ReturnMessage(False, "Log in first").response()
+        set_current_cart(results["cart"])
 
     return glvars.ReturnData(
         True,
         "Cart Data is here",
-        data=session.get("cart"),
-        user=session.get("user_info"),
+        data=current_cart(),
+        user=user,
     ).response()
 
 
 @cart_bp.route("/add", methods=["POST"])
 def add_to_cart():
-    if not session.get("user_info"):
+    user = current_user()
+    if not user:
         return glvars.ReturnMessage(False, "Login first").response()
 
     print(f"CART_SESSION 1: {session.get('cart')}")
-    if not session.get("cart") or not session.get("cart")["is_in_cart"]:
+    if not current_cart() or not current_cart()["is_in_cart"]:
         print('\nNEW CART\n')
-        results = order_man.create_cart(session.get("user_info"))
-        session["cart"] = results["cart"]
+        results = order_man.create_cart(user)
+        set_current_cart(results["cart"])
 
     print(f"CART_SESSION 1: {session.get('cart')}")
 
     data = request.get_json()
     ticket_code = data.get("code")
     response = order_man.add_tickets_to_cart(
-        ticket_code, session.get("user_info"), session.get("cart")
+        ticket_code, user, current_cart()
     )
 
     print(response)
@@ -229,54 +383,116 @@ def add_to_cart():
     if not response["success"]:
         return glvars.ReturnData(False, response["message"]).response()
 
-    session["user_info"] = response["user"]
-    session["cart"] = response["cart"]
+    set_current_user(response["user"])
+    set_current_cart(response["cart"])
 
     return glvars.ReturnData(True, "Added to cart").response()
 
 
+# Body: {"codes": ["100", "101"]} or {"codes": "100-120;7"}
+@cart_bp.route("/add_many", methods=["POST"])
+def add_many_to_cart():
+    user = current_user()
+    if not user:
+        return glvars.ReturnMessage(False, "Login first").response()
+
+    data = request.get_json(silent=True) or {}
+    codes = data.get("codes")
+    if isinstance(codes, list):
+        codes = [str(code).strip() for code in codes if str(code).strip()]
+    else:
+        # Stop expanding a huge range as soon as it is over the limit
+        parse_res = glvars.parse_codes(codes or "", limit=glvars.cart_batch_max + 1)
+        if not parse_res["success"]:
+            return glvars.ReturnMessage(False, parse_res["message"]).response()
+        codes = parse_res["codes"]
+
+    codes = list(dict.fromkeys(codes))
+    if not codes:
+        return glvars.ReturnMessage(False, "No codes given!").response()
+    if len(codes) > glvars.cart_batch_max:
+        return glvars.ReturnMessage(False, f"At most {glvars.cart_batch_max} tickets per request!").response()
+
+    if not current_cart() or not current_cart()["is_in_cart"]:
+        results = order_man.create_cart(user)
+        set_current_cart(results["cart"])
+
+    response = order_man.add_many_to_cart(
+        codes, user, current_cart()
+    )
+    if not response["success"]:
+        return glvars.ReturnData(False, response["message"]).response()
+
+    set_current_user(response["user"])
+    set_current_cart(response["cart"])
+
+    return glvars.ReturnData(
+        True, response["message"], added=response["added"], results=response["results"]
+    ).response()
+
+
 @cart_bp.route("/remove", methods=["POST"])
 def remove_from_cart():
-    if not session.get("user_info"):
+    user = current_user()
+    if not user:
         return glvars.ReturnMessage(False, "Login first").response()
 
-    if not session.get("cart"):
+    if not current_cart():
         return glvars.ReturnMessage(False, "No Cart!").response()
 
     data = request.get_json()
     ticket_code = data.get("code")
     response = order_man.remove_tickets_from_cart(
-        ticket_code, session.get("user_info"), session.get("cart")
+        ticket_code, user, current_cart()
     )
 
     if not response["success"]:
         return glvars.ReturnData(False, response["message"]).response()
 
-    session["user_info"] = response["user"]
-    session["cart"] = response["cart"]
+    set_current_user(response["user"])
+    set_current_cart(response["cart"])
 
     return glvars.ReturnData(True, "Removed from cart").response()
 
 
+# Images come as a multipart/form-data file field, or as a base64 data URL in a JSON body (older clients).
+# Either way they end up in a spool from BlobManager.spool_upload, checked against MAX_UPLOAD_BYTES.
+def load_upload(field):
+    if request.mimetype == "multipart/form-data":
+        # Werkzeug stops reading the body once it goes past this, before the whole upload is parsed
+        request.max_content_length = glvars.max_upload_bytes + 64 * 1024
+        file = request.files.get(field)
+        if not file:
+            return glvars.ReturnMessage(False, f"No {field} file!").send()
+        return blob_man.spool_upload(file.stream)
+
+    data = request.get_json(silent=True) or {}
+    image = glvars.decode_data_url(data.get(field))
+    if not image:
+        return glvars.ReturnMessage(False, "Not a base64 image!").send()
+    return blob_man.spool_upload(io.BytesIO(image[1]))
+
+
 @cart_bp.route("/confirm", methods=["POST"])
 def confirm_cart():
-    data = request.get_json()
-    img_data = data.get("img_link")
-
-    if not glvars.is_base64_image(img_data) or not img_data:
+    upload = load_upload("img_link")
+    if not upload["success"]:
         return glvars.ReturnMessage(
-            False, "An error occured with the image!"
+            False, f"An error occured with the image! {upload['message']}"
         ).response()
 
-    res = order_man.confirm_bought(
-        img_data, session.get("user_info"), session.get("cart")
-    )
+    try:
+        res = order_man.confirm_bought(
+            upload, current_user(), current_cart()
+        )
+    finally:
+        upload["spool"].close()
 
     if not res["success"]:
-        return glvars.ReturnMessage(False, res["message"]).response()
+        return glvars.ReturnData(False, res["message"], results=res.get("results", [])).response()
 
-    session["cart"] = None
-    session["user_info"] = res["user"]
+    set_current_cart(None)
+    set_current_user(res["user"])
 
     if (
         session["user_info"]["role"] == "admin"
@@ -289,7 +505,7 @@ def confirm_cart():
 
     print(f"SESSION ROLE: {session['user_info']['role']}")
 
-    return glvars.ReturnMessage(True, res["message"]).response()
+    return glvars.ReturnData(True, res["message"], results=res["results"]).response()
 
 
 #######################
@@ -299,19 +515,20 @@ def confirm_cart():
 
 @orders_bp.route("/")
 def load_orders():
-    offset = request.args.get("offset") or "0"
+    offset = request.args.get("offset", 0, type=int)
     search_q = request.args.get("q") or None
     search_for = request.args.get("type") or None
-
-    if search_q and search_for:
-        params = f'%{search_q}%'
-        query = f"SELECT o.id, u.id, u.name, o.tickets_bought, CASE WHEN o.is_in_cart = 1 THEN 'ordered' WHEN o.confirmed = 0 THEN 'processing' WHEN o.confirmed = 1 THEN 'confirmed' END AS status, o.id FROM {glvars.orders_table} o JOIN {glvars.users_table} u ON o.buyer_id = u.id WHERE o.confirmed = 0 AND o.is_in_cart = 0 AND {search_for} LIKE ? LIMIT 28 OFFSET {offset}"
-        res = db_man.execute_query(query, (params,))
-    else:
-        query = f"SELECT o.id, u.id, u.name, o.tickets_bought, CASE WHEN o.is_in_cart = 1 THEN 'ordered' WHEN o.confirmed = 0 THEN 'processing' WHEN o.confirmed = 1 THEN 'confirmed' END AS status, o.id FROM {glvars.orders_table} o JOIN {glvars.users_table} u ON o.buyer_id = u.id WHERE o.confirmed = 0 AND o.is_in_cart = 0 LIMIT 28 OFFSET {offset}"
-        res = db_man.execute_query(query)
-    
-    if not isinstance(res, list):
+    cursor = request.args.get("cursor") or None
+
+    res = order_man.get_orders(
+        limit=28,
+        offset=offset,
+        q=search_q,
+        search_for=search_for,
+        cursor=cursor,
+        processing_only=True,
+    )
+    if not res["success"]:
         print('SOMETHING WENT WRONG IN LOADING ORDERS!')
         return glvars.ReturnMessage(
             False, "Something went wrong in loading orders!"
@@ -319,64 +536,124 @@ def load_orders():
 
     orders = []
     img_data = []
-    for row in res:
+    for row in res["data"]:
         orders.append([row[0], row[1], row[2], row[3], row[4]])
         img_data.append(row[5])
 
     return glvars.ReturnData(
-        True, "Orders Data", orders=orders, img_data=img_data
+        True,
+        "Orders Data",
+        orders=orders,
+        img_data=img_data,
+        next_cursor=res["next_cursor"],
+        prev_cursor=res["prev_cursor"],
     ).response()
 
 
 @orders_bp.route("/load_all")
 def load_all():
-    offset = request.args.get("offset") or 0
+    offset = request.args.get("offset", 0, type=int)
     search_q = request.args.get("q") or None
-    search_for = request.args.get('type') or None
-
-    if search_q and search_for:
-        params = f'%{search_q}%'
-        query = f"SELECT o.id, u.id, u.name, o.tickets_bought, CASE WHEN o.is_in_cart = 1 THEN 'ordered' WHEN o.confirmed = 0 THEN 'processing' WHEN o.confirmed = 1 THEN 'confirmed' END AS status, o.id FROM {glvars.orders_table} o JOIN {glvars.users_table} u ON o.buyer_id = u.id WHERE {search_for} LIKE ? LIMIT 15 OFFSET {offset}"
-        res = db_man.execute_query(query, (params,))
-    else:
-        query = f"SELECT o.id, u.id, u.name, o.tickets_bought, CASE WHEN o.is_in_cart = 1 THEN 'ordered' WHEN o.confirmed = 0 THEN 'processing' WHEN o.confirmed = 1 THEN 'confirmed' END AS status, o.id FROM {glvars.orders_table} o JOIN {glvars.users_table} u ON o.buyer_id = u.id LIMIT 15 OFFSET {offset}"
-        res = db_man.execute_query(query)
-
-    if not isinstance(res, list):
+    search_for = request.args.get("type") or None
+    cursor = request.args.get("cursor") or None
+
+    res = order_man.get_orders(
+        limit=15,
+        offset=offset,
+        q=search_q,
+        search_for=search_for,
+        cursor=cursor,
+        processing_only=False,
+    )
+    if not res["success"]:
+        print('SOMETHING WENT WRONG IN LOADING ORDERS!')
         return glvars.ReturnMessage(
             False, "Something went wrong in loading orders!"
         ).response()
 
     orders = []
     img_data = []
-    for row in res:
+    for row in res["data"]:
         orders.append([row[0], row[1], row[2], row[3], row[4]])
         img_data.append(row[5])
 
     return glvars.ReturnData(
-        True, "Orders Data", orders=orders, img_data=img_data
+        True,
+        "Orders Data",
+        orders=orders,
+        img_data=img_data,
+        next_cursor=res["next_cursor"],
+        prev_cursor=res["prev_cursor"],
     ).response()
 
 
+def load_order_img_hash(order_id):
+    res = db_man.execute_query(f"SELECT img_link FROM {glvars.orders_table} WHERE id = ?", (order_id,))
+    if not isinstance(res, list) or not res or not res[0][0]:
+        return None
+    return res[0][0]
+
+
+# GET /order/load_img?id=<order id>[&size=<px>] streams the image itself, or its thumbnail
+@orders_bp.route("/load_img", methods=["GET"])
+def stream_img():
+    img_hash = load_order_img_hash(request.args.get("id", type=int))
+    if not img_hash:
+        return glvars.ReturnMessage(False, "Image not found!").response(), 404
+
+    return send_blob(img_hash, request.args.get("size", type=int))
+
+
+# The bytes behind a hash never change, so the ETag is the hash and browsers may cache it for good.
+# With a size, the thumbnail is sent instead. If it is unavailable the full image stands in, but only
+# until the browser revalidates, so the URL picks up the thumbnail once it can be rendered.
+def send_blob(img_hash, size=None):
+    cache_control = f"private, max-age={glvars.blob_cache_max_age}, immutable"
+    if size:
+        thumb = thumbs_man.get_thumbnail(img_hash, size)
+        if thumb["success"]:
+            img_hash = thumb["hash"]
+        else:
+            cache_control = "private, no-cache"
+            # Missing Pillow is reported once at startup
+            if thumbs_man.enabled:
+                print(f"THUMBNAIL FAILED: {thumb['message']}")
+
+    headers = {
+        "ETag": f'"{img_hash}"',
+        "Cache-Control": cache_control,
+    }
+    if img_hash in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    info = blob_man.get_blob_info(img_hash)
+    if not info["success"]:
+        return glvars.ReturnMessage(False, info["message"]).response(), 404
+
+    headers["Content-Length"] = str(info["size"])
+    if info["data"] is not None:
+        return Response(info["data"], mimetype=info["content_type"], headers=headers)
+    return Response(blob_man.stream_blob(info["rowid"]), mimetype=info["content_type"], headers=headers)
+
+
+# Older clients POST {"id": ...} and get the image back as a data URL
 @orders_bp.route("/load_img", methods=["POST"])
 def load_img():
     data = request.get_json()
     img_id = data["id"]
-    query = f"SELECT img_link FROM {glvars.orders_table} WHERE id = ?"
 
-    res = db_man.execute_query(query, (img_id,))
-    if not isinstance(res, list) or not res:
+    img_hash = load_order_img_hash(img_id)
+    if not img_hash:
         return glvars.ReturnMessage(
             False, "Something went wrong in loading orders!"
         ).response()
-    try:
-        img_data = res[0]
-    except IndexError:
-        return glvars.ReturnMessage(False, "Index Error in Load Image").response()
-    print(img_data)
+
+    res = blob_man.read_blob(img_hash)
+    if not res["success"]:
+        return glvars.ReturnMessage(False, res["message"]).response()
 
     return glvars.ReturnData(
-        True, f"Image Data of {img_id}", img_data=img_data
+        True, f"Image Data of {img_id}", img_data=[glvars.encode_data_url(res["content_type"], res["data"])]
     ).response()
 
 
@@ -394,6 +671,42 @@ def confirm_order():
     return glvars.ReturnMessage(True, "Confirmed order").response()
 
 
+def load_batch_ids():
+    user = session.get("user_info")
+    if not user or user["role"] not in ("admin", "agent"):
+        return None, glvars.ReturnMessage(False, "You are not an admin!").response()
+
+    data = request.get_json(silent=True) or {}
+    order_ids = data.get("code")
+    if not isinstance(order_ids, list) or not order_ids:
+        return None, glvars.ReturnMessage(False, "No orders given!").response()
+    if len(order_ids) > glvars.order_batch_max:
+        return None, glvars.ReturnMessage(False, f"At most {glvars.order_batch_max} orders per request!").response()
+
+    return order_ids, None
+
+
+# Body: {"code": [order_id, ...]}, same key as /confirm
+@orders_bp.route("/confirm_batch", methods=["POST"])
+def confirm_orders():
+    order_ids, error = load_batch_ids()
+    if error:
+        return error
+
+    confirm_res = order_man.confirm_orders(order_ids)
+    return glvars.ReturnData(**confirm_res).response()
+
+
+@orders_bp.route("/cancel_batch", methods=["POST"])
+def cancel_orders():
+    order_ids, error = load_batch_ids()
+    if error:
+        return error
+
+    cancel_res = order_man.cancel_orders(order_ids)
+    return glvars.ReturnData(**cancel_res).response()
+
+
 @orders_bp.route("/edit_note", methods=["POST"])
 def edit_note():
     res = request.get_json()
@@ -424,15 +737,13 @@ def cancel_order():
 ############
 @users_bp.route("/")
 def get_users():
-    offset = int(request.args.get("offset") or "0")
+    offset = request.args.get("offset", 0, type=int)
     q = request.args.get("q") or None
     search_for = request.args.get("type") or "id"
-    limit = request.args.get("limit") or '15'
+    limit = request.args.get("limit", type=int) or 15
+    cursor = request.args.get("cursor") or None
 
-    try:
-        res = users_man.get_users(limit=int(limit), offset=offset, q=q, search_for=search_for)
-    except Exception:
-        return glvars.ReturnMessage(False, "Limit must be a number!").response()
+    res = users_man.get_users(limit=min(max(limit, 1), 100), offset=offset, q=q, search_for=search_for, cursor=cursor)
 
     if not res["success"]:
         return glvars.ReturnMessage(
@@ -447,7 +758,12 @@ def get_users():
         personal_info.append([row[3], row[4], row[5], row[6], row[7]])
 
     return glvars.ReturnData(
-        True, "Fetched user data", data=main_data, personal_info=personal_info
+        True,
+        "Fetched user data",
+        data=main_data,
+        personal_info=personal_info,
+        next_cursor=res["next_cursor"],
+        prev_cursor=res["prev_cursor"],
     ).response()
 
 
@@ -459,6 +775,8 @@ def set_role():
         return glvars.ReturnMessage(False, "Select a role!").response()
 
     user_data = users_man.get_user(data["id"])
+    if not user_data["success"]:
+        return glvars.ReturnMessage(False, user_data["message"]).response()
     user = user_data["data"]
 
     user.set_vars(["role"], [data["role"]])
@@ -478,6 +796,7 @@ def set_role():
         return glvars.ReturnMessage(
             False, f"Could not commit: {commit_res['message']}"
         ).response()
+    users_man.forget_user(user.id)
 
     return glvars.ReturnMessage(True, f"Role set to {data['role']}").response()
 
@@ -514,6 +833,8 @@ def add_user():
     u_add = users_man.add_user(u_name, u_phone_number, u_password, u_address, db_conn)
 
     if not u_add["success"]:
+        if u_add.get("busy"):
+            return usr.busy_response(u_add)
         return glvars.ReturnMessage(False, u_add["message"]).response()
 
     commit_res = db_man.commit(db_conn)
@@ -525,6 +846,38 @@ def add_user():
     return glvars.ReturnMessage(True, "Added User!").response()
 
 
+# Body: a CSV (header row with name, phone_number, password and optionally address, email, role)
+# or NDJSON file, either as the raw request body or as the multipart "file" field. ?format=csv|ndjson
+# overrides the guess from the content type or file name.
+@users_bp.route("/import", methods=["POST"])
+def import_users():
+    user = session.get("user_info")
+    if not user or user["role"] != "admin":
+        return glvars.ReturnMessage(False, "You are not an admin!").response()
+
+    stream, name, mimetype = request.stream, "", request.mimetype
+    if request.mimetype == "multipart/form-data":
+        file = request.files.get("file")
+        if not file:
+            return glvars.ReturnMessage(False, "No file!").response()
+        stream, name, mimetype = file.stream, file.filename or "", file.mimetype
+
+    file_format = request.args.get("format")
+    if not file_format:
+        is_ndjson = mimetype in ("application/x-ndjson", "application/jsonl") or name.endswith((".ndjson", ".jsonl"))
+        file_format = "ndjson" if is_ndjson else "csv"
+    if file_format not in ("csv", "ndjson"):
+        return glvars.ReturnMessage(False, "Format must be csv or ndjson!").response()
+
+    rows = usr.iter_ndjson_rows(stream) if file_format == "ndjson" else usr.iter_csv_rows(stream)
+    try:
+        res = users_man.import_users(rows)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return glvars.ReturnMessage(False, f"Could not read the file: {e}").response()
+
+    return glvars.ReturnData(**res).response()
+
+
 @users_bp.route("/del_user", methods=['POST'])
 def del_user():
     data = request.get_json()
@@ -540,6 +893,7 @@ def del_user():
     commit_res = db_man.commit(db_conn)
     if not commit_res:
         return glvars.ReturnMessage(False, commit_res['message']).response()
+    users_man.forget_user(u_id)
 
     return glvars.ReturnMessage(True, "Deleted user!").response()
 
@@ -562,6 +916,8 @@ def edit_user():
         user.id, list(filtered_data.keys()), list(filtered_data.values()), db_conn
     )
     if not user_edit["success"]:
+        if user_edit.get("busy"):
+            return usr.busy_response(user_edit)
         return glvars.ReturnMessage(False, user_edit["message"]).response()
 
     commit_res = db_man.commit(db_conn)
@@ -569,6 +925,7 @@ def edit_user():
         return glvars.ReturnMessage(
             False, f"Could not commit data: {commit_res['message']}"
         ).response()
+    users_man.forget_user(user.id)
 
     return glvars.ReturnData(True, "Edited user!", data=user.to_dict()).response()
 
@@ -596,25 +953,42 @@ def load_img():
     ).response()
 
 
+# GET /user/pfp_img?id=<user id>[&size=<px>]
+@users_bp.route("/pfp_img")
+def stream_pfp():
+    res = db_man.execute_query(
+        f"SELECT pfp_hash FROM {glvars.users_table} WHERE id = ?", (request.args.get("id", type=int),)
+    )
+    if not isinstance(res, list) or not res or not res[0][0]:
+        return glvars.ReturnMessage(False, "Image not found!").response(), 404
+
+    return send_blob(res[0][0], request.args.get("size", type=int))
+
+
 ##############
 # Tickets BP #
 ##############
 @tickets_bp.route("/")
 def get_tickets():
-    offset = int(request.args.get("offset") or "0")
+    offset = request.args.get("offset", 0, type=int)
     q = request.args.get("q") or None
     search_for = request.args.get("type") or None
+    cursor = request.args.get("cursor") or None
 
-    res = tickets_man.get_records(limit=15, offset=offset, q=q, search_for=search_for)
+    res = tickets_man.get_records(limit=15, offset=offset, q=q, search_for=search_for, cursor=cursor)
 
     if not res["success"]:
         return glvars.ReturnMessage(
             False, "Something went wrong with the database! **tickets**"
         ).response()
 
-    print(f"RES: {res}")
-
-    return glvars.ReturnData(True, res["message"], data=res["data"]).response()
+    return glvars.ReturnData(
+        True,
+        res["message"],
+        data=res["data"],
+        next_cursor=res["next_cursor"],
+        prev_cursor=res["prev_cursor"],
+    ).response()
 
 
 @tickets_bp.route("/get_ticket")
@@ -627,7 +1001,7 @@ def get_ticket():
 
     ticket = ticket_import["data"]
 
-    return glvars.ReturnData(True, "Some ticket...", data=ticket.to_dict()).response()
+    return glvars.ReturnData(True, "Some ticket...", data=ticket.to_json()).response()
 
 
 @tickets_bp.route("/add_ticket", methods=["POST"])
@@ -639,37 +1013,15 @@ def add_ticket():
     if not code:
         return glvars.ReturnMessage(False, "No code provided").response()
 
-    codes = str(code).strip().split(";")
-    print(f"LENGTH CODES: {len(codes)}")
-    print(f"CODE: {code}")
-    print(f"CODES: {codes}")
-    # if len(codes) == 0 and code:
-    #     codes = [code]
-
-    new_codes = list()
-
-    for c in codes:
-        c_mod = str(c).split("-")
+    parse_res = glvars.parse_codes(code)
+    if not parse_res["success"]:
+        return glvars.ReturnMessage(False, parse_res["message"]).response()
+    new_codes = parse_res["codes"]
 
-        if len(c_mod) == 2:
-            if int(c_mod[0]) > int(c_mod[1]):
-                c_mod = [c_mod[1], c_mod[0]]
-
-            for j in range(int(c_mod[0]), int(c_mod[1]) + 1):
-                new_codes.append(str(j))
-                res = tickets_man.add_ticket(str(j), db_conn)
-                if not res["success"]:
-                    print(f"FAILURE! {res['message']}")
-                    continue
-
-        elif len(c_mod) == 1:
-            new_codes.append(str(c_mod[0]))
-            res = tickets_man.add_ticket(str(c_mod[0]), db_conn)
-            if not res["success"]:
-                print(f"FAILURE! {res['message']}")
-                continue
-
-    print(f"NEW CODES: {new_codes}")
+    res = tickets_man.add_tickets(new_codes, db_conn)
+    if not res["success"]:
+        db_man.rollback(db_conn)
+        return glvars.ReturnMessage(False, res["message"]).response()
 
     commit_res = db_man.commit(db_conn)
     if not commit_res["success"]:
@@ -677,8 +1029,11 @@ def add_ticket():
             False, f"Could not commit: {commit_res['message']}"
         ).send()
 
+    # Codes that already existed were skipped, so reload rather than trusting new_codes
+    tickets_man.index.invalidate()
+
     return glvars.ReturnData(
-        True, "Added ticket(s)!", added_tickets=new_codes
+        True, "Added ticket(s)!", added_tickets=new_codes, added_count=res["added"]
     ).response()
 
 
@@ -716,6 +1071,14 @@ def edit_ticket():
     if not ticket or not ticket.is_available():
         return glvars.ReturnMessage(False, "Not Allowed!").response()
 
+    # Back from the JSON names/times to what the table stores
+    if "status" in filtered_data:
+        filtered_data["status"] = glvars.status_id(filtered_data["status"])
+        if filtered_data["status"] is None:
+            return glvars.ReturnMessage(False, "Unknown status!").response()
+    if "expire_at" in filtered_data:
+        filtered_data["expire_at"] = glvars.parse_expire_at(filtered_data["expire_at"])
+
     tickets_man.edit_ticket(
         ticket.code, list(filtered_data.keys()), list(filtered_data.values()), db_conn
     )
@@ -726,7 +1089,9 @@ def edit_ticket():
             False, f"Could not commit: {commit_res['message']}"
         ).send()
 
-    return glvars.ReturnData(True, "Edited ticket!", data=ticket.to_dict()).response()
+    tickets_man.index.invalidate()
+
+    return glvars.ReturnData(True, "Edited ticket!", data=ticket.to_json()).response()
 
 
 app.register_blueprint(cart_bp)
@@ -735,8 +1100,18 @@ app.register_blueprint(users_bp)
 app.register_blueprint(tickets_bp)
 
 
+# The request's connection goes back to the pool before the session is saved, so saving it never needs a
+# second pool slot. checkin() rolls back anything the route left uncommitted.
+@app.after_request
+def release_connection(response):
+    db_conn = g.pop('_database', None)
+    if db_conn is not None:
+        db_man.release_conn(db_conn)
+    return response
+
+
 @app.teardown_appcontext
 def close_connections(exception):
-    db_conn = getattr(g, '_database', None)
+    db_conn = g.pop('_database', None)
     if db_conn is not None:
-        db_conn.close()
\ No newline at end of file
+        db_man.release_conn(db_conn)
\ No newline at end of file